@@ -1,81 +1,331 @@
-import pandas as pd
-import os
 import argparse
+import csv
+import io
+import os
 import shutil
+from typing import List, Optional
+
+import pandas as pd
+
+from citation_store import update_store
+from fingerprints import RowKeyer
+from storage import is_parquet, is_sharded, read_table, write_daily_partition
+
+
+def read_header(file_path: str) -> List[str]:
+    """
+    Read a CSV header from the first line of a file without parsing the rest.
+
+    Args:
+        file_path: Path to the CSV file
 
-def append_new_rows(original_file_path, new_rows_file_path, combined_file_path=None):
+    Returns:
+        List of column names
     """
-    Appends new rows to the original file and prints shape details.
-    
-    Parameters:
-        original_file_path (str): Path to the original dataset.
-        new_rows_file_path (str): Path to the new rows dataset.
-        combined_file_path (str, optional): Path to a new dataset to append. Defaults to None.
+    with open(file_path, newline='', encoding='utf-8') as f:
+        return next(csv.reader([f.readline()]), [])
+
+
+def fsync_directory(directory: str):
     """
+    Flush a directory entry so renames and new files in it survive a crash.
+
+    Args:
+        directory: Directory to flush
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
     try:
-        # Check if the original file exists
-        if not os.path.exists(original_file_path):
-            print(f"Original file does not exist at {original_file_path}. Creating it with headers from {new_rows_file_path}.")
-            # Load new rows to extract headers
-            new_rows = pd.read_csv(new_rows_file_path)
-            new_rows.iloc[0:0].to_csv(original_file_path, index=False)  # Write only the header
-            print(f"File created at {original_file_path} with headers from {new_rows_file_path}.")
-        
-        # Load datasets
-        df_original = pd.read_csv(original_file_path)
-        new_rows = pd.read_csv(new_rows_file_path)
-
-        # Print sanity check
-        print("----------------------------------------------------------------------------")
-        print("Sanity Check for 'append_new_rows.py':")
-        print()
-        print(f"Reading original file from: {original_file_path}")
-        print(f"Reading new rows file from: {new_rows_file_path}")
-        print(f"Combined file path: {combined_file_path}")
-        print()
-        print(f"Shape of original dataset: {df_original.shape}")
-        print(f"Shape of new rows dataset: {new_rows.shape}")
-
-        # Check that columns match 
-        if not df_original.empty and list(df_original.columns) != list(new_rows.columns):
-            raise ValueError("Column mismatch between original dataset and new rows dataset.")
-
-        # Append new rows to the original dataset
-        df_combined = pd.concat([df_original, new_rows], ignore_index=True)
-
-        # Save the combined dataset
-        output_path = combined_file_path
-        df_combined.to_csv(output_path, index=False)
-
-        print(f"Shape of combined dataset after appending: {df_combined.shape}")
-
-        print("----------------------------------------------------------------------------")
-        print("Appending operation completed successfully.")
-        print("----------------------------------------------------------------------------")
-
-    except Exception as e:
-        # Log the error details
-        print("----------------------------------------------------------------------------")
-        print("An error occurred during the append operation:")
-        print(f"Error: {e}")
-        print("----------------------------------------------------------------------------")
-        raise
-
-def main():
-    # Define command-line arguments
-    parser = argparse.ArgumentParser(description="Append new rows to an existing dataset.")
-    parser.add_argument('--original_file_path', type=str, required=True,
-                        help="Path to the dataset to which new rows will be appended.")
-    parser.add_argument('--new_rows_file_path', type=str, required=True,
-                        help="Path to the new rows dataset.")
-    parser.add_argument('--combined_file_path', type=str, default=None,
-                        help="Optional: Path to save the combined dataset.")
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-    args = parser.parse_args()
 
-    # Execute the append operation
-    append_new_rows(args.original_file_path, args.new_rows_file_path, args.combined_file_path)
+def write_durably(file_path: str, data: bytes):
+    """
+    Write bytes to a file and fsync it before returning.
+
+    Args:
+        file_path: Path to write
+        data: Content
+    """
+    with open(file_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def recover_interrupted_append(file_path: str) -> bool:
+    """
+    Finish an append that was interrupted part-way, using its journal and segment.
+
+    The journal holds the file size from before the append started and the segment
+    the rows being appended, both fsynced before the append begins. If the file is
+    exactly that size plus the segment, the append had completed and is kept;
+    otherwise the file is truncated back to the journalled size and the segment is
+    appended again. The rows are never dropped, as by then extract_new_rows.py has
+    already recorded them as published. A segment without a journal belongs to an
+    append that never started, or that finished, and is discarded.
+
+    Args:
+        file_path: CSV file that may have been appended to
+
+    Returns:
+        True if the file was modified
+    """
+    journal_path = file_path + '.journal'
+    segment_path = file_path + '.segment'
+
+    modified = False
+    if os.path.exists(journal_path):
+        with open(journal_path, encoding='utf-8') as f:
+            original_size = int(f.read().strip())
+        # Without its segment (a crash before the directory was flushed) the append had not started
+        segment = b''
+        if os.path.exists(segment_path):
+            with open(segment_path, 'rb') as f:
+                segment = f.read()
+        if os.path.getsize(file_path) != original_size + len(segment):
+            print(f"Completing interrupted append to {file_path} ({len(segment)} bytes after {original_size})")
+            with open(file_path, 'r+b') as f:
+                f.truncate(original_size)
+                f.seek(original_size)
+                f.write(segment)
+                f.flush()
+                os.fsync(f.fileno())
+            modified = True
+        os.remove(journal_path)
+
+    if os.path.exists(segment_path):
+        os.remove(segment_path)
+    return modified
+
+
+def build_segment(new_rows_file_path: str, header: List[str]) -> bytes:
+    """
+    Bytes to append for the new rows: the rows of the new file without its header line.
+
+    When the new file has the same columns in the same order its bytes are copied
+    as-is; if only the order differs, the rows are reordered to match header.
+
+    Args:
+        new_rows_file_path: CSV with the rows to append
+        header: Column names of the file being appended to
+
+    Returns:
+        CSV rows ending with a newline, or empty bytes if there are none
+    """
+    new_header = read_header(new_rows_file_path)
+
+    if new_header == header:
+        with open(new_rows_file_path, 'rb') as f:
+            f.readline()
+            segment = f.read()
+    elif sorted(new_header) == sorted(header):
+        new_rows = pd.read_csv(new_rows_file_path, dtype=str, keep_default_na=False)
+        buffer = io.StringIO()
+        new_rows[header].to_csv(buffer, index=False, header=False)
+        segment = buffer.getvalue().encode('utf-8')
+    else:
+        raise ValueError(
+            f"Columns of {new_rows_file_path} {new_header} do not match the existing file's columns {header}"
+        )
+
+    if segment and not segment.endswith(b'\n'):
+        segment += b'\n'
+    return segment
+
+
+def append_segment(target_path: str, segment: bytes):
+    """
+    Append rows to a CSV in place, journaled so that an interrupted append can be completed.
+
+    The rows are written to a fsynced segment file and the file's size to a fsynced
+    journal before they are appended; recover_interrupted_append redoes the append
+    from them on the next run if it does not complete.
+
+    Args:
+        target_path: Non-empty CSV to append to
+        segment: CSV rows ending with a newline, from build_segment
+    """
+    # An original without a trailing newline would glue its last row to the first new one
+    with open(target_path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            segment = b'\n' + segment
+
+    segment_path = target_path + '.segment'
+    journal_path = target_path + '.journal'
+    write_durably(segment_path, segment)
+    write_durably(journal_path, str(os.path.getsize(target_path)).encode('utf-8'))
+    fsync_directory(os.path.dirname(target_path))
+
+    with open(target_path, 'ab') as f:
+        f.write(segment)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.remove(journal_path)
+    os.remove(segment_path)
+
+
+def apply_changes(original_file_path: str, new_rows_file_path: str, changes_file_path: str, combined_file_path: str):
+    """
+    Rewrite the original CSV with changed rows replaced in place, deleted rows removed and inserted rows appended.
+
+    The original is streamed in chunks; only the new rows batch and the changes file,
+    both small, are held in memory. The result is written to a temporary file that is
+    renamed over combined_file_path once complete.
+
+    Args:
+        original_file_path: Existing CSV with all previously published rows
+        new_rows_file_path: CSV with the inserted and changed rows, in batch order
+        changes_file_path: Changes file written by extract_new_rows.py
+        combined_file_path: Where to write the updated CSV
+    """
+    changes = pd.read_csv(changes_file_path, dtype=str, keep_default_na=False)
+    new_rows = pd.read_csv(new_rows_file_path, dtype=str, keep_default_na=False)
+    apply_change_frames(original_file_path, new_rows, changes, combined_file_path)
+
+
+def apply_change_frames(original_file_path: str, new_rows: pd.DataFrame, changes: pd.DataFrame, combined_file_path: str):
+    """
+    apply_changes with the new rows and changes already read, as strings.
+
+    Args:
+        original_file_path: Existing CSV with all previously published rows
+        new_rows: Inserted and changed rows, in batch order
+        changes: Changes, with batch_row giving each changed row's position in new_rows
+        combined_file_path: Where to write the updated CSV
+    """
+    header = read_header(original_file_path)
+    new_rows = new_rows[header]
+
+    deleted = set()
+    replacements = {}
+    for row in changes.itertuples(index=False):
+        key = (row.hash_id, row.code, int(row.occurrence))
+        if row.change == 'deleted':
+            deleted.add(key)
+        else:
+            replacements[key] = int(row.batch_row)
+
+    temp_path = combined_file_path + '.tmp'
+    keyer = RowKeyer()
+    replaced_batch_rows = set()
+    write_header = True
+    for chunk in pd.read_csv(original_file_path, chunksize=10000, dtype=str, keep_default_na=False):
+        keys = keyer.keys(chunk)
+        for position, key in enumerate(keys):
+            if key in replacements:
+                chunk.iloc[position] = new_rows.iloc[replacements[key]].to_numpy()
+                replaced_batch_rows.add(replacements[key])
+        # .loc, as an empty list of booleans would select no columns with []
+        keep = [key not in deleted for key in keys]
+        chunk.loc[keep].to_csv(temp_path, index=False, header=write_header, mode='w' if write_header else 'a')
+        write_header = False
+
+    # Changed rows missing from the original are appended like inserted rows
+    inserted = new_rows.drop(index=new_rows.index[sorted(replaced_batch_rows)])
+    inserted.to_csv(temp_path, index=False, header=write_header, mode='w' if write_header else 'a')
+
+    with open(temp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, combined_file_path)
+    fsync_directory(os.path.dirname(combined_file_path))
+
+    print(f"Updated {combined_file_path}: {len(replaced_batch_rows)} rows replaced, {len(deleted)} deleted, {len(inserted)} appended")
+
+
+def append_new_rows(original_file_path: str, new_rows_file_path: str, combined_file_path: str, changes_file_path: Optional[str] = None):
+    """
+    Append new rows to the original CSV without reading or rewriting its existing rows.
+
+    Only the first line of the original file is read, to check its header. The new rows
+    are written to a fsynced segment file and the original size is recorded in a fsynced
+    journal before the segment is appended; if the append is interrupted, the next run
+    truncates the file back to that size and appends the segment again, so the published
+    output is never left with a partial row nor loses the batch. When combined_file_path differs from original_file_path, the original is
+    copied first and the copy is renamed into place.
+
+    When a changes file lists changed or deleted rows, the file has to be rewritten and
+    apply_changes is used instead. A sharded output (sharded_output.py) is updated
+    shard by shard, touching only the shards the new rows and changes fall in.
+
+    Args:
+        original_file_path: Existing CSV with all previously published rows
+        new_rows_file_path: CSV with the rows to add
+        combined_file_path: Where to write the combined CSV
+        changes_file_path: Optional changes file written by extract_new_rows.py
+    """
+    if is_sharded(original_file_path):
+        if original_file_path != combined_file_path:
+            raise ValueError("Sharded outputs are appended in place; use the same original and combined path")
+        # sharded_output builds on this module, so it is imported only when needed
+        from sharded_output import append_sharded
+        append_sharded(original_file_path, new_rows_file_path, changes_file_path)
+        return
+
+    if is_parquet(original_file_path):
+        # A partitioned Parquet table grows by one file per batch; existing partitions are never touched
+        if changes_file_path:
+            raise ValueError("Changes files can only be applied to CSV outputs")
+        if original_file_path != combined_file_path:
+            raise ValueError("Parquet outputs are appended in place; use the same original and combined path")
+        path = write_daily_partition(read_table(new_rows_file_path, dtype=str), original_file_path)
+        print(f"Appended {new_rows_file_path} to {original_file_path} as {path}")
+        return
+
+    if os.path.isdir(original_file_path):
+        raise ValueError(f"{original_file_path} is a directory but neither a sharded output nor a Parquet table with partition files")
+
+    recover_interrupted_append(original_file_path)
+
+    if changes_file_path and os.path.exists(original_file_path):
+        apply_changes(original_file_path, new_rows_file_path, changes_file_path, combined_file_path)
+        return
+
+    if not os.path.exists(original_file_path) or os.path.getsize(original_file_path) == 0:
+        print(f"No existing data at {original_file_path}; starting it from {new_rows_file_path}")
+        temp_path = combined_file_path + '.tmp'
+        shutil.copyfile(new_rows_file_path, temp_path)
+        os.replace(temp_path, combined_file_path)
+        fsync_directory(os.path.dirname(combined_file_path))
+        return
+
+    header = read_header(original_file_path)
+    segment = build_segment(new_rows_file_path, header)
+    if not segment:
+        print(f"No new rows in {new_rows_file_path}")
+        if combined_file_path != original_file_path:
+            shutil.copyfile(original_file_path, combined_file_path)
+        return
+
+    if os.path.abspath(combined_file_path) != os.path.abspath(original_file_path):
+        target_path = combined_file_path + '.tmp'
+        shutil.copyfile(original_file_path, target_path)
+    else:
+        target_path = combined_file_path
+
+    append_segment(target_path, segment)
+
+    if target_path != combined_file_path:
+        os.replace(target_path, combined_file_path)
+    fsync_directory(os.path.dirname(combined_file_path))
+
+    print(f"Appended {len(segment)} bytes from {new_rows_file_path} to {combined_file_path}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Append newly flagged rows to a published CSV.")
+    parser.add_argument('--original_file_path', required=True, help="Existing CSV with all previously published rows")
+    parser.add_argument('--new_rows_file_path', required=True, help="CSV with the rows to add")
+    parser.add_argument('--combined_file_path', required=True, help="Where to write the combined CSV (may equal the original)")
+    parser.add_argument('--changes_file_path', default=None, help="Changes file from extract_new_rows.py, to update changed and deleted rows in place")
+    parser.add_argument('--store_path', default=None, help="SQLite citation store (citation_store.py) to upsert the new rows into as well")
+    args = parser.parse_args()
+
+    append_new_rows(args.original_file_path, args.new_rows_file_path, args.combined_file_path, args.changes_file_path)
+    if args.store_path:
+        update_store(args.store_path, args.new_rows_file_path, args.changes_file_path)
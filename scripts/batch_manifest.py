@@ -0,0 +1,303 @@
+"""
+Manifest of the new rows batches written by extract_new_rows.py.
+
+The manifest is a JSON file kept next to the batches. It lists every batch in
+arrival order with its timestamp, row count, the upstream commit it was extracted
+from and the flags that have processed it. Stages look up their work here instead
+of listing and stat-ing the batch directory, so the latest batch is found in O(1)
+and does not depend on file modification times, which git checkouts reset.
+
+Batches compacted by compact_batches.py no longer have a file of their own: their
+entry gives the monthly segment holding their rows, with the byte offset and size of
+those rows in it, and read_batch reads them back from there.
+"""
+import io
+import json
+import os
+import re
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+NEW_ROWS_DIR = '../data/flagging_process/new_rows/'
+MANIFEST_NAME = 'manifest.json'
+NEW_ROWS_PREFIX = 'inspections_citations_new_rows_'
+CHANGES_PREFIX = 'inspections_citations_changes_'
+
+# Subdirectory of the batch directory holding compacted segments and their offset indexes
+SEGMENTS_DIR = 'segments'
+SEGMENT_INDEX_SUFFIX = '.index.csv'
+
+# Timestamp embedded in batch file names, e.g. inspections_citations_new_rows_20250113_112857.csv
+BATCH_TIMESTAMP = re.compile(r'(\d{8})_(\d{6})')
+
+
+def get_upstream_commit(upstream_file: str, ref: str = 'origin/main') -> Optional[str]:
+    """
+    Commit of the upstream submodule that batches are extracted from.
+
+    Args:
+        upstream_file: A file inside the aphis-inspection-reports checkout
+        ref: Ref the workflow checks the citations file out from
+
+    Returns:
+        Commit hash, or None if it cannot be determined
+    """
+    try:
+        result = subprocess.run(['git', '-C', os.path.dirname(upstream_file) or '.', 'rev-parse', ref], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def batch_timestamp(file_name: str) -> str:
+    """
+    ISO timestamp parsed from a batch file name.
+
+    Args:
+        file_name: Batch file name
+
+    Returns:
+        Timestamp such as '2025-01-13T11:28:57'
+    """
+    match = BATCH_TIMESTAMP.search(file_name)
+    if match is None:
+        raise ValueError(f"No timestamp in batch file name '{file_name}'")
+    return datetime.strptime(''.join(match.groups()), '%Y%m%d%H%M%S').isoformat()
+
+
+def changes_name(batch_name: str) -> str:
+    """
+    Name of the changes file extract_new_rows.py writes alongside a batch.
+    """
+    return CHANGES_PREFIX + batch_name[len(NEW_ROWS_PREFIX):]
+
+
+def read_slice(directory: str, location: Dict) -> bytes:
+    """
+    A segment's header line followed by the bytes at a location in it.
+
+    Args:
+        directory: Batch directory
+        location: Dictionary with the segment path, relative to directory, and the offset and size of the bytes
+
+    Returns:
+        CSV content
+    """
+    with open(os.path.join(directory, location['path']), 'rb') as f:
+        header = f.readline()
+        f.seek(location['offset'])
+        return header + f.read(location['size'])
+
+
+class BatchManifest:
+    def __init__(self, directory: str = NEW_ROWS_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.batches = []
+
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.batches = json.load(f)['batches']
+        else:
+            self.bootstrap()
+
+    def bootstrap(self):
+        """
+        Build the manifest from the batch files already in the directory.
+
+        Timestamps come from the file names. Batches that predate the manifest are
+        recorded as processed by every flag that exists now; to run a newly added
+        flag over history, classify the full upstream file with --input instead.
+        Compacted batches are recovered from the segments' offset indexes.
+        """
+        from flag_definitions import FLAG_DEFINITIONS
+
+        print(f"No manifest at {self.path}; building it from the batch files")
+        names = [
+            name for name in os.listdir(self.directory)
+            if name.startswith(NEW_ROWS_PREFIX) and name.endswith('.csv')
+        ]
+        for name in names:
+            rows = len(pd.read_csv(os.path.join(self.directory, name), usecols=[0]))
+            self.batches.append({
+                'path': name,
+                'timestamp': batch_timestamp(name),
+                'rows': rows,
+                'upstream_commit': None,
+                'flagged': sorted(FLAG_DEFINITIONS),
+            })
+
+        segments_dir = os.path.join(self.directory, SEGMENTS_DIR)
+        index_names = os.listdir(segments_dir) if os.path.isdir(segments_dir) else []
+        for index_name in (name for name in index_names if name.endswith(SEGMENT_INDEX_SUFFIX)):
+            index = pd.read_csv(os.path.join(segments_dir, index_name), keep_default_na=False)
+            for entry in index.itertuples(index=False):
+                batch = {
+                    'path': entry.path,
+                    'timestamp': batch_timestamp(entry.path),
+                    'rows': int(entry.rows),
+                    'upstream_commit': entry.upstream_commit or None,
+                    'flagged': sorted(FLAG_DEFINITIONS),
+                    'segment': {'path': entry.segment, 'offset': int(entry.offset), 'size': int(entry.size)},
+                }
+                if entry.changes_segment:
+                    batch['changes'] = {'path': entry.changes_segment, 'offset': int(entry.changes_offset),
+                                        'size': int(entry.changes_size)}
+                self.batches.append(batch)
+
+        self.batches.sort(key=lambda batch: batch['timestamp'])
+        self.save()
+
+    def save(self):
+        """
+        Write the manifest, replacing the previous version atomically.
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'batches': self.batches}, f, indent=1)
+            f.write('\n')
+        os.replace(temp_path, self.path)
+
+    def full_path(self, batch: Dict) -> str:
+        """
+        Path of a batch file relative to the working directory.
+
+        Args:
+            batch: Manifest entry
+
+        Returns:
+            Path to the batch file
+        """
+        return os.path.join(self.directory, batch['path'])
+
+    def read_batch(self, batch: Dict, **csv_kwargs) -> pd.DataFrame:
+        """
+        Rows of a batch, from its own file or from the segment it was compacted into.
+
+        Args:
+            batch: Manifest entry
+            csv_kwargs: Extra pd.read_csv arguments
+
+        Returns:
+            DataFrame
+        """
+        if 'segment' in batch:
+            source = io.BytesIO(read_slice(self.directory, batch['segment']))
+        else:
+            source = self.full_path(batch)
+        return pd.read_csv(source, **csv_kwargs)
+
+    def read_changes(self, batch: Dict) -> Optional[pd.DataFrame]:
+        """
+        Changes file written with a batch, or None if its rows were all inserted.
+
+        Args:
+            batch: Manifest entry
+
+        Returns:
+            DataFrame with the columns of fingerprints.CHANGES_COLUMNS
+        """
+        if 'changes' in batch:
+            return pd.read_csv(io.BytesIO(read_slice(self.directory, batch['changes'])), dtype=str, keep_default_na=False)
+        if 'segment' not in batch:
+            path = os.path.join(self.directory, changes_name(batch['path']))
+            if os.path.exists(path):
+                return pd.read_csv(path, dtype=str, keep_default_na=False)
+        return None
+
+    def combine_changes(self, batches: List[Dict]) -> Optional[pd.DataFrame]:
+        """
+        Changes of several batches classified as one, with batch_row pointing into their concatenation.
+
+        Each batch's batch_row values are offset by the rows of the batches before it. A
+        batch changing or deleting a citation (hash_id and code) that an earlier one of
+        them holds cannot be combined: the earlier row is not in the published outputs
+        yet, so it would be appended as well as the later version.
+
+        Args:
+            batches: Manifest entries, in the order they are concatenated
+
+        Returns:
+            DataFrame with the columns of fingerprints.CHANGES_COLUMNS, or None if no batch has changes
+        """
+        combined = []
+        earlier = set()
+        offset = 0
+        for batch in batches:
+            changes = self.read_changes(batch)
+            if changes is not None:
+                overlap = set(zip(changes['hash_id'], changes['code'])) & earlier
+                if overlap:
+                    raise ValueError(f"{batch['path']} changes citations that an earlier pending batch holds, e.g. "
+                                     f"{sorted(overlap)[0]}; classify and append the batches one at a time with --input")
+                changes = changes.copy()
+                changed = changes['batch_row'] != ''
+                changes.loc[changed, 'batch_row'] = (changes.loc[changed, 'batch_row'].astype(int) + offset).astype(str)
+                combined.append(changes)
+            rows = self.read_batch(batch, usecols=['hash_id', 'code'], dtype=str, keep_default_na=False)
+            earlier |= set(zip(rows['hash_id'], rows['code']))
+            offset += len(rows)
+        return pd.concat(combined, ignore_index=True) if combined else None
+
+    def register(self, batch_path: str, rows: int, upstream_commit: Optional[str] = None):
+        """
+        Record a newly written batch.
+
+        Args:
+            batch_path: Path to the batch file, inside the manifest's directory
+            rows: Number of rows in the batch
+            upstream_commit: Upstream commit the batch was extracted from
+        """
+        name = os.path.basename(batch_path)
+        self.batches.append({
+            'path': name,
+            'timestamp': batch_timestamp(name),
+            'rows': rows,
+            'upstream_commit': upstream_commit,
+            'flagged': [],
+        })
+        self.batches.sort(key=lambda batch: batch['timestamp'])
+        self.save()
+
+    def latest(self) -> Dict:
+        """
+        Most recent batch.
+
+        Returns:
+            Manifest entry
+        """
+        if not self.batches:
+            raise FileNotFoundError(f"No batches recorded in {self.path}")
+        return self.batches[-1]
+
+    def pending(self, flag_names: List[str]) -> List[Dict]:
+        """
+        Batches not yet processed by every one of the given flags, oldest first.
+
+        Compacted batches are left out: they were processed by every flag registered
+        when they were compacted, and a flag added since runs over history with --input.
+
+        Args:
+            flag_names: Flags that should have processed each batch
+
+        Returns:
+            List of manifest entries
+        """
+        return [batch for batch in self.batches if not set(flag_names) <= set(batch['flagged']) and 'segment' not in batch]
+
+    def mark_flagged(self, batch_paths: List[str], flag_names: List[str]):
+        """
+        Record that the given flags have processed the given batches.
+
+        Args:
+            batch_paths: Batch file paths
+            flag_names: Flags that processed them
+        """
+        names = {os.path.basename(path) for path in batch_paths}
+        for batch in self.batches:
+            if batch['path'] in names:
+                batch['flagged'] = sorted(set(batch['flagged']) | set(flag_names))
+        self.save()
@@ -0,0 +1,82 @@
+import argparse
+import re
+import time
+
+import pandas as pd
+
+from flag_definitions import FLAG_DEFINITIONS
+from flagging_engine import RuleBasedClassifier, RuleMatcher
+
+UPSTREAM_CSV = '../aphis-inspection-reports/data/combined/inspections-citations.csv'
+
+
+def match_with_search_loop(rules, texts):
+    """
+    Reference matcher: one re.search per rule per text, as the flag scripts originally did.
+
+    Args:
+        rules: Dictionary of rule names to patterns
+        texts: Preprocessed texts
+
+    Returns:
+        List of matched rule names per text
+    """
+    return [[name for name, pattern in rules.items() if re.search(pattern, text)] for text in texts]
+
+
+def match_with_rule_matcher(rules, texts):
+    """
+    Match texts with the precompiled, literal-prefiltered RuleMatcher.
+
+    Args:
+        rules: Dictionary of rule names to patterns
+        texts: Preprocessed texts
+
+    Returns:
+        List of matched rule names per text
+    """
+    matcher = RuleMatcher(rules)
+    return [matcher.match(text) for text in texts]
+
+
+def time_call(function, *args):
+    """
+    Run function(*args) and measure its wall time.
+
+    Returns:
+        Tuple of the function's result and elapsed seconds
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the per-rule re.search loop with RuleMatcher.")
+    parser.add_argument('--input', default=UPSTREAM_CSV, help="CSV with a 'narrative' column (defaults to the full upstream corpus)")
+    args = parser.parse_args()
+
+    narratives = pd.read_csv(args.input, usecols=['narrative'])['narrative']
+    texts = [RuleBasedClassifier.preprocess_text(text) for text in narratives]
+    print(f"Narratives: {len(texts)}")
+    print()
+
+    total_loop = 0.0
+    total_matcher = 0.0
+    for flag_name, definition in FLAG_DEFINITIONS.items():
+        for kind in ('positive_rules', 'negative_rules'):
+            rules = definition[kind]
+            expected, loop_seconds = time_call(match_with_search_loop, rules, texts)
+            actual, matcher_seconds = time_call(match_with_rule_matcher, rules, texts)
+
+            if expected != actual:
+                raise AssertionError(f"RuleMatcher disagrees with re.search for {flag_name} {kind}")
+
+            total_loop += loop_seconds
+            total_matcher += matcher_seconds
+            print(f"{flag_name:<22} {kind:<15} search loop {loop_seconds:8.3f}s  RuleMatcher {matcher_seconds:8.3f}s")
+
+    print("----------------------------------------------------------------------------")
+    print(f"Total search loop: {total_loop:.3f}s")
+    print(f"Total RuleMatcher: {total_matcher:.3f}s")
+    print(f"Speedup: {total_loop / total_matcher:.1f}x")
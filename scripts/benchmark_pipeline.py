@@ -0,0 +1,217 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from append_new_rows import append_new_rows
+from extract_new_rows import extract_new_rows
+from fingerprints import RowKeyer, row_digests, save_index
+from flagging_engine import DEFAULT_CHUNKSIZE, ENGINES, classify_all_flags, classify_chunks_in_parallel
+from storage import read_table
+from synthetic_corpus import iter_synthetic_chunks, parse_rows
+
+
+def prepare_corpus(workdir: str, rows: int, new_rows: int, seed: int):
+    """
+    Write a synthetic upstream corpus, the published copy from before its last new_rows rows, and that copy's fingerprint index.
+
+    Args:
+        workdir: Directory to write into
+        rows: Rows in the upstream corpus
+        new_rows: Rows missing from the published copy, i.e. the size of the next batch
+        seed: Random seed
+    """
+    keyer = RowKeyer()
+    index = {}
+    published_rows = rows - new_rows
+    written = 0
+    for chunk in iter_synthetic_chunks(rows, seed):
+        mode = 'w' if written == 0 else 'a'
+        chunk.to_csv(os.path.join(workdir, 'upstream.csv'), index=False, header=written == 0, mode=mode)
+
+        published = chunk.iloc[:max(0, published_rows - written)]
+        published.to_csv(os.path.join(workdir, 'published.csv'), index=False, header=written == 0, mode=mode)
+        index.update(zip(keyer.keys(published), row_digests(published)))
+        written += len(chunk)
+
+    save_index(index, os.path.join(workdir, 'fingerprints.tsv'))
+
+
+def stage_extract(workdir: str, rows: int) -> int:
+    """
+    extract_new_rows.py against the published copy's fingerprint index.
+
+    Returns:
+        Rows read, i.e. the size of the upstream corpus
+    """
+    extract_new_rows(os.path.join(workdir, 'upstream.csv'), os.path.join(workdir, 'published.csv'),
+                     os.path.join(workdir, 'new_rows'), os.path.join(workdir, 'fingerprints.tsv'))
+    return rows
+
+
+def stage_flag_batch(workdir: str, engine: str) -> int:
+    """
+    Classify the new rows batch for every flag and write the initial_flagged files, as the daily run does.
+
+    Returns:
+        Rows classified
+    """
+    batch_dir = os.path.join(workdir, 'new_rows')
+    batch_path = os.path.join(batch_dir, next(name for name in os.listdir(batch_dir) if name.endswith('.csv')))
+    df = read_table(batch_path)
+    for flag_name, classified_df in classify_all_flags(df, engine=engine).items():
+        classified_df.to_csv(os.path.join(workdir, f'initial_flagged_{flag_name}.csv'), index=False)
+    return len(df)
+
+
+def stage_reflag(workdir: str, engine: str, workers: int, chunksize: int) -> int:
+    """
+    Stream the whole upstream corpus through every flag, as a full reflag with --stream does.
+
+    Returns:
+        Rows classified
+    """
+    chunks = pd.read_csv(os.path.join(workdir, 'upstream.csv'), chunksize=chunksize, dtype=str)
+    rows = 0
+    write_header = True
+    for classified in classify_chunks_in_parallel(chunks, engine=engine, workers=workers):
+        for flag_name, classified_df in classified.items():
+            classified_df.to_csv(os.path.join(workdir, f'reflagged_{flag_name}.csv'), index=False,
+                                 header=write_header, mode='w' if write_header else 'a')
+        rows += len(classified_df)
+        write_header = False
+    return rows
+
+
+def stage_append(workdir: str) -> int:
+    """
+    Append the new rows batch to the published copy in place.
+
+    Returns:
+        Rows appended
+    """
+    batch_dir = os.path.join(workdir, 'new_rows')
+    batch_path = os.path.join(batch_dir, next(name for name in os.listdir(batch_dir) if name.endswith('.csv')))
+    published_path = os.path.join(workdir, 'published.csv')
+    append_new_rows(published_path, batch_path, published_path)
+    return len(pd.read_csv(batch_path, usecols=['hash_id']))
+
+
+def measure(function, *args) -> dict:
+    """
+    Run a stage in the current process and measure it; called in a fresh process per stage.
+
+    Returns:
+        Dictionary with the stage's rows, seconds, rows per second and peak RSS in MB
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = function(*args)
+    seconds = time.perf_counter() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss_mb = peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'peak_rss_mb': round(peak_rss_mb, 1),
+    }
+
+
+def run_stage(function, *args) -> dict:
+    """
+    Measure a stage in its own spawned process, so peak RSS covers that stage alone.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(measure, (function, *args))
+
+
+def run_benchmark(rows: int, new_rows: int, seed: int, engines, workers: int, chunksize: int, workdir: str) -> dict:
+    """
+    Generate a corpus of the given size and time every pipeline stage on it.
+
+    Returns:
+        Dictionary of results for this corpus size
+    """
+    start = time.perf_counter()
+    prepare_corpus(workdir, rows, new_rows, seed)
+    print(f"Generated {rows} rows in {time.perf_counter() - start:.1f}s")
+
+    stages = {'extract_new_rows': run_stage(stage_extract, workdir, rows)}
+    for engine in engines:
+        stages[f'flag_batch_{engine}'] = run_stage(stage_flag_batch, workdir, engine)
+    for engine in engines:
+        stages[f'reflag_{engine}'] = run_stage(stage_reflag, workdir, engine, workers, chunksize)
+    stages['append_new_rows'] = run_stage(stage_append, workdir)
+
+    for name, result in stages.items():
+        print(f"{name:<24} {result['seconds']:9.3f}s {result['rows_per_second'] or 0:12.0f} rows/s {result['peak_rss_mb']:9.1f} MB peak RSS")
+    print()
+
+    return {'rows': rows, 'new_rows': new_rows, 'stages': stages}
+
+
+def compare(results: dict, previous_path: str):
+    """
+    Print each stage's time relative to a previous results file, for corpus sizes present in both.
+
+    Args:
+        results: Results of this run
+        previous_path: JSON written by an earlier run
+    """
+    with open(previous_path, encoding='utf-8') as f:
+        previous = {run['rows']: run['stages'] for run in json.load(f)['runs']}
+
+    print(f"Compared with {previous_path} (time ratio, above 1.0 is slower):")
+    for run in results['runs']:
+        for name, result in run['stages'].items():
+            before = previous.get(run['rows'], {}).get(name)
+            if before and before['seconds']:
+                print(f"{run['rows']:>10} {name:<24} {result['seconds'] / before['seconds']:6.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on seeded synthetic corpora.")
+    parser.add_argument('--rows', type=parse_rows, nargs='+', default=[10_000], help="Corpus sizes, e.g. 10k 1M 10M")
+    parser.add_argument('--new-rows', type=int, default=1000, help="Rows in the new rows batch extracted from each corpus")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=ENGINES, nargs='+', default=list(ENGINES))
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for the reflag stages")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help="Rows per chunk for the reflag stages")
+    parser.add_argument('--workdir', default=None, help="Directory for the generated files (a temporary directory by default)")
+    parser.add_argument('--output', default='benchmark_pipeline.json', help="JSON file to write the results to")
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'seed': args.seed,
+        'workers': args.workers,
+        'chunksize': args.chunksize,
+        'runs': [],
+    }
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            results['runs'].append(run_benchmark(rows, min(args.new_rows, rows), args.seed, args.engine,
+                                                 args.workers, args.chunksize, workdir))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
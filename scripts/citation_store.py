@@ -0,0 +1,372 @@
+"""
+Indexed SQLite store of flagged citations, for lookups without parsing the output CSVs.
+
+One table holds every citation with one column per flag (NULL until that flag has
+been run on the row). Rows are keyed like fingerprints.py keys them, on hash_id, code
+and occurrence, and indexed on code and on each flag column, so questions such as
+"air transport flagged citations for this hash_id" or "temperature flags by code"
+read a few index pages instead of a whole CSV.
+
+The store is fed incrementally: append_new_rows.py --store_path upserts each batch it
+appends, applying its changes file, and the flag scripts' --store option upserts the
+rows they classify. A row identical in every column to one already stored under the
+same hash_id and code is the same citation, so feeding a batch again, or feeding it
+once per flag output, only updates flag columns.
+"""
+import argparse
+import hashlib
+import sqlite3
+import sys
+from typing import Dict, Iterable, List, Optional, Set
+
+import pandas as pd
+
+from fingerprints import row_digests
+from flag_definitions import FLAG_DEFINITIONS
+
+DEFAULT_STORE_PATH = '../data/output/citations.sqlite'
+
+# Upstream inspections-citations columns, stored for every row
+CITATION_COLUMNS = ['hash_id', 'code', 'kind', 'repeat', 'desc', 'narrative']
+
+# SQLite's default limit on host parameters per statement is 999
+QUERY_BATCH = 900
+
+
+def quote(identifier: str) -> str:
+    """
+    Quote a column name for SQL; desc, for one, is a keyword.
+    """
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def flag_column(flag: str) -> str:
+    """
+    Flag column for a flag name or flag column name.
+
+    Args:
+        flag: Key of the flag in FLAG_DEFINITIONS, e.g. 'air_transport', or its column, e.g. 'air_transport_flag'
+
+    Returns:
+        Column name
+    """
+    if flag in FLAG_DEFINITIONS:
+        return FLAG_DEFINITIONS[flag]['flag_column']
+    columns = [definition['flag_column'] for definition in FLAG_DEFINITIONS.values()]
+    if flag not in columns:
+        raise ValueError(f"Unknown flag '{flag}'. Available flags: {list(FLAG_DEFINITIONS)}")
+    return flag
+
+
+class CitationStore:
+    def __init__(self, path: str = DEFAULT_STORE_PATH):
+        self.path = path
+        self.flag_columns = [definition['flag_column'] for definition in FLAG_DEFINITIONS.values()]
+
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            # The primary key index also serves lookups by hash_id alone
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS citations ('
+                ' hash_id TEXT NOT NULL, code TEXT NOT NULL, occurrence INTEGER NOT NULL,'
+                ' kind TEXT, repeat TEXT, "desc" TEXT, narrative TEXT, digest TEXT NOT NULL,'
+                ' PRIMARY KEY (hash_id, code, occurrence))'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS citations_code ON citations (code)')
+            # Changes files already applied, by digest, so that feeding one again does not delete rows twice
+            self.connection.execute('CREATE TABLE IF NOT EXISTS applied_changes (digest TEXT PRIMARY KEY)')
+
+            # Flags registered since the store was created get their column on first open
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(citations)')}
+            for column in self.flag_columns:
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE citations ADD COLUMN {quote(column)} INTEGER')
+                # (flag, code) covers both filtering on the flag and counting its rows by code
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS {quote("citations_" + column)} ON citations ({quote(column)}, code)'
+                )
+
+    def _load_groups(self, hash_ids: Iterable[str]) -> Dict[tuple, Dict[int, str]]:
+        """
+        Stored rows of some inspections, by (hash_id, code).
+
+        Args:
+            hash_ids: Inspections to load
+
+        Returns:
+            Dictionary mapping (hash_id, code) to a dictionary of occurrence to row digest
+        """
+        hash_ids = list(hash_ids)
+        groups = {}
+        for start in range(0, len(hash_ids), QUERY_BATCH):
+            batch = hash_ids[start:start + QUERY_BATCH]
+            placeholders = ','.join('?' * len(batch))
+            for hash_id, code, occurrence, digest in self.connection.execute(
+                    f'SELECT hash_id, code, occurrence, digest FROM citations WHERE hash_id IN ({placeholders})', batch):
+                groups.setdefault((hash_id, code), {})[occurrence] = digest
+        return groups
+
+    def _delete(self, hash_id: str, code: str, occurrence: int):
+        """
+        Delete a row and move later occurrences of its hash_id and code down by one, as a rewritten CSV would number them.
+        """
+        self.connection.execute('DELETE FROM citations WHERE hash_id = ? AND code = ? AND occurrence = ?',
+                                (hash_id, code, occurrence))
+        # Renumbered through negative values so no two rows share a key part way
+        self.connection.execute('UPDATE citations SET occurrence = -occurrence WHERE hash_id = ? AND code = ? AND occurrence > ?',
+                                (hash_id, code, occurrence))
+        self.connection.execute('UPDATE citations SET occurrence = -occurrence - 1 WHERE hash_id = ? AND code = ? AND occurrence < 0',
+                                (hash_id, code))
+
+    def _apply_changes(self, rows: pd.DataFrame, digests: List[str], flags: Dict[str, List[Optional[int]]],
+                       changes: pd.DataFrame, counts: Dict[str, int]) -> Set[int]:
+        """
+        Replace changed rows and delete deleted rows listed in a changes file, unless it was applied before.
+
+        Returns:
+            Positions of the rows that replaced a stored row
+        """
+        changes = changes.fillna('').astype(str)
+        changes_digest = hashlib.blake2b('\n'.join(row_digests(changes)).encode('utf-8'), digest_size=16).hexdigest()
+        if self.connection.execute('SELECT 1 FROM applied_changes WHERE digest = ?', (changes_digest,)).fetchone():
+            return set()
+
+        assignments = ', '.join(f'{quote(column)} = ?' for column in CITATION_COLUMNS[2:] + ['digest', *flags])
+        replaced = set()
+        for row in changes[changes['change'] == 'changed'].itertuples(index=False):
+            key = (row.hash_id, row.code, int(row.occurrence))
+            position = int(row.batch_row)
+            if not self.connection.execute('SELECT 1 FROM citations WHERE hash_id = ? AND code = ? AND occurrence = ?',
+                                           key).fetchone():
+                continue
+
+            # A copy with the new values stored by an earlier upsert of this batch, e.g. from a flag script, is this row
+            stray = self.connection.execute(
+                'SELECT MAX(occurrence) FROM citations WHERE hash_id = ? AND code = ? AND occurrence > ? AND digest = ?',
+                (*key, digests[position])
+            ).fetchone()[0]
+            if stray is not None:
+                # Keep the flags it was given that this upsert does not set
+                carried = ', '.join(quote(column) for column in self.flag_columns if column not in flags)
+                if carried:
+                    self.connection.execute(
+                        f'UPDATE citations SET ({carried}) = (SELECT {carried} FROM citations '
+                        f'WHERE hash_id = ? AND code = ? AND occurrence = ?) WHERE hash_id = ? AND code = ? AND occurrence = ?',
+                        (row.hash_id, row.code, stray, *key)
+                    )
+                self._delete(row.hash_id, row.code, stray)
+
+            flag_values = [values[position] for values in flags.values()]
+            self.connection.execute(
+                f'UPDATE citations SET {assignments} WHERE hash_id = ? AND code = ? AND occurrence = ?',
+                (*rows.iloc[position, 2:], digests[position], *flag_values, *key)
+            )
+            replaced.add(position)
+            counts['replaced'] += 1
+
+        # Keys refer to the rows before any deletion, so later occurrences go first
+        deleted = changes[changes['change'] == 'deleted']
+        for row in sorted(deleted.itertuples(index=False), key=lambda row: int(row.occurrence), reverse=True):
+            self._delete(row.hash_id, row.code, int(row.occurrence))
+            counts['deleted'] += 1
+
+        self.connection.execute('INSERT INTO applied_changes VALUES (?)', (changes_digest,))
+        return replaced
+
+    def upsert(self, df: pd.DataFrame, changes: Optional[pd.DataFrame] = None) -> Dict[str, int]:
+        """
+        Add rows to the store, or update the flag columns of rows already in it, in one transaction.
+
+        Args:
+            df: Rows with CITATION_COLUMNS and any flag columns, e.g. a new rows batch or a flag output
+            changes: Changes file written by extract_new_rows.py for this batch, if any
+
+        Returns:
+            Counts of rows inserted, updated, replaced and deleted
+        """
+        rows = df[CITATION_COLUMNS].fillna('').astype(str).reset_index(drop=True)
+        digests = row_digests(rows)
+        flags = {
+            column: [None if pd.isna(value) else int(value) for value in pd.to_numeric(df[column], errors='coerce')]
+            for column in self.flag_columns if column in df.columns
+        }
+        counts = {'inserted': 0, 'updated': 0, 'replaced': 0, 'deleted': 0}
+
+        with self.connection:
+            replaced = set()
+            if changes is not None and len(changes):
+                replaced = self._apply_changes(rows, digests, flags, changes, counts)
+
+            groups = self._load_groups(rows['hash_id'].unique())
+            claimed = set()
+            inserts = []
+            updates = []
+            for position, (hash_id, code) in enumerate(zip(rows['hash_id'], rows['code'])):
+                if position in replaced:
+                    continue
+                group = groups.setdefault((hash_id, code), {})
+                occurrence = next(
+                    (occurrence for occurrence, digest in sorted(group.items())
+                     if digest == digests[position] and (hash_id, code, occurrence) not in claimed),
+                    None,
+                )
+                flag_values = [values[position] for values in flags.values()]
+                if occurrence is None:
+                    occurrence = max(group, default=-1) + 1
+                    group[occurrence] = digests[position]
+                    inserts.append([hash_id, code, occurrence, *rows.iloc[position, 2:], digests[position], *flag_values])
+                else:
+                    updates.append([*flag_values, hash_id, code, occurrence])
+                claimed.add((hash_id, code, occurrence))
+
+            columns = ', '.join(quote(column) for column in
+                                ['hash_id', 'code', 'occurrence', *CITATION_COLUMNS[2:], 'digest', *flags])
+            self.connection.executemany(
+                f'INSERT INTO citations ({columns}) VALUES ({",".join("?" * (len(CITATION_COLUMNS) + 2 + len(flags)))})',
+                inserts,
+            )
+            if flags:
+                assignments = ', '.join(f'{quote(column)} = ?' for column in flags)
+                self.connection.executemany(
+                    f'UPDATE citations SET {assignments} WHERE hash_id = ? AND code = ? AND occurrence = ?', updates
+                )
+            counts['inserted'] = len(inserts)
+            counts['updated'] = len(updates)
+
+        return counts
+
+    def upsert_classified(self, classified: Dict[str, pd.DataFrame]) -> Dict[str, int]:
+        """
+        Upsert the rows classified by the flag scripts, with every flag's column at once.
+
+        Args:
+            classified: Dictionary mapping each flag name to its classified DataFrame
+
+        Returns:
+            Counts of rows inserted and updated
+        """
+        first_df = next(iter(classified.values()))
+        df = first_df[CITATION_COLUMNS].copy()
+        for flag_name, classified_df in classified.items():
+            column = FLAG_DEFINITIONS[flag_name]['flag_column']
+            df[column] = classified_df[column].to_numpy()
+        return self.upsert(df)
+
+    def query(self, hash_id: Optional[str] = None, code: Optional[str] = None, flags: Iterable[str] = (),
+              columns: Optional[List[str]] = None, limit: Optional[int] = None) -> pd.DataFrame:
+        """
+        Citations matching every given condition, in the order they were stored.
+
+        Args:
+            hash_id: Inspection to look up
+            code: Citation code, e.g. '3.125(a)'
+            flags: Flags (names or columns) the rows must be flagged for
+            columns: Columns to return (defaults to the citation and flag columns)
+            limit: Maximum number of rows
+
+        Returns:
+            DataFrame of matching citations
+        """
+        conditions = []
+        parameters = []
+        if hash_id is not None:
+            conditions.append('hash_id = ?')
+            parameters.append(hash_id)
+        if code is not None:
+            conditions.append('code = ?')
+            parameters.append(code)
+        for flag in flags:
+            conditions.append(f'{quote(flag_column(flag))} = 1')
+
+        columns = columns or CITATION_COLUMNS + self.flag_columns
+        sql = f'SELECT {", ".join(quote(column) for column in columns)} FROM citations'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY rowid'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return pd.read_sql_query(sql, self.connection, params=parameters)
+
+    def flag_counts(self, flag: str, by: str = 'code') -> pd.DataFrame:
+        """
+        Number of rows flagged for a flag, grouped by a citation column.
+
+        Args:
+            flag: Flag name or column
+            by: Citation column to group by, e.g. 'code' or 'kind'
+
+        Returns:
+            DataFrame with the group values and a flagged count, largest first
+        """
+        if by not in CITATION_COLUMNS:
+            raise ValueError(f"Cannot group by '{by}'. Available columns: {CITATION_COLUMNS}")
+        return pd.read_sql_query(
+            f'SELECT {quote(by)}, COUNT(*) AS flagged FROM citations WHERE {quote(flag_column(flag))} = 1 '
+            f'GROUP BY {quote(by)} ORDER BY flagged DESC, {quote(by)}',
+            self.connection,
+        )
+
+    def close(self):
+        """
+        Close the SQLite connection.
+        """
+        self.connection.close()
+
+
+def update_store(store_path: str, new_rows_file_path: str, changes_file_path: Optional[str] = None):
+    """
+    Upsert a new rows batch or flag output into the store, applying its changes file.
+
+    Args:
+        store_path: SQLite store to update (created if missing)
+        new_rows_file_path: CSV with the rows to add
+        changes_file_path: Changes file written by extract_new_rows.py, if any
+    """
+    df = pd.read_csv(new_rows_file_path, dtype=str, keep_default_na=False)
+    changes = pd.read_csv(changes_file_path, dtype=str, keep_default_na=False) if changes_file_path else None
+    store = CitationStore(store_path)
+    counts = store.upsert(df, changes)
+    store.close()
+    print(f"Updated {store_path} from {new_rows_file_path}: " + ', '.join(f"{count} {name}" for name, count in counts.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load flagged citations into an indexed SQLite store and query it.")
+    parser.add_argument('--store_path', default=DEFAULT_STORE_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    load_parser = subparsers.add_parser('load', help="Upsert citation CSVs, e.g. the published outputs, into the store")
+    load_parser.add_argument('file_paths', nargs='+', help="CSVs with the citation columns and any flag columns")
+    load_parser.add_argument('--changes_file_path', default=None, help="Changes file from extract_new_rows.py to apply")
+
+    query_parser = subparsers.add_parser('query', help="Print or export the citations matching every given condition")
+    query_parser.add_argument('--hash_id', default=None)
+    query_parser.add_argument('--code', default=None)
+    query_parser.add_argument('--flag', nargs='+', default=[], help="Only rows flagged for these flags, e.g. air_transport")
+    query_parser.add_argument('--columns', nargs='+', default=None)
+    query_parser.add_argument('--limit', type=int, default=None)
+    query_parser.add_argument('--csv_path', default=None, help="Write the rows to this CSV instead of printing them")
+
+    counts_parser = subparsers.add_parser('counts', help="Count a flag's flagged rows by code or another column")
+    counts_parser.add_argument('--flag', required=True)
+    counts_parser.add_argument('--by', default='code')
+
+    args = parser.parse_args()
+    if args.command == 'load':
+        for file_path in args.file_paths:
+            update_store(args.store_path, file_path, args.changes_file_path)
+    else:
+        store = CitationStore(args.store_path)
+        if args.command == 'query':
+            result = store.query(args.hash_id, args.code, args.flag, args.columns, args.limit)
+        else:
+            result = store.flag_counts(args.flag, args.by)
+        store.close()
+
+        if args.command == 'query' and args.csv_path:
+            result.to_csv(args.csv_path, index=False)
+            print(f"Exported {len(result)} rows to {args.csv_path}")
+        else:
+            result.to_csv(sys.stdout, index=False)
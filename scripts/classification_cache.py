@@ -0,0 +1,144 @@
+"""
+Persistent cache of classification results, keyed by narrative and ruleset.
+
+Many citations repeat the same narrative (boilerplate such as "a responsible adult was
+not available to accompany aphis officials", or one text cited under several codes),
+so the rules matched for a preprocessed narrative are stored in a SQLite file and
+reused on later runs. Entries are kept per flag together with a version hash of that
+flag's rules: editing one flag's rules invalidates only that flag's entries. The
+cache holds at most max_entries results and evicts the least recently used ones.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from flag_definitions import FLAG_DEFINITIONS
+
+DEFAULT_CACHE_PATH = '../data/flagging_process/classification_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 1_000_000
+
+# SQLite's default limit on host parameters per statement is 999
+QUERY_BATCH = 900
+
+# Matched (positive, negative) rule names
+CachedRules = Tuple[List[str], List[str]]
+
+
+def ruleset_version(flag_name: str) -> str:
+    """
+    Hash of a flag's positive and negative rules, in rule order.
+
+    Args:
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+
+    Returns:
+        16-character hex digest
+    """
+    definition = FLAG_DEFINITIONS[flag_name]
+    rules = [list(definition['positive_rules'].items()), list(definition['negative_rules'].items())]
+    return hashlib.blake2b(json.dumps(rules).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def text_digest(text: str) -> str:
+    """
+    Digest of a preprocessed narrative.
+
+    Args:
+        text: Preprocessed text
+
+    Returns:
+        32-character hex digest
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ClassificationCache:
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, flag_names: Optional[List[str]] = None,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        if flag_names is None:
+            flag_names = list(FLAG_DEFINITIONS)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.versions = {name: ruleset_version(name) for name in flag_names}
+
+        # Pool workers share the file; WAL lets them read while one of them writes
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' flag TEXT NOT NULL, digest TEXT NOT NULL, version TEXT NOT NULL,'
+                ' matched_positive TEXT NOT NULL, matched_negative TEXT NOT NULL, last_used INTEGER NOT NULL,'
+                ' PRIMARY KEY (flag, digest)) WITHOUT ROWID'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            # Results computed with a flag's previous rules can never be hit again
+            self.connection.executemany(
+                'DELETE FROM results WHERE flag = ? AND version != ?', self.versions.items()
+            )
+
+    def get(self, digests: Iterable[str]) -> Dict[str, Dict[str, CachedRules]]:
+        """
+        Look up cached results for narratives, marking the hits as recently used.
+
+        Args:
+            digests: Digests of preprocessed narratives
+
+        Returns:
+            Dictionary mapping each flag name to a dictionary of digest to matched rules
+        """
+        digests = list(digests)
+        now = time.time_ns()
+        found = {name: {} for name in self.versions}
+
+        with self.connection:
+            for name, version in self.versions.items():
+                for start in range(0, len(digests), QUERY_BATCH):
+                    batch = digests[start:start + QUERY_BATCH]
+                    placeholders = ','.join('?' * len(batch))
+                    rows = self.connection.execute(
+                        f'SELECT digest, matched_positive, matched_negative FROM results '
+                        f'WHERE flag = ? AND version = ? AND digest IN ({placeholders})',
+                        [name, version, *batch],
+                    ).fetchall()
+                    for digest, matched_positive, matched_negative in rows:
+                        found[name][digest] = (json.loads(matched_positive), json.loads(matched_negative))
+                    self.connection.executemany(
+                        'UPDATE results SET last_used = ? WHERE flag = ? AND digest = ?',
+                        [(now, name, digest) for digest, _, _ in rows],
+                    )
+        return found
+
+    def put(self, results: Dict[str, Dict[str, CachedRules]]):
+        """
+        Store newly computed results, then evict the least recently used entries over max_entries.
+
+        Args:
+            results: Dictionary mapping each flag name to a dictionary of digest to matched rules
+        """
+        now = time.time_ns()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (name, digest, self.versions[name], json.dumps(matched_positive), json.dumps(matched_negative), now)
+                    for name, flag_results in results.items()
+                    for digest, (matched_positive, matched_negative) in flag_results.items()
+                ],
+            )
+            excess = self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM results WHERE (flag, digest) IN '
+                    '(SELECT flag, digest FROM results ORDER BY last_used LIMIT ?)',
+                    (excess,),
+                )
+
+    def close(self):
+        """
+        Close the SQLite connection.
+        """
+        self.connection.close()
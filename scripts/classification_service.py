@@ -0,0 +1,489 @@
+"""
+Classify narratives on demand, as a library call or through a local HTTP service.
+
+classify_many(texts) applies every registered flag's rules to a list of narratives
+and returns two arrays with one row per narrative and one column per flag: the flags
+and the rule_hits bitmasks, packed as in compact_results.py (positive rule bits above
+negative rule bits, INVALID_INPUT for empty narratives). The rules are compiled on
+the first call and kept for the next ones.
+
+    from classification_service import classify_many
+    result = classify_many(["The animals were shipped by air in extreme heat."])
+    result['flag_names'], result['flags'], result['rule_hits']
+
+`serve` keeps the rules warm in a local HTTP service. Concurrent requests are queued
+and coalesced into micro-batches: a batch is classified once it holds --max_batch
+narratives or --max_wait_ms has passed since its first request, so single
+narratives do not each pay for a classification call. p50 and p99 request latency
+are reported at /stats and printed every --report_interval seconds.
+
+    python classification_service.py serve [--port 8765] [--max_batch 1024] [--max_wait_ms 2]
+    curl -s localhost:8765/classify -d '{"narratives": ["..."]}'
+    python classification_service.py bench [--concurrency 64] [--requests 5000] [--batch 1]
+
+POST /classify takes {"narratives": [...]} and returns flag_names, flags and
+rule_hits (one list per narrative); GET /rules returns the rule tables that decode
+rule_hits, and GET /stats the latency percentiles. There is no narrative budget, as
+it relies on signals in the main thread.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from compact_results import INVALID_INPUT, rule_table
+from flag_definitions import FLAG_DEFINITIONS
+from flagging_engine import MultiFlagClassifier, RuleBasedClassifier, literal_presence, required_literals, rule_mask
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH = 1024
+DEFAULT_MAX_WAIT_MS = 2.0
+
+# From this many distinct narratives, the rules are evaluated column by column (as the vectorized engine does)
+COLUMNAR_MIN_BATCH = 1024
+
+# Requests kept for the latency percentiles
+LATENCY_WINDOW = 10000
+
+
+class BatchClassifier:
+    """
+    Every flag's rules, compiled once, applied to lists of narratives.
+    """
+
+    def __init__(self, flag_names: Optional[List[str]] = None):
+        self.classifier = MultiFlagClassifier(flag_names)
+        self.flag_names = list(self.classifier.classifiers)
+        self.tables = {name: rule_table(name) for name in self.flag_names}
+
+        # rule_hits bit of each matched rule, per flag
+        self.positive_bits = {}
+        self.negative_bits = {}
+        for name, classifier in self.classifier.classifiers.items():
+            negative_count = len(classifier.negative_rules)
+            self.positive_bits[name] = {rule: 1 << (negative_count + bit) for bit, rule in enumerate(classifier.positive_rules)}
+            self.negative_bits[name] = {rule: 1 << bit for bit, rule in enumerate(classifier.negative_rules)}
+
+        self.literals = set()
+        for classifier in self.classifier.classifiers.values():
+            for pattern in {**classifier.positive_rules, **classifier.negative_rules}.values():
+                self.literals |= required_literals(pattern) or set()
+
+    def classify_many(self, texts: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        Classify narratives for every flag.
+
+        Args:
+            texts: Raw narratives; non-strings count as empty
+
+        Returns:
+            Dictionary with flag_names and two arrays of shape (len(texts), len(flag_names)):
+            flags (int8) and rule_hits (int64)
+        """
+        # Repeated narratives are evaluated once
+        positions = {}
+        rows = np.array([positions.setdefault(RuleBasedClassifier.preprocess_text(text), len(positions)) for text in texts],
+                        dtype=np.intp)
+        distinct = list(positions)
+        if len(distinct) >= COLUMNAR_MIN_BATCH:
+            flags, rule_hits = self.classify_columns(pd.Series(distinct, dtype=object))
+        else:
+            flags, rule_hits = self.classify_rows(distinct)
+        return {'flag_names': self.flag_names, 'flags': flags[rows], 'rule_hits': rule_hits[rows]}
+
+    def classify_rows(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Flags and rule_hits of preprocessed narratives, one narrative at a time.
+        """
+        flags = np.zeros((len(texts), len(self.flag_names)), dtype=np.int8)
+        rule_hits = np.full((len(texts), len(self.flag_names)), INVALID_INPUT, dtype=np.int64)
+
+        for row, text in enumerate(texts):
+            if not text:
+                continue
+            results = self.classifier.apply_rules_preprocessed(text)
+            for column, name in enumerate(self.flag_names):
+                result = results[name]
+                flags[row, column] = result['classification']
+                rule_hits[row, column] = (sum(self.positive_bits[name][rule] for rule in result['matched_positive'])
+                                          | sum(self.negative_bits[name][rule] for rule in result['matched_negative']))
+        return flags, rule_hits
+
+    def classify_columns(self, texts: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Flags and rule_hits of preprocessed narratives, evaluating each rule over all of them with rule_mask.
+        """
+        has_text = (texts != "").to_numpy()
+        presence = literal_presence(texts, self.literals)
+
+        flags = np.zeros((len(texts), len(self.flag_names)), dtype=np.int8)
+        rule_hits = np.zeros((len(texts), len(self.flag_names)), dtype=np.int64)
+        for column, (name, classifier) in enumerate(self.classifier.classifiers.items()):
+            positive_mask = rule_mask(texts, classifier.positive_rules, has_text, presence)
+            negative_mask = rule_mask(texts, classifier.negative_rules, positive_mask != 0, presence)
+            flags[:, column] = (positive_mask != 0) & (negative_mask == 0)
+            rule_hits[:, column] = np.where(has_text, positive_mask << len(classifier.negative_rules) | negative_mask,
+                                            INVALID_INPUT)
+        return flags, rule_hits
+
+
+# Classifiers already built, by their flags
+_warm_classifiers = {}
+
+
+def get_classifier(flag_names: Optional[List[str]] = None) -> BatchClassifier:
+    """
+    Classifier for the given flags (every registered flag by default), built on first use and kept.
+    """
+    key = tuple(flag_names or FLAG_DEFINITIONS)
+    if key not in _warm_classifiers:
+        _warm_classifiers[key] = BatchClassifier(list(key))
+    return _warm_classifiers[key]
+
+
+def classify_many(texts: Sequence[str], flag_names: Optional[List[str]] = None) -> Dict[str, np.ndarray]:
+    """
+    Classify narratives for every registered flag, with rules compiled once per process.
+
+    Args:
+        texts: Raw narratives
+        flag_names: Flags to evaluate (defaults to every registered flag)
+
+    Returns:
+        Dictionary with flag_names and the flags and rule_hits arrays, one row per narrative
+        and one column per flag
+    """
+    return get_classifier(flag_names).classify_many(texts)
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent classification requests into batches.
+
+    Requests wait on an asyncio queue; the batch loop takes the first one, gathers
+    more until max_batch narratives or max_wait seconds, and classifies them in one
+    call on a worker thread, so the event loop keeps reading requests meanwhile.
+    """
+
+    def __init__(self, classifier: BatchClassifier, max_batch: int = DEFAULT_MAX_BATCH,
+                 max_wait: float = DEFAULT_MAX_WAIT_MS / 1000):
+        self.classifier = classifier
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.narratives = 0
+
+    async def classify(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Classify one request's narratives as part of the next batch.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future))
+        return await future
+
+    async def gather(self) -> List[Tuple[List[str], asyncio.Future]]:
+        """
+        Wait for a request, then take others until the batch is full or the window has passed.
+        """
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        count = len(pending[0][0])
+        deadline = loop.time() + self.max_wait
+        while count < self.max_batch:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            pending.append(item)
+            count += len(item[0])
+        return pending
+
+    async def run(self):
+        """
+        Classify batches until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self.gather()
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            try:
+                result = await loop.run_in_executor(self.executor, self.classifier.classify_many, texts)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.narratives += len(texts)
+            start = 0
+            for request_texts, future in pending:
+                end = start + len(request_texts)
+                if not future.done():
+                    future.set_result({'flag_names': result['flag_names'], 'flags': result['flags'][start:end],
+                                       'rule_hits': result['rule_hits'][start:end]})
+                start = end
+
+
+def latency_percentiles(latencies: Sequence[float]) -> Dict[str, Optional[float]]:
+    """
+    p50 and p99 of latencies in seconds, in milliseconds.
+    """
+    if not latencies:
+        return {'p50_ms': None, 'p99_ms': None}
+    p50, p99 = np.percentile(np.fromiter(latencies, dtype=float), [50, 99])
+    return {'p50_ms': round(p50 * 1000, 3), 'p99_ms': round(p99 * 1000, 3)}
+
+
+class ClassificationService:
+    """
+    Minimal HTTP/1.1 server, with keep-alive, in front of a MicroBatcher.
+    """
+
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.started = time.time()
+
+    def stats(self) -> Dict:
+        """
+        Request, batch and latency counters since the service started.
+        """
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'requests': self.requests,
+            'narratives': self.batcher.narratives,
+            'batches': self.batcher.batches,
+            'mean_batch_size': round(self.batcher.narratives / self.batcher.batches, 1) if self.batcher.batches else None,
+            'latency_window': len(self.latencies),
+            **latency_percentiles(self.latencies),
+        }
+
+    async def respond(self, method: str, path: str, body: bytes) -> Tuple[str, Dict]:
+        """
+        Status line and JSON payload for a request.
+        """
+        if path == '/classify' and method == 'POST':
+            try:
+                narratives = json.loads(body)['narratives']
+            except (ValueError, KeyError, TypeError):
+                return '400 Bad Request', {'error': 'Expected a JSON object with a "narratives" list'}
+            if not isinstance(narratives, list):
+                return '400 Bad Request', {'error': '"narratives" must be a list'}
+            result = await self.batcher.classify(narratives)
+            return '200 OK', {'flag_names': result['flag_names'], 'flags': result['flags'].tolist(),
+                              'rule_hits': result['rule_hits'].tolist()}
+        if path == '/rules' and method == 'GET':
+            return '200 OK', self.batcher.classifier.tables
+        if path == '/stats' and method == 'GET':
+            return '200 OK', self.stats()
+        return '404 Not Found', {'error': f'No {method} {path}'}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve the requests of one connection until it closes.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start = time.perf_counter()
+                try:
+                    status, payload = await self.respond(method, path, body)
+                except Exception as e:
+                    status, payload = '500 Internal Server Error', {'error': str(e)}
+                data = json.dumps(payload).encode('utf-8')
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                connection = '' if keep_alive else 'Connection: close\r\n'
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                             f"{connection}\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if path == '/classify':
+                    self.requests += 1
+                    self.latencies.append(time.perf_counter() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def report(self, interval: float):
+        """
+        Print the stats every interval seconds while requests come in.
+        """
+        last_requests = 0
+        while True:
+            await asyncio.sleep(interval)
+            if self.requests != last_requests:
+                stats = self.stats()
+                print(f"{stats['requests']} requests, {stats['narratives']} narratives, mean batch {stats['mean_batch_size']}, "
+                      f"p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms", flush=True)
+                last_requests = self.requests
+
+
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, max_batch: int = DEFAULT_MAX_BATCH,
+                max_wait_ms: float = DEFAULT_MAX_WAIT_MS, report_interval: float = 60.0,
+                flag_names: Optional[List[str]] = None):
+    """
+    Run the classification service until interrupted.
+
+    Args:
+        host: Address to listen on
+        port: Port to listen on
+        max_batch: Narratives at which a batch is classified without waiting further
+        max_wait_ms: Longest a batch waits for more requests after its first one
+        report_interval: Seconds between printed stats
+        flag_names: Flags to evaluate (defaults to every registered flag)
+    """
+    classifier = get_classifier(flag_names)
+    # Compile the rules' regexes before the first request instead of during it
+    classifier.classify_many(["warm up"])
+
+    service = ClassificationService(MicroBatcher(classifier, max_batch, max_wait_ms / 1000))
+    server = await asyncio.start_server(service.handle, host, port)
+    tasks = [asyncio.create_task(service.batcher.run()), asyncio.create_task(service.report(report_interval))]
+    print(f"Classifying {', '.join(classifier.flag_names)} on http://{host}:{port} "
+          f"(batches of up to {max_batch} narratives, {max_wait_ms} ms window)", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        stats = service.stats()
+        print(f"Served {stats['requests']} requests: p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms")
+
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, method: str, path: str,
+                  payload: Optional[Dict] = None) -> Dict:
+    """
+    Send one request over a keep-alive connection and read its JSON response.
+    """
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    status = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    data = json.loads(await reader.readexactly(length))
+    if not status.split()[1].startswith(b'2'):
+        raise RuntimeError(f"{method} {path}: {status.decode('latin-1').strip()} {data}")
+    return data
+
+
+async def bench(narratives: List[str], host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, concurrency: int = 64,
+                requests: int = 5000, batch: int = 1) -> Dict:
+    """
+    Send requests to a running service from concurrent keep-alive connections and time them.
+
+    Args:
+        narratives: Narratives to cycle through
+        host: Service address
+        port: Service port
+        concurrency: Connections sending requests at the same time
+        requests: Requests to send in total
+        batch: Narratives per request
+
+    Returns:
+        Dictionary with narratives per second, client-side latency percentiles and the service's stats
+    """
+    latencies = []
+    counter = iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in counter:
+                start = (i * batch) % len(narratives)
+                texts = (narratives[start:] + narratives)[:batch]
+                sent = time.perf_counter()
+                await request(reader, writer, host, 'POST', '/classify', {'narratives': texts})
+                latencies.append(time.perf_counter() - sent)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        server_stats = await request(reader, writer, host, 'GET', '/stats')
+    finally:
+        writer.close()
+    return {
+        'requests': requests,
+        'narratives_per_second': round(requests * batch / seconds),
+        **latency_percentiles(latencies),
+        'server': server_stats,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify narratives for every flag through a local HTTP service.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="Run the service, with the rules compiled once")
+    serve_parser.add_argument('--max_batch', type=int, default=DEFAULT_MAX_BATCH, help="Narratives per micro-batch at most")
+    serve_parser.add_argument('--max_wait_ms', type=float, default=DEFAULT_MAX_WAIT_MS,
+                              help="How long a micro-batch waits for more requests after its first")
+    serve_parser.add_argument('--report_interval', type=float, default=60.0, help="Seconds between printed latency stats")
+    serve_parser.add_argument('--flags', nargs='+', choices=list(FLAG_DEFINITIONS), default=None,
+                              help="Flags to evaluate (default: every registered flag)")
+
+    bench_parser = subparsers.add_parser('bench', help="Load a running service and report throughput and p50/p99 latency")
+    bench_parser.add_argument('--input', required=True, help="CSV with a narrative column to send")
+    bench_parser.add_argument('--concurrency', type=int, default=64, help="Concurrent connections")
+    bench_parser.add_argument('--requests', type=int, default=5000, help="Requests to send")
+    bench_parser.add_argument('--batch', type=int, default=1, help="Narratives per request")
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        try:
+            asyncio.run(serve(args.host, args.port, args.max_batch, args.max_wait_ms, args.report_interval, args.flags))
+        except KeyboardInterrupt:
+            pass
+    else:
+        narratives = pd.read_csv(args.input, usecols=['narrative'], dtype=str, keep_default_na=False)['narrative'].tolist()
+        print(json.dumps(asyncio.run(bench(narratives, args.host, args.port, args.concurrency, args.requests, args.batch)),
+                         indent=1))
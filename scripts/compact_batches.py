@@ -0,0 +1,309 @@
+"""
+Compaction and retention for the new rows batch directory.
+
+extract_new_rows.py writes one small CSV per run, so the batch directory, and every
+checkout of it, gains a file a day. Once every flag has processed them, the batches of
+a finished month are merged into one segment for the month under new_rows/segments/:
+their rows are appended as they are, after a single header line, and each batch's
+manifest entry records the offset and size of its rows in the segment, so
+BatchManifest.read_batch still returns any batch and `show` writes it back out.
+Changes files are merged the same way into one changes segment per month. Each
+segment has an offset index next to it (*.index.csv) listing its batches, from which
+the manifest can be rebuilt.
+
+The latest batch is never compacted, as the flag scripts read it from its file. With
+--keep_months, compacted months older than that are deleted along with their entries.
+
+    python compact_batches.py compact [--before 2026-07] [--keep_months 24]
+    python compact_batches.py show inspections_citations_new_rows_20250113_112857.csv --output_path batch.csv
+"""
+import argparse
+import os
+from datetime import datetime, timezone
+from itertools import groupby
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from append_new_rows import build_segment, fsync_directory, read_header
+from batch_manifest import (CHANGES_PREFIX, NEW_ROWS_DIR, NEW_ROWS_PREFIX, SEGMENT_INDEX_SUFFIX, SEGMENTS_DIR,
+                            BatchManifest, changes_name, read_slice)
+from flag_definitions import FLAG_DEFINITIONS
+
+INDEX_COLUMNS = ['path', 'rows', 'upstream_commit', 'segment', 'offset', 'size',
+                 'changes_segment', 'changes_offset', 'changes_size']
+
+
+def batch_month(batch: Dict) -> str:
+    """
+    Month of a batch, such as '2025-01'.
+    """
+    return batch['timestamp'][:7]
+
+
+def month_number(month: str) -> int:
+    """
+    Months since year 0 of a 'YYYY-MM' month, for month arithmetic.
+    """
+    year, month = month.split('-')
+    return int(year) * 12 + int(month) - 1
+
+
+def segment_end(manifest: BatchManifest, segment_path: str, key: str) -> int:
+    """
+    Size a segment should have according to the manifest, 0 if no entry points into it.
+
+    Args:
+        manifest: Batch manifest
+        segment_path: Segment path relative to the batch directory
+        key: 'segment' for new rows segments, 'changes' for changes segments
+
+    Returns:
+        End of the last rows recorded in the segment
+    """
+    return max((batch[key]['offset'] + batch[key]['size'] for batch in manifest.batches
+                if key in batch and batch[key]['path'] == segment_path), default=0)
+
+
+def open_segment(directory: str, segment_path: str, expected_size: int, first_file: str) -> List[str]:
+    """
+    Get a segment ready for appending and return its columns.
+
+    Bytes past what the manifest records, left by an interrupted compaction, are
+    truncated; a segment without recorded rows is started with first_file's header line.
+
+    Args:
+        directory: Batch directory
+        segment_path: Segment path relative to directory
+        expected_size: Size recorded in the manifest, from segment_end
+        first_file: File whose header starts a new segment
+
+    Returns:
+        Column names of the segment
+    """
+    path = os.path.join(directory, segment_path)
+    if expected_size == 0:
+        with open(first_file, 'rb') as source, open(path, 'wb') as f:
+            f.write(source.readline())
+    else:
+        actual_size = os.path.getsize(path)
+        if actual_size < expected_size:
+            raise RuntimeError(f"{path} is shorter ({actual_size} bytes) than its manifest entries say ({expected_size} bytes)")
+        if actual_size > expected_size:
+            print(f"Truncating {path} to {expected_size} bytes, dropping an interrupted compaction")
+            with open(path, 'r+b') as f:
+                f.truncate(expected_size)
+    return read_header(path)
+
+
+def segment_rows(file_path: str, header: List[str]) -> Optional[bytes]:
+    """
+    Rows of a batch or changes file as they are appended to a segment with the given columns.
+
+    Returns:
+        CSV rows without a header, or None if the file's columns differ from the segment's
+    """
+    try:
+        return build_segment(file_path, header)
+    except ValueError as e:
+        print(f"Leaving {file_path} uncompacted: {e}")
+        return None
+
+
+def append_to_segment(directory: str, segment_path: str, rows: bytes) -> Dict:
+    """
+    Append rows to a segment and fsync it.
+
+    Args:
+        directory: Batch directory
+        segment_path: Segment path relative to directory
+        rows: Rows from segment_rows
+
+    Returns:
+        Location of the rows in the segment
+    """
+    with open(os.path.join(directory, segment_path), 'ab') as f:
+        offset = f.tell()
+        f.write(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    return {'path': segment_path, 'offset': offset, 'size': len(rows)}
+
+
+def write_segment_index(manifest: BatchManifest, segment_path: str):
+    """
+    Write the offset index of a segment's batches next to it.
+
+    Args:
+        manifest: Batch manifest, with the segment's entries
+        segment_path: Segment path relative to the batch directory
+    """
+    rows = []
+    for batch in manifest.batches:
+        if batch.get('segment', {}).get('path') != segment_path:
+            continue
+        changes = batch.get('changes', {})
+        rows.append([batch['path'], batch['rows'], batch['upstream_commit'], segment_path, batch['segment']['offset'],
+                     batch['segment']['size'], changes.get('path'), changes.get('offset'), changes.get('size')])
+
+    index_path = os.path.join(manifest.directory, segment_path[:-len('.csv')] + SEGMENT_INDEX_SUFFIX)
+    index = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    index['changes_offset'] = index['changes_offset'].astype('Int64')
+    index['changes_size'] = index['changes_size'].astype('Int64')
+    index.to_csv(index_path + '.tmp', index=False)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def remove_files(paths: List[str]):
+    """
+    Delete the files that exist among paths and flush their directories.
+    """
+    removed = [path for path in paths if os.path.exists(path)]
+    for path in removed:
+        os.remove(path)
+    for directory in {os.path.dirname(path) for path in removed}:
+        fsync_directory(directory)
+
+
+def compact_batches(directory: str = NEW_ROWS_DIR, before: Optional[str] = None,
+                    keep_months: Optional[int] = None) -> Dict[str, int]:
+    """
+    Merge the processed batches of finished months into monthly segments, then apply retention.
+
+    Segments are appended and fsynced before the manifest records them, and batch files
+    are deleted only once it has, so an interrupted run leaves every batch readable and
+    the next run picks up where it stopped.
+
+    Args:
+        directory: Batch directory, with its manifest
+        before: First month not to compact, as 'YYYY-MM' (defaults to the current month, UTC)
+        keep_months: Compacted months to keep before `before`; older ones are deleted (all are kept if None)
+
+    Returns:
+        Dictionary with the numbers of batches compacted and of months deleted
+    """
+    manifest = BatchManifest(directory)
+    if before is None:
+        before = datetime.now(timezone.utc).strftime('%Y-%m')
+
+    latest = manifest.latest() if manifest.batches else None
+    candidates = [
+        batch for batch in manifest.batches
+        if 'segment' not in batch and batch is not latest and batch_month(batch) < before
+        and set(FLAG_DEFINITIONS) <= set(batch['flagged'])
+    ]
+
+    compacted = []
+    if candidates:
+        os.makedirs(os.path.join(directory, SEGMENTS_DIR), exist_ok=True)
+    for month, batches in groupby(candidates, key=batch_month):
+        batches = [batch for batch in batches if os.path.exists(manifest.full_path(batch))]
+        if not batches:
+            continue
+        segment_path = os.path.join(SEGMENTS_DIR, f'{NEW_ROWS_PREFIX}{month}.csv')
+        changes_path = os.path.join(SEGMENTS_DIR, f'{CHANGES_PREFIX}{month}.csv')
+        header = open_segment(directory, segment_path, segment_end(manifest, segment_path, 'segment'),
+                              manifest.full_path(batches[0]))
+        changes_header = None
+
+        for batch in batches:
+            rows = segment_rows(manifest.full_path(batch), header)
+            changes_file = os.path.join(directory, changes_name(batch['path']))
+            changes_rows = None
+            if os.path.exists(changes_file):
+                if changes_header is None:
+                    changes_header = open_segment(directory, changes_path, segment_end(manifest, changes_path, 'changes'),
+                                                  changes_file)
+                changes_rows = segment_rows(changes_file, changes_header)
+                if changes_rows is None:
+                    continue
+            if rows is None:
+                continue
+
+            batch['segment'] = append_to_segment(directory, segment_path, rows)
+            if changes_rows is not None:
+                batch['changes'] = append_to_segment(directory, changes_path, changes_rows)
+            compacted.append(batch)
+
+        write_segment_index(manifest, segment_path)
+        print(f"Compacted {sum(batch_month(batch) == month for batch in compacted)} batch(es) into {segment_path}")
+
+    deleted_months = set()
+    if keep_months is not None:
+        oldest_kept = month_number(before) - keep_months
+        deleted_months = {batch_month(batch) for batch in manifest.batches
+                          if 'segment' in batch and month_number(batch_month(batch)) < oldest_kept}
+        manifest.batches = [batch for batch in manifest.batches
+                            if 'segment' not in batch or batch_month(batch) not in deleted_months]
+        for month in sorted(deleted_months):
+            print(f"Deleting the {month} segments, older than {keep_months} month(s) before {before}")
+
+    manifest.save()
+
+    # Only now that the manifest points into the segments do the original files go,
+    # along with any left behind by an interrupted run
+    remove_files([
+        os.path.join(directory, name)
+        for batch in manifest.batches if 'segment' in batch
+        for name in (batch['path'], changes_name(batch['path']))
+    ])
+    if deleted_months:
+        remove_files([
+            os.path.join(directory, SEGMENTS_DIR, name)
+            for month in deleted_months
+            for name in (f'{NEW_ROWS_PREFIX}{month}.csv', f'{NEW_ROWS_PREFIX}{month}{SEGMENT_INDEX_SUFFIX}',
+                         f'{CHANGES_PREFIX}{month}.csv')
+        ])
+
+    return {'compacted': len(compacted), 'deleted_months': len(deleted_months)}
+
+
+def show_batch(batch_name: str, output_path: str, directory: str = NEW_ROWS_DIR):
+    """
+    Write a batch's rows back out as a CSV, from its file or its segment.
+
+    When the batch had the segment's columns, the output is identical to the original file.
+
+    Args:
+        batch_name: Batch file name, as listed in the manifest
+        output_path: CSV file to write
+        directory: Batch directory
+    """
+    manifest = BatchManifest(directory)
+    batch = next((batch for batch in manifest.batches if batch['path'] == batch_name), None)
+    if batch is None:
+        raise ValueError(f"No batch {batch_name} in {manifest.path}")
+
+    if 'segment' in batch:
+        with open(output_path, 'wb') as f:
+            f.write(read_slice(directory, batch['segment']))
+        location = batch['segment']
+        print(f"{batch_name}: {batch['rows']} rows at bytes {location['offset']}-{location['offset'] + location['size']} "
+              f"of {location['path']}")
+    else:
+        with open(manifest.full_path(batch), 'rb') as source, open(output_path, 'wb') as f:
+            f.write(source.read())
+        print(f"{batch_name}: {batch['rows']} rows, not compacted")
+    print(f"Saved to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact processed new rows batches into monthly segments.")
+    parser.add_argument('--new_rows_dir', default=NEW_ROWS_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = subparsers.add_parser('compact', help="Merge the processed batches of finished months into monthly segments")
+    compact_parser.add_argument('--before', default=None, metavar='YYYY-MM', help="First month not to compact (default: the current month)")
+    compact_parser.add_argument('--keep_months', type=int, default=None,
+                                help="Delete compacted months older than this many months before --before (default: keep all)")
+
+    show_parser = subparsers.add_parser('show', help="Write one batch back out as a CSV")
+    show_parser.add_argument('batch_name', help="Batch file name, e.g. inspections_citations_new_rows_20250113_112857.csv")
+    show_parser.add_argument('--output_path', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'compact':
+        counts = compact_batches(args.new_rows_dir, args.before, args.keep_months)
+        print(f"{counts['compacted']} batch(es) compacted, {counts['deleted_months']} month(s) deleted")
+    else:
+        show_batch(args.batch_name, args.output_path, args.new_rows_dir)
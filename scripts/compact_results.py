@@ -0,0 +1,221 @@
+"""
+Compact representation of a flag's results.
+
+A flag's output normally carries, for every row, an explanation string and the lists of
+matched positive and negative rule names, all of which follow from which rules matched.
+The compact form replaces those three columns with one small integer per row,
+rule_hits: the positive rules' bits above the negative rules' bits, in rule order, as
+the vectorized engine packs them. Rows whose result does not come from the rules get
+INVALID_INPUT or QUARANTINED. The rule names behind the bits are kept in a rule table,
+written next to the output as rules.json with the version hash of the rules it
+describes, and code, kind and desc become categorical columns.
+
+Explanations and rule lists are rendered back only when needed, e.g. for export:
+
+    python compact_results.py expand air_transport --output_path flagged_air_transport.csv
+"""
+import argparse
+import json
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from classification_cache import ruleset_version
+from flag_definitions import FLAG_DEFINITIONS
+from flagging_engine import (INVALID_INPUT_EXPLANATION, QUARANTINE_EXPLANATION, RuleBasedClassifier, get_output_path,
+                             quarantined_result)
+from storage import DICTIONARY_COLUMNS, read_table, write_table
+
+RULE_TABLE_FILE = 'rules.json'
+
+# rule_hits values of rows classified without evaluating the rules
+INVALID_INPUT = -1
+QUARANTINED = -2
+
+# Columns the compact form derives from rule_hits
+EXPANDED_COLUMNS = ['classification_explanation', 'matched_positive_rules', 'matched_negative_rules']
+
+
+def rule_table(flag_name: str) -> Dict:
+    """
+    Rule names behind each bit of a flag's rule_hits, for the current rules.
+
+    Args:
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+
+    Returns:
+        Dictionary with the flag's name, flag column, ruleset version and rule names
+    """
+    definition = FLAG_DEFINITIONS[flag_name]
+    return {
+        'flag': flag_name,
+        'flag_column': definition['flag_column'],
+        'version': ruleset_version(flag_name),
+        'positive_rules': list(definition['positive_rules']),
+        'negative_rules': list(definition['negative_rules']),
+    }
+
+
+def rule_hits_dtype(table: Dict) -> type:
+    """
+    Smallest signed integer type holding every rule's bit.
+    """
+    bits = len(table['positive_rules']) + len(table['negative_rules'])
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if bits < np.iinfo(dtype).bits - 1:
+            return dtype
+    raise ValueError(f"Flag '{table['flag']}' has {bits} rules, more than a 64-bit rule_hits can hold")
+
+
+def pack_rule_hits(matched_positive: List[str], matched_negative: List[str], table: Dict) -> int:
+    """
+    rule_hits value of a classification result.
+
+    Args:
+        matched_positive: Names of the positive rules that matched
+        matched_negative: Names of the negative rules that matched
+        table: Rule table from rule_table
+
+    Returns:
+        Positive rule bits above negative rule bits
+    """
+    positive = sum(1 << table['positive_rules'].index(name) for name in matched_positive)
+    negative = sum(1 << table['negative_rules'].index(name) for name in matched_negative)
+    return positive << len(table['negative_rules']) | negative
+
+
+def unpack_rule_hits(rule_hits: int, table: Dict) -> Dict:
+    """
+    Classification result for a rule_hits value, explanation included.
+
+    Args:
+        rule_hits: Value from a compact frame
+        table: Rule table the value was packed with
+
+    Returns:
+        Dictionary containing classification and matched rules
+    """
+    if rule_hits == INVALID_INPUT:
+        return {**RuleBasedClassifier.build_result([], []), 'explanation': INVALID_INPUT_EXPLANATION}
+    if rule_hits == QUARANTINED:
+        return quarantined_result()
+
+    negative_count = len(table['negative_rules'])
+    positive = [name for bit, name in enumerate(table['positive_rules']) if rule_hits >> negative_count >> bit & 1]
+    negative = [name for bit, name in enumerate(table['negative_rules']) if rule_hits >> bit & 1]
+    return RuleBasedClassifier.build_result(positive, negative)
+
+
+def compact_frame(classified_df: pd.DataFrame, flag_name: str) -> pd.DataFrame:
+    """
+    Replace a classified DataFrame's explanation and rule list columns by rule_hits.
+
+    Args:
+        classified_df: DataFrame returned by the classifier
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+
+    Returns:
+        Compact DataFrame, with categorical DICTIONARY_COLUMNS
+    """
+    table = rule_table(flag_name)
+
+    # Each distinct explanation stands for one result, so only those are packed
+    explanations = classified_df['classification_explanation']
+    first_rows = pd.Series(np.arange(len(classified_df)), index=explanations.to_numpy()).groupby(level=0).first()
+    keys = {}
+    for explanation, row in first_rows.items():
+        if explanation == QUARANTINE_EXPLANATION:
+            keys[explanation] = QUARANTINED
+        elif explanation == INVALID_INPUT_EXPLANATION:
+            keys[explanation] = INVALID_INPUT
+        else:
+            keys[explanation] = pack_rule_hits(classified_df['matched_positive_rules'].iloc[row],
+                                               classified_df['matched_negative_rules'].iloc[row], table)
+
+    compact_df = classified_df.drop(columns=EXPANDED_COLUMNS)
+    compact_df[table['flag_column']] = compact_df[table['flag_column']].astype(np.int8)
+    compact_df['rule_hits'] = explanations.map(keys).to_numpy(dtype=rule_hits_dtype(table))
+    for column in DICTIONARY_COLUMNS:
+        if column in compact_df.columns:
+            compact_df[column] = compact_df[column].astype('category')
+    return compact_df
+
+
+def expand_frame(compact_df: pd.DataFrame, table: Dict) -> pd.DataFrame:
+    """
+    Render a compact DataFrame back into the classifier's full output.
+
+    Args:
+        compact_df: DataFrame from compact_frame or read_compact
+        table: Rule table the frame was compacted with
+
+    Returns:
+        DataFrame with the explanation and matched rule columns in place of rule_hits
+    """
+    rule_hits = compact_df['rule_hits']
+    results = {key: unpack_rule_hits(int(key), table) for key in rule_hits.unique()}
+
+    expanded_df = compact_df.drop(columns='rule_hits')
+    for column in DICTIONARY_COLUMNS:
+        if column in expanded_df.columns and isinstance(expanded_df[column].dtype, pd.CategoricalDtype):
+            expanded_df[column] = expanded_df[column].astype(object)
+    expanded_df[table['flag_column']] = expanded_df[table['flag_column']].astype(int)
+    expanded_df['classification_explanation'] = rule_hits.map({k: r['explanation'] for k, r in results.items()}).to_numpy()
+    expanded_df['matched_positive_rules'] = rule_hits.map({k: r['matched_positive'] for k, r in results.items()}).to_numpy()
+    expanded_df['matched_negative_rules'] = rule_hits.map({k: r['matched_negative'] for k, r in results.items()}).to_numpy()
+    return expanded_df
+
+
+def write_rule_table(flag_name: str, output_dir: str):
+    """
+    Write a flag's current rule table next to its compact output.
+
+    Args:
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+        output_dir: Directory of the flag's output
+    """
+    with open(os.path.join(output_dir, RULE_TABLE_FILE), 'w') as f:
+        json.dump(rule_table(flag_name), f, indent=2)
+
+
+def read_compact(path: str) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Read a compact output and the rule table written next to it.
+
+    Args:
+        path: Compact initial_flagged CSV or Parquet file
+
+    Returns:
+        Tuple of the compact DataFrame and its rule table
+    """
+    with open(os.path.join(os.path.dirname(path), RULE_TABLE_FILE)) as f:
+        table = json.load(f)
+
+    df = read_table(path, dtype={column: 'category' for column in DICTIONARY_COLUMNS})
+    for column in DICTIONARY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    df[table['flag_column']] = df[table['flag_column']].astype(np.int8)
+    df['rule_hits'] = df['rule_hits'].astype(rule_hits_dtype(table))
+    return df, table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a compact flag output with explanations and matched rules.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    expand_parser = subparsers.add_parser('expand', help="Write a compact output back in the full format")
+    expand_parser.add_argument('flag_name', choices=list(FLAG_DEFINITIONS))
+    expand_parser.add_argument('--input_path', default=None, help="Compact output (defaults to the flag's initial_flagged.csv)")
+    expand_parser.add_argument('--output_path', required=True, help="CSV or .parquet file to write")
+
+    args = parser.parse_args()
+    input_path = args.input_path or get_output_path(args.flag_name)
+    compact_df, table = read_compact(input_path)
+    if table['version'] != ruleset_version(args.flag_name):
+        print(f"Note: {input_path} was classified with other '{args.flag_name}' rules than the current ones; "
+              f"the rule table written with it is used")
+    write_table(expand_frame(compact_df, table), args.output_path)
+    print(f"Expanded {len(compact_df)} rows to {args.output_path}")
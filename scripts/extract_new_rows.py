@@ -1,78 +1,298 @@
-import pandas as pd
-from datetime import datetime
-import sys
+import argparse
 import os
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+
+import pandas as pd
+
+from batch_manifest import BatchManifest, get_upstream_commit
+from fingerprints import CHANGES_COLUMNS, RowKey, build_index, iter_keyed_chunks, load_index, save_index
+from sharded_output import published_location
+from upstream_delta import delta_changes
+from upstream_git import (COMMIT_FILE, UPSTREAM_PATH, UPSTREAM_REF, UPSTREAM_REPO, blob_id, file_unchanged, git,
+                          is_ancestor, open_blob, read_indexed_commit, resolve_commit, write_indexed_commit)
 
-def extract_new_rows(original_df, new_df):
+UPSTREAM_FILE = os.path.join(UPSTREAM_REPO, UPSTREAM_PATH)
+LATEST_FILE = '../data/output/inspections_citations_latest.csv'
+NEW_ROWS_DIR = '../data/flagging_process/new_rows/'
+INDEX_FILE = '../data/flagging_process/upstream_fingerprints.tsv'
+
+def scanned_commit(upstream_file: str) -> Optional[str]:
     """
-    Extract new rows from new_df that are not in original_df, assuming that the new rows
-    are at the bottom of the new_df.
+    Upstream commit of which upstream_file is the checked out version, if it is one.
+
+    Args:
+        upstream_file: Citations file inside the upstream repository's working tree
 
-    Parameters:
-    original_df (pd.DataFrame): The original dataframe.
-    new_df (pd.DataFrame): The refreshed dataframe, where new rows are at the bottom.
-    
     Returns:
-    pd.DataFrame: DataFrame containing the new rows.
+        Commit hash of UPSTREAM_REF, or None if the file differs from that commit's version
+    """
+    commit = get_upstream_commit(upstream_file, UPSTREAM_REF)
+    if commit is None:
+        return None
+    directory = os.path.dirname(upstream_file) or '.'
+    file_name = os.path.basename(upstream_file)
+    try:
+        prefix = git(directory, 'rev-parse', '--show-prefix').decode().strip()
+        scanned_blob = git(directory, 'hash-object', '--', file_name).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit if scanned_blob == blob_id(directory, commit, prefix + file_name) else None
+
+
+def scan_changes(keyed_chunks: Iterable, previous_index: Dict[RowKey, str]) -> Dict:
     """
-    # Find the difference in the number of rows
-    new_rows = new_df.iloc[len(original_df):]
-    
-    return new_rows
+    Compare every row of the upstream file with the previous fingerprint index.
 
-def main():
-    # File paths
-    original_file_path = '../data/output/inspections_citations_latest.csv'
-    new_file_path = '../aphis-inspection-reports/data/combined/inspections-citations.csv'
+    Args:
+        keyed_chunks: Chunks of the upstream file with their keys and digests, from iter_keyed_chunks
+        previous_index: Fingerprint index of the rows processed so far
+
+    Returns:
+        Dictionary with the new fingerprint index, the inserted and changed rows in file
+        order, the number of inserted rows, the changed keys with their rows' positions
+        among the new rows, and the deleted keys
+    """
+    current_index = {}
+    new_row_chunks = []
+    changed_keys = []
+    changed_batch_rows = []
+    inserted = 0
+    batch_rows = 0
+    chunk = None
+
+    for chunk, keys, digests in keyed_chunks:
+        is_new = []
+        for key, digest in zip(keys, digests):
+            previous_digest = previous_index.get(key)
+            current_index[key] = digest
+            if previous_digest is None:
+                inserted += 1
+            elif previous_digest != digest:
+                changed_keys.append(key)
+                changed_batch_rows.append(batch_rows)
+            is_new.append(previous_digest != digest)
+            # Running count of new rows so far, which is the next new row's position in the batch
+            batch_rows += is_new[-1]
+        if any(is_new):
+            new_row_chunks.append(chunk[is_new])
+
+    if new_row_chunks:
+        new_rows = pd.concat(new_row_chunks)
+    else:
+        new_rows = chunk.iloc[:0] if chunk is not None else None
+
+    return {
+        'current_index': current_index,
+        'new_rows': new_rows,
+        'inserted': inserted,
+        'changed_keys': changed_keys,
+        'changed_batch_rows': changed_batch_rows,
+        'deleted_keys': [key for key in previous_index if key not in current_index],
+    }
+
+
+def upstream_changes_from_history(previous_index: Dict[RowKey, str], indexed_commit: Optional[str], new_commit: str,
+                                  upstream_repo: str = UPSTREAM_REPO, upstream_path: str = UPSTREAM_PATH) -> Dict:
+    """
+    scan_changes for the upstream file at a commit, parsing only git's diff from the indexed commit when possible.
+
+    Falls back to scanning the whole file at new_commit when no commit is recorded for
+    the index, when history was rewritten so that the indexed commit is no longer an
+    ancestor of new_commit, or when the diff cannot be mapped to whole rows.
+
+    Args:
+        previous_index: Fingerprint index of the rows processed so far
+        indexed_commit: Upstream commit previous_index describes, if known
+        new_commit: Upstream commit to bring the index to
+        upstream_repo: Upstream repository, a working tree or a bare repository
+        upstream_path: Citations file path inside the repository
+
+    Returns:
+        Dictionary as returned by scan_changes
+    """
+    if indexed_commit is None:
+        print("No upstream commit recorded for the fingerprint index; scanning the whole file")
+    elif file_unchanged(upstream_repo, upstream_path, indexed_commit, new_commit):
+        print(f"Citations file unchanged since upstream commit {indexed_commit}")
+        return {
+            'current_index': previous_index,
+            'new_rows': None,
+            'inserted': 0,
+            'changed_keys': [],
+            'changed_batch_rows': [],
+            'deleted_keys': [],
+        }
+    elif not is_ancestor(upstream_repo, indexed_commit, new_commit):
+        print(f"Upstream commit {indexed_commit} is not in the history of {new_commit} (history rewritten?); scanning the whole file")
+    else:
+        changes = delta_changes(upstream_repo, indexed_commit, new_commit, upstream_path, previous_index)
+        if changes is not None:
+            print(f"Read the changes from git's diff between upstream commits {indexed_commit} and {new_commit}")
+            return changes
+        print("The diff could not be mapped to whole rows; scanning the whole file")
+
+    with open_blob(upstream_repo, new_commit, upstream_path) as blob:
+        return scan_changes(iter_keyed_chunks(blob), previous_index)
+
+
+def save_index_at_commit(index: Dict[RowKey, str], commit: Optional[str], index_file: str = INDEX_FILE,
+                         commit_file: str = COMMIT_FILE):
+    """
+    Save the fingerprint index along with the upstream commit it describes.
+
+    The recorded commit is cleared first, so an index saved without its commit is
+    never diffed from a stale one.
+    """
+    write_indexed_commit(None, commit_file)
+    save_index(index, index_file)
+    write_indexed_commit(commit, commit_file)
+
+
+def extract_batch(upstream_file: str = UPSTREAM_FILE, latest_file: str = LATEST_FILE,
+                  new_rows_dir: str = NEW_ROWS_DIR, index_file: str = INDEX_FILE, delta: bool = False,
+                  upstream_repo: str = UPSTREAM_REPO, upstream_path: str = UPSTREAM_PATH,
+                  upstream_ref: str = UPSTREAM_REF, commit_file: str = COMMIT_FILE) -> Optional[Dict]:
+    """
+    Find the citations inserted, changed or deleted upstream since the last run.
+
+    The upstream file is hashed row by row in one streaming pass and compared with the
+    fingerprint index saved by the previous run (bootstrapped from latest_file the first
+    time). With delta, the file is instead read from the upstream repository at
+    upstream_ref, and only git's diff from the commit the index was last brought to is
+    parsed (see upstream_changes_from_history). Inserted and changed rows are written
+    to a timestamped new rows batch for flagging; changed and deleted row keys are
+    written to a changes file so that the published outputs can be updated in place.
+    For changed rows, batch_row is the row's position in the new rows batch, and so in
+    every flag's initial_flagged.csv. The batch is registered in the new rows manifest
+    for the flagging stage to pick up.
+
+    Args:
+        upstream_file: Upstream inspections-citations.csv, read when delta is False
+        latest_file: Our copy of every row processed so far
+        new_rows_dir: Directory for new rows batches
+        index_file: Fingerprint index sidecar
+        delta: Read the upstream file's changes from git history instead of scanning upstream_file
+        upstream_repo: Upstream repository, with delta
+        upstream_path: Citations file path inside upstream_repo, with delta
+        upstream_ref: Ref of the upstream version to process, with delta
+        commit_file: Where the upstream commit the index describes is recorded
+
+    Returns:
+        Dictionary with the new rows batch's path and DataFrame and, if any rows changed or
+        were deleted, the changes file's path and DataFrame (None otherwise); None when
+        there is no new data
+    """
+    indexed_commit = read_indexed_commit(commit_file)
+    if os.path.exists(index_file):
+        previous_index = load_index(index_file)
+    elif os.path.exists(latest_file):
+        print(f"No fingerprint index at {index_file}; building it from {latest_file}")
+        previous_index = build_index(latest_file)
+        indexed_commit = None
+    else:
+        previous_index = {}
+        indexed_commit = None
+
+    if delta:
+        new_commit = resolve_commit(upstream_repo, upstream_ref)
+        if new_commit is None:
+            raise ValueError(f"Cannot resolve {upstream_ref} in {upstream_repo}")
+        changes = upstream_changes_from_history(previous_index, indexed_commit, new_commit, upstream_repo, upstream_path)
+        batch_commit = new_commit
+    else:
+        changes = scan_changes(iter_keyed_chunks(upstream_file), previous_index)
+        batch_commit = get_upstream_commit(upstream_file)
+        # Lets a later --delta run start from this scan
+        new_commit = scanned_commit(upstream_file)
+
+    current_index = changes['current_index']
+    changed_keys = changes['changed_keys']
+    changed_batch_rows = changes['changed_batch_rows']
+    deleted_keys = changes['deleted_keys']
+    inserted = changes['inserted']
+
+    print(f"Upstream rows: {len(current_index)}")
+    print(f"Inserted rows: {inserted}")
+    print(f"Changed rows: {len(changed_keys)}")
+    print(f"Deleted rows: {len(deleted_keys)}")
+
+    if not inserted and not changed_keys and not deleted_keys:
+        print("No new data")
+        if not os.path.exists(index_file):
+            # A bootstrapped index is kept, so the next run neither rebuilds it nor lacks a commit to diff from
+            save_index_at_commit(current_index, new_commit, index_file, commit_file)
+        elif new_commit != indexed_commit:
+            write_indexed_commit(new_commit, commit_file)
+        return None
+
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
+    os.makedirs(new_rows_dir, exist_ok=True)
+    # Loaded before the batch is written, so a first-time bootstrap does not record it as flagged
+    manifest = BatchManifest(new_rows_dir)
+
+    new_rows_path = os.path.join(new_rows_dir, f'inspections_citations_new_rows_{timestamp}.csv')
+    new_rows = changes['new_rows']
+    if new_rows is None:
+        new_rows = pd.read_csv(upstream_file, nrows=0, dtype=str)
+    new_rows.to_csv(new_rows_path, index=False)
+    print(f"Generated file path: {new_rows_path}")
+    manifest.register(new_rows_path, len(new_rows), batch_commit)
+
+    changes_path = None
+    changes = None
+    if changed_keys or deleted_keys:
+        changes_path = os.path.join(new_rows_dir, f'inspections_citations_changes_{timestamp}.csv')
+        changes = pd.DataFrame(
+            [(*key, 'changed', row) for key, row in zip(changed_keys, changed_batch_rows)]
+            + [(*key, 'deleted', None) for key in deleted_keys],
+            columns=CHANGES_COLUMNS,
+        )
+        changes['batch_row'] = changes['batch_row'].astype('Int64')
+        changes.to_csv(changes_path, index=False)
+        print(f"Changes file path: {changes_path}")
+
+    save_index_at_commit(current_index, new_commit, index_file, commit_file)
+    return {
+        'new_rows_path': new_rows_path,
+        'new_rows': new_rows,
+        'changes_path': changes_path,
+        'changes': changes,
+    }
+
+
+def extract_new_rows(upstream_file: str = UPSTREAM_FILE, latest_file: str = LATEST_FILE,
+                     new_rows_dir: str = NEW_ROWS_DIR, index_file: str = INDEX_FILE, delta: bool = False,
+                     upstream_repo: str = UPSTREAM_REPO, upstream_path: str = UPSTREAM_PATH,
+                     upstream_ref: str = UPSTREAM_REF, commit_file: str = COMMIT_FILE):
+    """
+    extract_batch, returning only the paths it wrote.
+
+    Returns:
+        Tuple of (new rows batch path, changes file path); either is None when there is nothing to write
+    """
+    batch = extract_batch(upstream_file, latest_file, new_rows_dir, index_file, delta,
+                          upstream_repo, upstream_path, upstream_ref, commit_file)
+    if batch is None:
+        return None, None
+    return batch['new_rows_path'], batch['changes_path']
 
-    try:
-        # Check if the original file exists
-        if not os.path.exists(original_file_path):
-            print(f"Original file does not exist at {original_file_path}. Creating it with headers from {new_file_path}.")
-            # Load new file and save only the headers
-            new_df = pd.read_csv(new_file_path)
-            new_df.iloc[0:0].to_csv(original_file_path, index=False)  # Write only the header
-            print(f"File created at {original_file_path} with headers from {new_file_path}.")
-
-        # Load dataframes
-        df_original = pd.read_csv(original_file_path)
-        df_new = pd.read_csv(new_file_path)
-
-        # Extract new rows
-        new_rows = extract_new_rows(df_original, df_new)
-
-        # Print sanity check
-        print("----------------------------------------------------------------------------")
-        print("Sanity Check for 'extract_new_rows.py':")
-        print()
-        print(f"Shape of inspections_citations_latest: {df_original.shape}")
-        print(f"Shape of inspections-citations from APHIS: {df_new.shape}")
-        print(f"Shape of extracted new rows: {new_rows.shape}")
-
-        # Check if there are new rows
-        if new_rows.shape[0] == 0:
-            print("No new data. All flagged datasets are up to date.")
-            sys.exit(0)  # Exit the script with a success status
-        
-        # Generate a timestamp for the filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_rows_file_path = f"../data/flagging_process/new_rows/inspections_citations_new_rows_{timestamp}.csv"
-        
-        # Print the generated file path
-        print(f"Generated file path: {new_rows_file_path}")
-
-        # Save new rows to a timestamped CSV file
-        new_rows.to_csv(new_rows_file_path, index=False)
-
-        print()
-        print(f"New rows saved to: {new_rows_file_path}")
-        print("----------------------------------------------------------------------------")
-
-    except Exception as e:
-        # Log the error details
-        print("An error occurred during the extract new rows operation:")
-        print(f"Error: {e}")
-        raise
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Extract citations that are new or changed upstream since the last run.")
+    parser.add_argument('--upstream_file_path', default=UPSTREAM_FILE, help="Upstream inspections-citations.csv")
+    parser.add_argument('--latest_file_path', default=LATEST_FILE, help="Our copy of every row processed so far (its shard directory is used once it is sharded)")
+    parser.add_argument('--new_rows_dir', default=NEW_ROWS_DIR, help="Directory for new rows batches")
+    parser.add_argument('--index_file_path', default=INDEX_FILE, help="Fingerprint index sidecar")
+    parser.add_argument('--delta', action='store_true',
+                        help="Read only the changes since the last processed upstream commit from git history, "
+                             "instead of scanning the checked out upstream file")
+    parser.add_argument('--upstream_repo', default=UPSTREAM_REPO, help="Upstream repository for --delta, a working tree or a bare repository")
+    parser.add_argument('--upstream_path', default=UPSTREAM_PATH, help="Citations file path inside the upstream repository")
+    parser.add_argument('--upstream_ref', default=UPSTREAM_REF, help="Upstream ref to process with --delta")
+    parser.add_argument('--commit_file_path', default=COMMIT_FILE, help="Where the upstream commit of the fingerprint index is recorded")
+    args = parser.parse_args()
+
+    extract_new_rows(args.upstream_file_path, published_location(args.latest_file_path), args.new_rows_dir, args.index_file_path, args.delta,
+                     args.upstream_repo, args.upstream_path, args.upstream_ref, args.commit_file_path)
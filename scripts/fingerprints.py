@@ -0,0 +1,143 @@
+"""
+Content fingerprints for inspection citations.
+
+Each row is identified by its hash_id and code plus its position among rows sharing
+both, and fingerprinted by a digest of all of its values. Comparing the fingerprints
+of two versions of the citations file gives exactly the rows that were inserted,
+changed or deleted, wherever they are in the file.
+"""
+import csv
+import hashlib
+import os
+from typing import BinaryIO, Dict, Iterable, List, Tuple, Union
+
+import pandas as pd
+
+from storage import is_sharded, read_shard_manifest
+
+KEY_COLUMNS = ['hash_id', 'code']
+INDEX_COLUMNS = KEY_COLUMNS + ['occurrence', 'digest']
+
+# Written by extract_new_rows.py next to each batch that changes or deletes existing rows
+CHANGES_COLUMNS = KEY_COLUMNS + ['occurrence', 'change', 'batch_row']
+
+RowKey = Tuple[str, str, int]
+
+
+class RowKeyer:
+    """
+    Assign (hash_id, code, occurrence) keys to rows, counting occurrences across chunks.
+    """
+
+    def __init__(self):
+        self.seen = {}
+
+    def keys(self, df: pd.DataFrame) -> List[RowKey]:
+        """
+        Keys for the rows of a chunk, continuing the occurrence counts of earlier chunks.
+
+        Args:
+            df: Chunk read with dtype=str and keep_default_na=False
+
+        Returns:
+            List of keys, one per row
+        """
+        keys = []
+        for hash_id, code in zip(df['hash_id'], df['code']):
+            occurrence = self.seen.get((hash_id, code), 0)
+            self.seen[(hash_id, code)] = occurrence + 1
+            keys.append((hash_id, code, occurrence))
+        return keys
+
+
+def row_digests(df: pd.DataFrame) -> List[str]:
+    """
+    Digest of every value in each row.
+
+    Args:
+        df: Chunk read with dtype=str and keep_default_na=False
+
+    Returns:
+        List of 16-character hex digests, one per row
+    """
+    return [
+        hashlib.blake2b('\x1f'.join(values).encode('utf-8'), digest_size=8).hexdigest()
+        for values in df.itertuples(index=False, name=None)
+    ]
+
+
+def iter_keyed_chunks(file_path: Union[str, BinaryIO], chunksize: int = 10000) -> Iterable[Tuple[pd.DataFrame, List[RowKey], List[str]]]:
+    """
+    Stream a citations CSV with the key and digest of every row.
+
+    Args:
+        file_path: Citations CSV, or a binary file object streaming one
+        chunksize: Rows per chunk
+
+    Returns:
+        Iterator of (chunk, keys, digests)
+    """
+    keyer = RowKeyer()
+    for chunk in pd.read_csv(file_path, chunksize=chunksize, dtype=str, keep_default_na=False):
+        yield chunk, keyer.keys(chunk), row_digests(chunk)
+
+
+def build_index(file_path: str) -> Dict[RowKey, str]:
+    """
+    Fingerprint every row of a citations CSV.
+
+    A sharded output is read shard by shard; each hash_id's rows are all in one shard,
+    in order, so the keys are the same as in the monolithic file.
+
+    Args:
+        file_path: Citations CSV or sharded CSV directory
+
+    Returns:
+        Dictionary mapping row keys to digests
+    """
+    if is_sharded(file_path):
+        file_paths = [os.path.join(file_path, shard['path']) for shard in read_shard_manifest(file_path)['shards']]
+    else:
+        file_paths = [file_path]
+
+    index = {}
+    for path in file_paths:
+        for _, keys, digests in iter_keyed_chunks(path):
+            index.update(zip(keys, digests))
+    return index
+
+
+def load_index(index_path: str) -> Dict[RowKey, str]:
+    """
+    Read a fingerprint index written by save_index.
+
+    Args:
+        index_path: Path to the index
+
+    Returns:
+        Dictionary mapping row keys to digests
+    """
+    index = {}
+    with open(index_path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter='\t')
+        next(reader, None)
+        for hash_id, code, occurrence, digest in reader:
+            index[(hash_id, code, int(occurrence))] = digest
+    return index
+
+
+def save_index(index: Dict[RowKey, str], index_path: str):
+    """
+    Write a fingerprint index as a tab-separated sidecar file, replacing any previous one atomically.
+
+    Args:
+        index: Dictionary mapping row keys to digests
+        index_path: Path to write
+    """
+    temp_path = index_path + '.tmp'
+    with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(INDEX_COLUMNS)
+        for (hash_id, code, occurrence), digest in index.items():
+            writer.writerow([hash_id, code, occurrence, digest])
+    os.replace(temp_path, index_path)
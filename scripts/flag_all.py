@@ -0,0 +1,9 @@
+from flagging_engine import main
+
+if __name__ == "__main__":
+    try:
+        # Read the input once and write every registered flag's output
+        main(None, "Flag the latest new rows batch for every registered flag.")
+
+    except Exception as e:
+        print(f"Error: {e}")
@@ -0,0 +1,79 @@
+"""
+Registry of flag definitions used by the flagging engine.
+
+Each entry maps a flag name to the column it adds and the regex rules that
+drive it. Positive rules assign the flag when any of them match; negative
+rules override a positive match back to 0. All patterns are matched against
+lowercased, whitespace-normalized narratives.
+"""
+
+# Negative rule shared by every flag: boilerplate for inspections that could not take place
+NO_ADULT_RULE = {
+    'no_adult': r'a responsible adult was not available to accompany aphis officials'
+}
+
+FLAG_DEFINITIONS = {
+    'extreme_temperatures': {
+        'flag_column': 'extreme_temperatures_flag',
+        'positive_rules': {
+            'temperature_value': r'\b(?!180\b)\d+(\.\d+)?\s*(f|degrees|fahrenheit|deg f|celsius)\b',
+            'general_terms': r'\b(climatic|ambient temperature|temperature extremes|atmospheric temperature)\b',
+            'heat_terms': r'\b(extreme heat|heat index|heat warning|excessive heat|hot weather|heat stroke|heat stress)\b',
+            'cold_terms': r'\b(extreme cold|cold temperature|cold weather|low temperature|cold stress|frostbite|hyperthermia|hypothermic)\b',
+            'weather_sources': r'\b(weather service|accuweather|noaa)\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+    'air_transport': {
+        'flag_column': 'air_transport_flag',
+        'positive_rules': {
+            'airport_terms': r'\b(airport|airline|aircraft|international terminal|passenger terminal)\b',
+            'transport_terms': r'\b(air transport|flight|air cargo)\b',
+            'document_terms': r'\b(waybill|airway bill|awb)\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+    'veterinary_care': {
+        'flag_column': 'veterinary_care_flag',
+        'positive_rules': {
+            'program_terms': r'\b(program of veterinary care|written program|pvc|aphis form 7002)\b',
+            'program_status': r'\b(no|not have an?|did not have an?|missing|outdated|incomplete|not been updated)\b[^.]{0,40}\b(program of veterinary care|pvc)\b',
+            'not_examined': r'\bnot (been )?(seen|examined|evaluated|treated) by (a|the|any) (licensed )?veterinarian\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+    'enclosures': {
+        'flag_column': 'enclosures_flag',
+        'positive_rules': {
+            'structural_terms': r'\b(structurally sound|good repair|in disrepair|sharp (points|edges|wires?)|broken (wires?|fence|fencing|boards?|panels?))\b',
+            'space_terms': r'\b(insufficient space|not enough space|minimum space|floor space|adequate headroom|freedom of movement)\b',
+            'surface_terms': r'\b(impervious to moisture|rusted|rusting|chipped paint|peeling paint|exposed insulation)\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+    'sanitation': {
+        'flag_column': 'sanitation_flag',
+        'positive_rules': {
+            'filth_terms': r'\b(accumulation of (feces|fecal material|excreta|debris|food waste|hair|dirt)|excessive (feces|fecal material|excreta)|build-?up of|grime|filth)\b',
+            'pest_terms': r'\b(rodent droppings|pest control|cockroach(es)?|infestation)\b',
+            'cleaning_terms': r'\b(not been cleaned|cleaned and sanitized|spot-cleaned|sanitation)\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+    'unauthorized_sale': {
+        'flag_column': 'unauthorized_sale_flag',
+        'positive_rules': {
+            'unlicensed_terms': r'\b(without (a|an) (valid |active )?(license|registration)|unlicensed|not licensed)\b',
+            'activity_terms': r'\b(sold|sells|selling|exhibited|exhibiting|exhibition of) [^.]{0,60}\bwithout\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+    'expired_medications': {
+        'flag_column': 'expired_medications_flag',
+        'positive_rules': {
+            'expired_terms': r'\bexpired (medications?|drugs?|medicines?|vaccines?|fluids|antibiotics?|euthanasia solution|anesthetics?|sedatives?|ointments?|bottles?)\b',
+            'expiration_terms': r'\b(past (the|its|their) expiration dates?|beyond (the|its|their) expiration dates?|expiration dates? (had|has|have) passed)\b'
+        },
+        'negative_rules': dict(NO_ADULT_RULE),
+    },
+}
@@ -0,0 +1,25 @@
+"""
+Command line options shared by the flag scripts and pipeline.py.
+
+Nothing here needs pandas, so pipeline.py can offer the same options and still answer
+--help without loading it.
+"""
+import argparse
+
+from classification_cache import DEFAULT_CACHE_PATH
+
+# narrative_index needs pandas, so its default file is defined here and imported there
+DEFAULT_INDEX_PATH = '../data/flagging_process/narrative_index.sqlite'
+
+
+def add_lookup_arguments(parser: argparse.ArgumentParser):
+    """
+    Add --cache and --index, each taking an optional file and defaulting to the shared one when given alone.
+
+    Args:
+        parser: Argument parser to add the options to
+    """
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_PATH, default=None,
+                        help=f"Reuse results for narratives classified before with the same rules, from a SQLite cache (default file {DEFAULT_CACHE_PATH})")
+    parser.add_argument('--index', nargs='?', const=DEFAULT_INDEX_PATH, default=None,
+                        help=f"Add the narratives to an inverted index and look up the literals each rule requires there (default file {DEFAULT_INDEX_PATH})")
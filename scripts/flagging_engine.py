@@ -0,0 +1,1407 @@
+import argparse
+import bisect
+import contextlib
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import re
+import os
+import signal
+import threading
+import warnings
+from typing import TYPE_CHECKING, List, Dict, Union, Optional, Hashable, Iterable, Iterator, Tuple
+
+from batch_manifest import BatchManifest
+from citation_store import DEFAULT_STORE_PATH, CitationStore
+from classification_cache import ClassificationCache, text_digest
+from flag_definitions import FLAG_DEFINITIONS
+from flag_options import add_lookup_arguments
+from narrative_index import MIN_LITERAL_LENGTH, NarrativeIndex
+from rule_checks import check_rules
+from storage import read_table, write_table
+
+if TYPE_CHECKING:
+    from rule_metrics import RunMetrics
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+FLAGGING_PROCESS_DIR = '../data/flagging_process/'
+NEW_ROWS_DIR = os.path.join(FLAGGING_PROCESS_DIR, 'new_rows/')
+
+# Rows whose narrative ran over the --narrative-budget, written by the last run with a budget
+QUARANTINE_FILE = os.path.join(FLAGGING_PROCESS_DIR, 'quarantined.csv')
+# Changes of the batches a --pending run classifies together, with batch_row into their concatenation
+PENDING_CHANGES_FILE = os.path.join(FLAGGING_PROCESS_DIR, 'pending_changes.csv')
+QUARANTINE_EXPLANATION = 'Quarantined: rule evaluation ran over the narrative budget'
+
+# Classification explanation of missing or empty narratives
+INVALID_INPUT_EXPLANATION = 'Invalid input'
+
+# Classification engines: per-row Python matching, or columnar pandas string operations
+ENGINES = ('python', 'vectorized')
+
+# Formats initial_flagged can be written in; Parquet needs pyarrow
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+# Rows per task when classifying in a process pool
+DEFAULT_CHUNKSIZE = 10000
+
+# Posting lists cover every indexed narrative, so they only beat scanning the texts
+# when the texts make up a large share of the index, as in a full reflag
+POSTINGS_MIN_SHARE = 0.25
+
+
+def _best_requirement(candidates: List[Optional[set]]) -> Optional[set]:
+    """
+    Pick the most selective literal set among the requirements of a sequence.
+
+    Args:
+        candidates: Literal sets, each of which any match must contain one of (None if unknown)
+
+    Returns:
+        The set whose shortest literal is longest, or None if no item has one
+    """
+    known = [literals for literals in candidates if literals]
+    if not known:
+        return None
+    return max(known, key=lambda literals: (min(len(literal) for literal in literals), -len(literals)))
+
+
+def _required_literals(items) -> Optional[set]:
+    """
+    Walk a parsed pattern and find literals of which every match must contain at least one.
+
+    Args:
+        items: Parsed sequence from the re module's parser
+
+    Returns:
+        Set of literal strings, or None if no such set can be derived
+    """
+    candidates = []
+    run = []
+
+    for op, value in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(value))
+            continue
+
+        if run:
+            candidates.append({''.join(run)})
+            run = []
+
+        if op is sre_constants.SUBPATTERN:
+            add_flags, del_flags = value[1], value[2]
+            # Literals of a group matched with its own case sensitivity, as in (?i:...), say nothing about the text's case
+            if not (add_flags | del_flags) & sre_constants.SRE_FLAG_IGNORECASE:
+                candidates.append(_required_literals(value[-1]))
+        elif op is sre_constants.BRANCH:
+            branches = [_required_literals(branch) for branch in value[1]]
+            if all(branches):
+                candidates.append(set().union(*branches))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and value[0] >= 1:
+            candidates.append(_required_literals(value[2]))
+
+    if run:
+        candidates.append({''.join(run)})
+
+    literals = _best_requirement(candidates)
+    if literals is None:
+        return None
+
+    # A literal that contains another literal of the set adds nothing to the check
+    return {
+        literal for literal in literals
+        if not any(other != literal and other in literal for other in literals)
+    }
+
+
+def required_literals(pattern: str) -> Optional[set]:
+    """
+    Literals of which any match of pattern must contain at least one.
+
+    Args:
+        pattern: Regex pattern, matched case-sensitively against preprocessed text
+
+    Returns:
+        Set of literal strings, or None if the pattern has no usable literals
+    """
+    compiled = re.compile(pattern)
+    if compiled.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    return _required_literals(sre_parse.parse(pattern))
+
+
+class RuleMatcher:
+    """
+    Precompiled matcher for a set of rules with a literal-set prefilter.
+
+    Every literal that some rule requires is looked up in the text once with a
+    substring check; a rule's compiled regex only runs when at least one of its
+    required literals is present, so most rules never scan most narratives.
+
+    The literals are looked up one by one rather than with a single alternation of
+    all of them: re has no multi-literal search, so the alternation is tried at every
+    position of the text, and on the published citations finding the literals present
+    that way took 3.5 times as long as the substring checks.
+    """
+
+    def __init__(self, rules: Dict[Hashable, str]):
+        self.rule_keys = list(rules)
+        self.compiled = {key: re.compile(pattern) for key, pattern in rules.items()}
+        self.rule_literals = {key: required_literals(pattern) for key, pattern in rules.items()}
+        self.literals = sorted(set().union(*[literals for literals in self.rule_literals.values() if literals]))
+        # With none of the literals in a text, no rule can match it
+        self.every_rule_needs_literals = all(literals is not None for literals in self.rule_literals.values())
+
+    def match(self, text: str, present: Optional[set] = None) -> List[Hashable]:
+        """
+        Find every rule with at least one match in text.
+
+        Args:
+            text: Text to scan
+            present: Literals known to be in text, e.g. from a NarrativeIndex; looked up in text if None
+
+        Returns:
+            Keys of the matching rules, in rule order
+        """
+        if present is None:
+            present = self.present_literals(text)
+        if not present and self.every_rule_needs_literals:
+            return []
+
+        return [
+            key for key in self.rule_keys
+            if (self.rule_literals[key] is None or not self.rule_literals[key].isdisjoint(present))
+            and self.compiled[key].search(text)
+        ]
+
+    def present_literals(self, text: str) -> set:
+        """
+        Required literals of the rules that occur in text.
+        """
+        return {literal for literal in self.literals if literal in text}
+
+
+class RuleBasedClassifier:
+    def __init__(self, positive_rules: Dict[str, str], negative_rules: Dict[str, str]):
+        # Positive rules - if satisfied, classify as 1
+        self.positive_rules = dict(positive_rules)
+
+        # Negative rules - if satisfied, override to 0
+        self.negative_rules = dict(negative_rules)
+
+        # Reject patterns that can backtrack exponentially before they meet a narrative
+        check_rules(self.positive_rules)
+        check_rules(self.negative_rules)
+
+        self.positive_matcher = RuleMatcher(self.positive_rules)
+        self.negative_matcher = RuleMatcher(self.negative_rules)
+
+    @classmethod
+    def from_definition(cls, flag_name: str) -> 'RuleBasedClassifier':
+        """
+        Build a classifier from a registered flag definition.
+
+        Args:
+            flag_name: Key of the flag in FLAG_DEFINITIONS
+
+        Returns:
+            Classifier using that flag's positive and negative rules
+        """
+        definition = FLAG_DEFINITIONS[flag_name]
+        return cls(definition['positive_rules'], definition['negative_rules'])
+
+    @staticmethod
+    def preprocess_text(text: str) -> str:
+        """
+        Preprocess text by lowercasing and normalizing spaces.
+
+        Args:
+            text: Input text to preprocess
+
+        Returns:
+            Preprocessed text
+        """
+        if not isinstance(text, str):
+            return ""
+
+        # Convert to lowercase
+        text = text.lower()
+
+        # Normalize spaces (split and rejoin to remove multiple spaces)
+        text = ' '.join(text.split())
+
+        return text
+
+    def apply_rules(self, text: str) -> Dict[str, Union[int, List[str]]]:
+        """
+        Apply both positive and negative rules to text and return classification with explanation.
+
+        Args:
+            text: Input text to classify
+
+        Returns:
+            Dictionary containing classification and matched rules
+        """
+        return self.apply_rules_preprocessed(self.preprocess_text(text))
+
+    def apply_rules_preprocessed(self, text: str, present: Optional[set] = None) -> Dict[str, Union[int, List[str]]]:
+        """
+        Apply the rules to text that has already been through preprocess_text.
+
+        Args:
+            text: Preprocessed text to classify
+            present: Required literals known to be in text; looked up in text if None
+
+        Returns:
+            Dictionary containing classification and matched rules
+        """
+        if not text:
+            return {
+                'classification': 0,
+                'matched_positive': [],
+                'matched_negative': [],
+                'explanation': INVALID_INPUT_EXPLANATION
+            }
+
+        return self.resolve(self.positive_matcher.match(text, present), text, present)
+
+    def resolve(self, matched_positive: List[str], text: str, present: Optional[set] = None) -> Dict[str, Union[int, List[str]]]:
+        """
+        Turn the positive rules matched in text into a classification with explanation.
+
+        Args:
+            matched_positive: Names of the positive rules that matched, in rule order
+            text: Preprocessed text, used to check the negative rules
+            present: Required literals known to be in text; looked up in text if None
+
+        Returns:
+            Dictionary containing classification and matched rules
+        """
+        # Negative rules only need checking once a positive rule has matched
+        matched_negative = self.negative_matcher.match(text, present) if matched_positive else []
+
+        return self.build_result(matched_positive, matched_negative)
+
+    @staticmethod
+    def build_result(matched_positive: List[str], matched_negative: List[str]) -> Dict[str, Union[int, List[str]]]:
+        """
+        Build the classification result for a given set of matched rules.
+
+        Args:
+            matched_positive: Names of the positive rules that matched, in rule order
+            matched_negative: Names of the negative rules that matched, in rule order
+
+        Returns:
+            Dictionary containing classification and matched rules
+        """
+        # If no positive rules were satisfied, return early
+        if not matched_positive:
+            return {
+                'classification': 0,
+                'matched_positive': [],
+                'matched_negative': [],
+                'explanation': 'No positive rules matched'
+            }
+
+        # Determine final classification
+        final_classification = 1 if matched_positive and not matched_negative else 0
+
+        # Create explanation
+        if matched_negative:
+            explanation = f"Initially matched positive rules {matched_positive} but overridden by negative rules {matched_negative}"
+        else:
+            explanation = f"Matched positive rules: {matched_positive}"
+
+        return {
+            'classification': final_classification,
+            'matched_positive': matched_positive,
+            'matched_negative': matched_negative,
+            'explanation': explanation
+        }
+
+
+class NarrativeTimeout(Exception):
+    """
+    Raised when evaluating the rules on one narrative runs over the narrative budget.
+    """
+
+
+def _raise_narrative_timeout(signum, frame):
+    raise NarrativeTimeout()
+
+
+@contextlib.contextmanager
+def narrative_budget(seconds: Optional[float]):
+    """
+    Interrupt the enclosed rule evaluation with NarrativeTimeout after a number of seconds.
+
+    The re module checks for signals while it backtracks, so a SIGALRM timer stops a
+    runaway search part way. Without a budget this does nothing.
+
+    Args:
+        seconds: Budget in seconds, or None for no limit
+    """
+    if not seconds:
+        yield
+        return
+
+    previous_handler = signal.signal(signal.SIGALRM, _raise_narrative_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def quarantined_result() -> Dict[str, Union[int, List[str]]]:
+    """
+    Classification result for a narrative whose rule evaluation ran over the budget.
+    """
+    return {
+        'classification': 0,
+        'matched_positive': [],
+        'matched_negative': [],
+        'explanation': QUARANTINE_EXPLANATION
+    }
+
+
+class MultiFlagClassifier:
+    def __init__(self, flag_names: Optional[List[str]] = None, budget: Optional[float] = None):
+        if budget and not hasattr(signal, 'setitimer'):
+            raise ValueError("A narrative budget needs signal.setitimer, which this platform does not have")
+        if budget and threading.current_thread() is not threading.main_thread():
+            raise ValueError("A narrative budget relies on signals, so it only works in the main thread")
+        # Seconds the rules may spend on one narrative before it is quarantined, None for no limit
+        self.budget = budget
+
+        if flag_names is None:
+            flag_names = list(FLAG_DEFINITIONS)
+
+        unknown = [name for name in flag_names if name not in FLAG_DEFINITIONS]
+        if unknown:
+            raise ValueError(f"Unknown flags: {unknown}. Available flags: {list(FLAG_DEFINITIONS)}")
+
+        self.classifiers = {name: RuleBasedClassifier.from_definition(name) for name in flag_names}
+
+        # One matcher over every flag's positive rules, keyed by (flag name, rule name)
+        self.positive_matcher = RuleMatcher({
+            (name, rule_name): pattern
+            for name, classifier in self.classifiers.items()
+            for rule_name, pattern in classifier.positive_rules.items()
+        })
+
+    @property
+    def literals(self) -> set:
+        """
+        Every literal required by some positive or negative rule.
+        """
+        literals = set(self.positive_matcher.literals)
+        for classifier in self.classifiers.values():
+            literals.update(classifier.negative_matcher.literals)
+        return literals
+
+    def apply_rules(self, text: str) -> Dict[str, Dict[str, Union[int, List[str]]]]:
+        """
+        Preprocess text once and apply every flag's rules to it.
+
+        Args:
+            text: Input text to classify
+
+        Returns:
+            Dictionary mapping each flag name to its classification result
+        """
+        return self.apply_rules_preprocessed(RuleBasedClassifier.preprocess_text(text))
+
+    def apply_rules_preprocessed(self, text: str, present: Optional[set] = None) -> Dict[str, Dict[str, Union[int, List[str]]]]:
+        """
+        Apply every flag's rules to text that has already been through preprocess_text.
+
+        Args:
+            text: Preprocessed text to classify
+            present: Required literals known to be in text; looked up in text if None
+
+        Returns:
+            Dictionary mapping each flag name to its classification result
+        """
+        if not text:
+            return {
+                name: classifier.apply_rules_preprocessed(text)
+                for name, classifier in self.classifiers.items()
+            }
+
+        matched_positive = {name: [] for name in self.classifiers}
+        for name, rule_name in self.positive_matcher.match(text, present):
+            matched_positive[name].append(rule_name)
+
+        return {
+            name: classifier.resolve(matched_positive[name], text, present)
+            for name, classifier in self.classifiers.items()
+        }
+
+
+def build_flag_frame(new_inspections_citations: pd.DataFrame, flag_name: str, results: List[Dict]) -> pd.DataFrame:
+    """
+    Attach one flag's classification results to a copy of the input rows.
+
+    Args:
+        new_inspections_citations: DataFrame that was classified
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+        results: Per-row classification results, in row order
+
+    Returns:
+        DataFrame with the flag, explanation and matched rule columns added
+    """
+    results_df = new_inspections_citations.copy()
+    results_df[FLAG_DEFINITIONS[flag_name]['flag_column']] = [r['classification'] for r in results]
+    results_df['classification_explanation'] = [r['explanation'] for r in results]
+    results_df['matched_positive_rules'] = [r['matched_positive'] for r in results]
+    results_df['matched_negative_rules'] = [r['matched_negative'] for r in results]
+    return results_df
+
+
+def classify_all_flags(new_inspections_citations: pd.DataFrame, flag_names: Optional[List[str]] = None, engine: str = 'python',
+                       classifier: Optional[MultiFlagClassifier] = None, cache: Optional[ClassificationCache] = None,
+                       index: Optional[NarrativeIndex] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Classify every narrative for all requested flags in a single pass.
+
+    Narratives that run over the classifier's budget get quarantined_result() for every flag.
+
+    Args:
+        new_inspections_citations: DataFrame containing narratives to classify
+        flag_names: Flags to evaluate (defaults to every registered flag)
+        engine: 'python' to match row by row, 'vectorized' to use pandas string operations
+        classifier: Already built classifier to reuse; flag_names is ignored when given
+        cache: Classification cache to reuse results from and add new results to
+        index: Narrative index to add the narratives to and to look required literals up in
+
+    Returns:
+        Dictionary mapping each flag name to its classified DataFrame
+    """
+    if classifier is None:
+        classifier = MultiFlagClassifier(flag_names)
+
+    if cache is not None:
+        return classify_all_flags_cached(new_inspections_citations, classifier, engine, cache, index)
+
+    if engine == 'vectorized':
+        if classifier.budget:
+            raise ValueError("The narrative budget applies to the 'python' engine only")
+        return classify_all_flags_vectorized(new_inspections_citations, classifier=classifier, index=index)
+    if engine != 'python':
+        raise ValueError(f"Unknown engine '{engine}'. Available engines: {list(ENGINES)}")
+
+    if index is None:
+        rows = ((narrative,) for narrative in new_inspections_citations['narrative'])
+        evaluate = classifier.apply_rules
+    else:
+        texts = preprocess_series(new_inspections_citations['narrative'])
+        present = [set() for _ in range(len(texts))]
+        for literal, found in index_presence(index, texts, classifier.literals).items():
+            for row in np.flatnonzero(found):
+                present[row].add(literal)
+        rows = zip(texts, present)
+        evaluate = classifier.apply_rules_preprocessed
+        if classifier.positive_matcher.every_rule_needs_literals:
+            # Texts without any required literal are not candidates for any rule
+            no_match = {name: flag.build_result([], []) for name, flag in classifier.classifiers.items()}
+
+            def evaluate(text: str, present: set) -> Dict[str, Dict[str, Union[int, List[str]]]]:
+                if text and not present:
+                    return no_match
+                return classifier.apply_rules_preprocessed(text, present)
+
+    per_flag_results = {name: [] for name in classifier.classifiers}
+    for row in rows:
+        try:
+            with narrative_budget(classifier.budget):
+                results = evaluate(*row)
+        except NarrativeTimeout:
+            results = {name: quarantined_result() for name in classifier.classifiers}
+        for name, result in results.items():
+            per_flag_results[name].append(result)
+
+    return {
+        name: build_flag_frame(new_inspections_citations, name, results)
+        for name, results in per_flag_results.items()
+    }
+
+
+def preprocess_series(narratives: pd.Series) -> pd.Series:
+    """
+    Vectorized RuleBasedClassifier.preprocess_text: lowercase and normalize spaces.
+
+    Args:
+        narratives: Series of raw narratives
+
+    Returns:
+        Series of preprocessed text, with "" for missing or non-string values
+    """
+    narratives = narratives.astype(object)
+    is_text = narratives.map(type) == str
+    if not is_text.any():
+        return pd.Series("", index=narratives.index, dtype=object)
+
+    return narratives.where(is_text).str.lower().str.split().str.join(' ').fillna("")
+
+
+def classify_all_flags_cached(new_inspections_citations: pd.DataFrame, classifier: MultiFlagClassifier, engine: str,
+                              cache: ClassificationCache, index: Optional[NarrativeIndex] = None) -> Dict[str, pd.DataFrame]:
+    """
+    classify_all_flags that evaluates the rules only for distinct narratives missing from the cache.
+
+    Args:
+        new_inspections_citations: DataFrame containing narratives to classify
+        classifier: Classifier for the narratives not in the cache
+        engine: Classification engine for the narratives not in the cache, one of ENGINES
+        cache: Classification cache built for the classifier's flags
+        index: Narrative index for the narratives not in the cache, if any
+
+    Returns:
+        Dictionary mapping each flag name to its classified DataFrame
+    """
+    flag_classifiers = classifier.classifiers
+    texts = preprocess_series(new_inspections_citations['narrative'])
+    digests = {text: text_digest(text) for text in texts.unique() if text}
+
+    matched = cache.get(digests.values())
+    missing = [
+        text for text, digest in digests.items()
+        if any(digest not in matched[name] for name in classifier.classifiers)
+    ]
+    if missing:
+        # After a rule edit only the edited flag's entries are gone, so only its rules need evaluating
+        stale_flags = [name for name in classifier.classifiers if len(matched[name]) < len(digests)]
+        if len(stale_flags) < len(classifier.classifiers):
+            classifier = MultiFlagClassifier(stale_flags, classifier.budget)
+
+        # Preprocessing is idempotent, so the preprocessed texts classify like the raw narratives
+        fresh = classify_all_flags(pd.DataFrame({'narrative': missing}), engine=engine, classifier=classifier, index=index)
+        new_results = {}
+        for name, classified_df in fresh.items():
+            new_results[name] = {}
+            for text, matched_positive, matched_negative, explanation in zip(
+                    missing, classified_df['matched_positive_rules'], classified_df['matched_negative_rules'],
+                    classified_df['classification_explanation']):
+                # Quarantined narratives are not cached, so they are evaluated again next time
+                if explanation != QUARANTINE_EXPLANATION:
+                    new_results[name][digests[text]] = (matched_positive, matched_negative)
+        cache.put(new_results)
+        for name, flag_results in new_results.items():
+            matched[name].update(flag_results)
+
+    classified = {}
+    for name, flag_classifier in flag_classifiers.items():
+        results = {"": flag_classifier.apply_rules_preprocessed("")}
+        for text, digest in digests.items():
+            if digest in matched[name]:
+                results[text] = flag_classifier.build_result(*matched[name][digest])
+            else:
+                # Ran over the narrative budget this time
+                results[text] = quarantined_result()
+        classified[name] = build_flag_frame(new_inspections_citations, name, [results[text] for text in texts])
+
+    return classified
+
+
+def literal_presence(texts: pd.Series, literals: set) -> Dict[str, np.ndarray]:
+    """
+    Find which rows contain each required literal, so rules sharing a literal share the scan.
+
+    Preprocessed texts contain no newlines, so they are joined into one newline-separated
+    corpus and each literal is located with str.find, skipping to the next row after a hit.
+
+    Args:
+        texts: Series of preprocessed text
+        literals: Literals to look up
+
+    Returns:
+        Dictionary mapping each literal to a boolean array of rows containing it
+    """
+    corpus = '\n'.join(texts) + '\n'
+    row_ends = list(itertools.accumulate(len(text) + 1 for text in texts))
+
+    presence = {}
+    for literal in sorted(literals):
+        rows = np.zeros(len(texts), dtype=bool)
+        position = corpus.find(literal)
+        while position != -1:
+            row = bisect.bisect_right(row_ends, position)
+            rows[row] = True
+            position = corpus.find(literal, row_ends[row])
+        presence[literal] = rows
+    return presence
+
+
+def index_presence(index: NarrativeIndex, texts: pd.Series, literals: set) -> Dict[str, np.ndarray]:
+    """
+    literal_presence answered from a narrative index, after adding the texts to it.
+
+    Literals too short for the index are looked up in the texts, as are all literals
+    when the texts are less than POSTINGS_MIN_SHARE of the indexed narratives.
+
+    Args:
+        index: Narrative index
+        texts: Series of preprocessed text
+        literals: Literals to look up
+
+    Returns:
+        Dictionary mapping each literal to a boolean array of rows containing it
+    """
+    digests = {text: text_digest(text) for text in texts.unique() if text}
+    ids = index.add({digest: text for text, digest in digests.items()})
+
+    if len(ids) < POSTINGS_MIN_SHARE * len(index):
+        return literal_presence(texts, literals)
+    row_ids = np.array([ids[digests[text]] if text else 0 for text in texts], dtype=np.int64)
+
+    indexed = {literal for literal in literals if len(literal) >= MIN_LITERAL_LENGTH}
+    presence = literal_presence(texts, literals - indexed)
+    for literal, found in index.postings(indexed).items():
+        presence[literal] = np.isin(row_ids, found)
+    return presence
+
+
+def rule_mask(texts: pd.Series, rules: Dict[str, str], rows: np.ndarray, presence: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Evaluate a set of rules column by column and pack the hits into one integer per row.
+
+    A rule's regex only runs, through Series.str.contains, on selected rows containing
+    one of its required literals.
+
+    Args:
+        texts: Series of preprocessed text
+        rules: Dictionary of rule names to patterns; bit i is set when the i-th rule matches
+        rows: Boolean array selecting the rows to evaluate; other rows get 0
+        presence: Literal lookups from literal_presence
+
+    Returns:
+        Array of int64 bitmasks
+    """
+    mask = np.zeros(len(texts), dtype=np.int64)
+
+    for bit, pattern in enumerate(rules.values()):
+        candidates = rows.copy()
+        literals = required_literals(pattern)
+        if literals is not None:
+            candidates &= np.logical_or.reduce([presence[literal] for literal in literals])
+        if not candidates.any():
+            continue
+
+        with warnings.catch_warnings():
+            # Rule patterns use groups for alternation only; pandas warns that they are not extracted
+            warnings.filterwarnings('ignore', 'This pattern is interpreted as a regular expression, and has match groups')
+            hits = texts[candidates].str.contains(re.compile(pattern), regex=True).to_numpy(dtype=bool)
+        mask[np.flatnonzero(candidates)[hits]] |= 1 << bit
+
+    return mask
+
+
+def rule_names_for_mask(rules: Dict[str, str], mask: int) -> List[str]:
+    """
+    Rule names whose bits are set in mask, in rule order.
+
+    Args:
+        rules: Dictionary of rule names to patterns
+        mask: Bitmask as produced by rule_mask
+
+    Returns:
+        List of rule names
+    """
+    return [name for bit, name in enumerate(rules) if mask >> bit & 1]
+
+
+def classify_all_flags_vectorized(new_inspections_citations: pd.DataFrame, flag_names: Optional[List[str]] = None,
+                                  classifier: Optional[MultiFlagClassifier] = None,
+                                  index: Optional[NarrativeIndex] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Columnar equivalent of classify_all_flags for large inputs such as full-history reflags.
+
+    Narratives are normalized once, each rule becomes a boolean column computed with
+    Series.str.contains, and the flag, explanation and matched-rule columns are derived
+    from per-row rule bitmasks. Output is identical to the 'python' engine.
+
+    Args:
+        new_inspections_citations: DataFrame containing narratives to classify
+        flag_names: Flags to evaluate (defaults to every registered flag)
+        classifier: Already built classifier to reuse; flag_names is ignored when given
+        index: Narrative index to add the narratives to and to look required literals up in
+
+    Returns:
+        Dictionary mapping each flag name to its classified DataFrame
+    """
+    if classifier is None:
+        classifier = MultiFlagClassifier(flag_names)
+
+    texts = preprocess_series(new_inspections_citations['narrative']).reset_index(drop=True)
+    has_text = (texts != "").to_numpy()
+
+    literals = set()
+    for flag_classifier in classifier.classifiers.values():
+        for pattern in {**flag_classifier.positive_rules, **flag_classifier.negative_rules}.values():
+            literals |= required_literals(pattern) or set()
+    presence = index_presence(index, texts, literals) if index is not None else literal_presence(texts, literals)
+
+    classified = {}
+    for name, flag_classifier in classifier.classifiers.items():
+        positive_mask = rule_mask(texts, flag_classifier.positive_rules, has_text, presence)
+        negative_mask = rule_mask(texts, flag_classifier.negative_rules, positive_mask != 0, presence)
+
+        # Every distinct (positive, negative) combination maps to one classification result
+        keys = pd.Series((positive_mask << len(flag_classifier.negative_rules)) | negative_mask)
+        keys[~has_text] = -1
+        results = {}
+        for key in keys.unique():
+            if key == -1:
+                results[key] = flag_classifier.apply_rules_preprocessed("")
+            else:
+                results[key] = flag_classifier.build_result(
+                    rule_names_for_mask(flag_classifier.positive_rules, key >> len(flag_classifier.negative_rules)),
+                    rule_names_for_mask(flag_classifier.negative_rules, key & ((1 << len(flag_classifier.negative_rules)) - 1)),
+                )
+
+        results_df = new_inspections_citations.copy()
+        results_df[FLAG_DEFINITIONS[name]['flag_column']] = keys.map({k: r['classification'] for k, r in results.items()}).to_numpy()
+        results_df['classification_explanation'] = keys.map({k: r['explanation'] for k, r in results.items()}).to_numpy()
+        results_df['matched_positive_rules'] = keys.map({k: r['matched_positive'] for k, r in results.items()}).to_numpy()
+        results_df['matched_negative_rules'] = keys.map({k: r['matched_negative'] for k, r in results.items()}).to_numpy()
+        classified[name] = results_df
+
+    return classified
+
+
+# Per-process state for pool workers, set up once by _init_worker
+_worker_state = {}
+
+
+def _init_worker(flag_names: Optional[List[str]], engine: str, cache_path: Optional[str] = None,
+                 budget: Optional[float] = None, index_path: Optional[str] = None):
+    """
+    Build the classifier once per worker process instead of pickling it with every task.
+
+    Args:
+        flag_names: Flags to evaluate
+        engine: Classification engine, one of ENGINES
+        cache_path: Classification cache file to open in the worker, if any
+        budget: Seconds the rules may spend on one narrative, None for no limit
+        index_path: Narrative index file to open in the worker, if any
+    """
+    _worker_state['classifier'] = MultiFlagClassifier(flag_names, budget)
+    _worker_state['engine'] = engine
+    _worker_state['cache'] = ClassificationCache(cache_path, flag_names) if cache_path else None
+    _worker_state['index'] = NarrativeIndex(index_path) if index_path else None
+
+
+def _classify_chunk(chunk: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Pool task: classify one chunk with the worker's classifier.
+
+    Args:
+        chunk: Rows to classify
+
+    Returns:
+        Dictionary mapping each flag name to the chunk's classified DataFrame
+    """
+    return classify_all_flags(chunk, engine=_worker_state['engine'], classifier=_worker_state['classifier'],
+                              cache=_worker_state['cache'], index=_worker_state['index'])
+
+
+def iter_chunks(df: pd.DataFrame, chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Split a DataFrame into consecutive row chunks, keeping the original index.
+
+    Args:
+        df: DataFrame to split
+        chunksize: Maximum rows per chunk
+
+    Returns:
+        Iterator over the chunks, in row order
+    """
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+def classify_chunks_in_parallel(chunks: Iterable[pd.DataFrame], flag_names: Optional[List[str]] = None, engine: str = 'python',
+                                workers: int = 1, cache_path: Optional[str] = None,
+                                classifier: Optional[MultiFlagClassifier] = None, budget: Optional[float] = None,
+                                index_path: Optional[str] = None) -> Iterator[Dict[str, pd.DataFrame]]:
+    """
+    Classify chunks in a process pool and yield the results in input order.
+
+    At most two chunks per worker are submitted ahead of the one being yielded, so
+    memory is bounded by the chunks in flight rather than by the size of the input.
+
+    Args:
+        chunks: DataFrames to classify, in order
+        flag_names: Flags to evaluate (defaults to every registered flag)
+        engine: Classification engine, one of ENGINES
+        workers: Number of worker processes
+        cache_path: Classification cache file to use, if any
+        classifier: Already built classifier to reuse when workers is 1
+        budget: Seconds the rules may spend on one narrative, None for no limit
+        index_path: Narrative index file to use, if any
+
+    Returns:
+        Iterator over per-chunk dictionaries mapping each flag name to its classified DataFrame
+    """
+    if workers <= 1:
+        classifier = classifier or MultiFlagClassifier(flag_names, budget)
+        cache = ClassificationCache(cache_path, flag_names) if cache_path else None
+        index = NarrativeIndex(index_path) if index_path else None
+        for chunk in chunks:
+            yield classify_all_flags(chunk, engine=engine, classifier=classifier, cache=cache, index=index)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(flag_names, engine, cache_path, budget, index_path)) as executor:
+        in_flight = deque()
+        for chunk in chunks:
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(_classify_chunk, chunk))
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def classify_all_flags_parallel(new_inspections_citations: pd.DataFrame, flag_names: Optional[List[str]] = None, engine: str = 'python',
+                                workers: int = 1, chunksize: int = DEFAULT_CHUNKSIZE, cache_path: Optional[str] = None,
+                                classifier: Optional[MultiFlagClassifier] = None, budget: Optional[float] = None,
+                                index_path: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Classify a large DataFrame in chunks across a process pool, e.g. for a full-corpus reflag.
+
+    Args:
+        new_inspections_citations: DataFrame containing narratives to classify
+        flag_names: Flags to evaluate (defaults to every registered flag)
+        engine: Classification engine, one of ENGINES
+        workers: Number of worker processes
+        chunksize: Rows per task
+        cache_path: Classification cache file to use, if any
+        classifier: Already built classifier to reuse when the rows are classified in this process
+        budget: Seconds the rules may spend on one narrative, None for no limit
+        index_path: Narrative index file to use, if any
+
+    Returns:
+        Dictionary mapping each flag name to its classified DataFrame, in the original row order
+    """
+    if workers <= 1 or len(new_inspections_citations) <= chunksize:
+        classifier = classifier or MultiFlagClassifier(flag_names, budget)
+        cache = ClassificationCache(cache_path, flag_names) if cache_path else None
+        index = NarrativeIndex(index_path) if index_path else None
+        return classify_all_flags(new_inspections_citations, engine=engine, classifier=classifier, cache=cache, index=index)
+
+    parts = {}
+    chunks = iter_chunks(new_inspections_citations, chunksize)
+    for classified in classify_chunks_in_parallel(chunks, flag_names, engine, workers, cache_path, budget=budget,
+                                                  index_path=index_path):
+        for name, classified_df in classified.items():
+            parts.setdefault(name, []).append(classified_df)
+
+    return {name: pd.concat(frames) for name, frames in parts.items()}
+
+
+def classify_inspection_narratives(new_inspections_citations: pd.DataFrame, flag_name: str, engine: str = 'python') -> pd.DataFrame:
+    """
+    Apply one flag's classification rules to a DataFrame of inspection narratives.
+
+    Args:
+        new_inspections_citations: DataFrame containing narratives to classify
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+        engine: Classification engine, one of ENGINES
+
+    Returns:
+        DataFrame with classification results added
+    """
+    return classify_all_flags(new_inspections_citations, [flag_name], engine)[flag_name]
+
+
+def get_output_path(flag_name: str, output_format: str = 'csv') -> str:
+    """
+    Path of the initial_flagged file written for a flag.
+
+    Args:
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+        output_format: 'csv' or 'parquet'
+
+    Returns:
+        Path to the flag's initial_flagged file
+    """
+    return os.path.join(FLAGGING_PROCESS_DIR, flag_name, f'initial_flagged.{output_format}')
+
+
+def select_batches(manifest: BatchManifest, flag_names: List[str], pending: bool = False) -> List[str]:
+    """
+    New rows batches to classify, looked up in the batch manifest.
+
+    Args:
+        manifest: Manifest of the new rows batches
+        flag_names: Flags being run
+        pending: Every batch not yet processed by all of flag_names, instead of only the latest batch
+
+    Returns:
+        List of batch paths, oldest first
+    """
+    batches = manifest.pending(flag_names) if pending else [manifest.latest()]
+    return [manifest.full_path(batch) for batch in batches]
+
+
+def write_pending_changes(manifest: BatchManifest, batch_paths: List[str]) -> Optional[str]:
+    """
+    Write the combined changes of batches classified together to PENDING_CHANGES_FILE.
+
+    Each batch's changes file has batch_row positions in that batch alone, so it no
+    longer matches the rows of an output covering several batches. Any previous
+    combined file is removed first.
+
+    Args:
+        manifest: Manifest of the new rows batches
+        batch_paths: Batch paths, in the order they are classified
+
+    Returns:
+        PENDING_CHANGES_FILE, or None if none of the batches has changes
+    """
+    names = [os.path.basename(path) for path in batch_paths]
+    batches = {batch['path']: batch for batch in manifest.batches}
+    changes = manifest.combine_changes([batches[name] for name in names])
+    if os.path.exists(PENDING_CHANGES_FILE):
+        os.remove(PENDING_CHANGES_FILE)
+    if changes is None:
+        return None
+    changes.to_csv(PENDING_CHANGES_FILE, index=False)
+    print(f"Changes file path: {PENDING_CHANGES_FILE}")
+    return PENDING_CHANGES_FILE
+
+
+class SanityCheck:
+    """
+    Running flag counts and a few flagged examples, accumulated chunk by chunk.
+    """
+
+    def __init__(self, flag_name: str, max_examples: int = 5):
+        self.flag_name = flag_name
+        self.flag_column = FLAG_DEFINITIONS[flag_name]['flag_column']
+        self.max_examples = max_examples
+        self.total = 0
+        self.flagged = 0
+        self.examples = []
+
+    def update(self, classified_df: pd.DataFrame):
+        """
+        Add a classified DataFrame (or chunk of one) to the counts.
+
+        Args:
+            classified_df: DataFrame returned by the classifier
+        """
+        is_flagged = classified_df[self.flag_column] == 1
+        self.total += len(classified_df)
+        self.flagged += int(is_flagged.sum())
+
+        needed = self.max_examples - len(self.examples)
+        if needed > 0:
+            self.examples.extend(row for _, row in classified_df[is_flagged].head(needed).iterrows())
+
+    def print(self):
+        """
+        Print the counts and examples.
+        """
+        print("----------------------------------------------------------------------------")
+        print(f"Sanity Check for '{self.flag_name}':")
+        print()
+        print(f"Total records: {self.total}")
+        print(f"Records flagged: {self.flagged}")
+        if self.total:
+            print(f"Percentage flagged: {(self.flagged / self.total * 100):.2f}%")
+        print("----------------------------------------------------------------------------")
+
+        # Print a few examples of flagged records
+        print("\nExample Matched Records:")
+        for row in self.examples:
+            print(f"Narrative: {row['narrative'][:200]}...")
+            print(f"Matched Rules: {row['matched_positive_rules']}")
+            print(f"Classification Explanation: {row['classification_explanation']}")
+        print()
+
+
+def print_sanity_check(classified_df: pd.DataFrame, flag_name: str):
+    """
+    Print flag counts and a few flagged examples for a classified DataFrame.
+
+    Args:
+        classified_df: DataFrame returned by the classifier
+        flag_name: Key of the flag in FLAG_DEFINITIONS
+    """
+    sanity_check = SanityCheck(flag_name)
+    sanity_check.update(classified_df)
+    sanity_check.print()
+
+
+def start_profiling(flag_names: List[str], engine: str, workers: int, budget: Optional[float] = None,
+                    cache_path: Optional[str] = None, index_path: Optional[str] = None) -> Tuple[MultiFlagClassifier, 'RunMetrics']:
+    """
+    Build a classifier whose rules record their cost and hits, for --profile.
+
+    Args:
+        flag_names: Flags to run
+        engine: Classification engine; rules are timed one by one only by the 'python' engine
+        workers: Number of worker processes; rules are timed only in this process
+        budget: Seconds the rules may spend on one narrative, None for no limit
+        cache_path: Classification cache file of the run, which profiling cannot be combined with
+        index_path: Narrative index file of the run, which profiling cannot be combined with
+
+    Returns:
+        Tuple of the instrumented classifier and the metrics it records into
+    """
+    if engine != 'python' or workers > 1:
+        raise ValueError("--profile times rules one by one: use it with --engine python and --workers 1")
+    if cache_path or index_path:
+        # Cached narratives, and with the index narratives lacking every required literal, never reach the rules
+        raise ValueError("--profile times the rules on every narrative: use it without --cache and --index")
+
+    # rule_metrics builds on this module, so it is imported only when needed
+    from rule_metrics import RunMetrics
+    classifier = MultiFlagClassifier(flag_names, budget)
+    return classifier, RunMetrics(classifier)
+
+
+def quarantined_rows(classified: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Input rows that ran over the narrative budget for any flag.
+
+    Args:
+        classified: Dictionary mapping each flag name to its classified DataFrame
+
+    Returns:
+        The quarantined rows, with the input columns only
+    """
+    flag_name, first_df = next(iter(classified.items()))
+    quarantined = np.zeros(len(first_df), dtype=bool)
+    for classified_df in classified.values():
+        quarantined |= (classified_df['classification_explanation'] == QUARANTINE_EXPLANATION).to_numpy()
+
+    added_columns = [FLAG_DEFINITIONS[flag_name]['flag_column'], 'classification_explanation',
+                     'matched_positive_rules', 'matched_negative_rules']
+    return first_df.loc[quarantined].drop(columns=added_columns)
+
+
+def write_quarantine(quarantined: List[pd.DataFrame]):
+    """
+    Write the rows quarantined by this run to QUARANTINE_FILE, replacing those of the previous run.
+
+    Args:
+        quarantined: DataFrames of quarantined rows, e.g. one per chunk
+    """
+    quarantined = [df for df in quarantined if len(df)] or quarantined[:1]
+    pd.concat(quarantined).to_csv(QUARANTINE_FILE, index=False)
+    rows = sum(len(df) for df in quarantined)
+    if rows:
+        print(f"{rows} rows ran over the narrative budget and were quarantined to {QUARANTINE_FILE}")
+    else:
+        print("No rows ran over the narrative budget")
+    print()
+
+
+def build_argument_parser(description: str) -> argparse.ArgumentParser:
+    """
+    Command line options shared by the flag scripts.
+
+    Args:
+        description: Description shown by --help
+
+    Returns:
+        Argument parser
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--engine', choices=ENGINES, default='python',
+                        help="'python' matches row by row; 'vectorized' uses pandas string operations, faster on full-history reflags")
+    parser.add_argument('--input', default=None,
+                        help="CSV to classify, e.g. the full upstream inspections-citations.csv for a reflag (defaults to the latest new rows batch)")
+    parser.add_argument('--pending', action='store_true',
+                        help="Classify every new rows batch these flags have not processed yet, in one output, instead of only the latest")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes to classify with")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help="Rows per task when --workers is above 1, and rows per read with --stream")
+    parser.add_argument('--stream', action='store_true',
+                        help="Read, classify and write the input chunk by chunk so memory stays flat however large it is")
+    parser.add_argument('--diff-against', default=None, metavar='OLD_DEFINITIONS',
+                        help="Instead of flagging, report rows whose flags change between this older flag_definitions.py and the current rules")
+    add_lookup_arguments(parser)
+    parser.add_argument('--profile', action='store_true',
+                        help="Record time, calls and hits per rule and time per stage, written to metrics.json and metrics.prom next to each flag's output")
+    parser.add_argument('--store', nargs='?', const=DEFAULT_STORE_PATH, default=None,
+                        help=f"Also upsert the classified rows and their flags into a SQLite citation store (default file {DEFAULT_STORE_PATH})")
+    parser.add_argument('--narrative-budget', type=float, default=None, metavar='SECONDS',
+                        help=f"Stop evaluating the rules on a narrative after this many seconds, flag it 0 and list its row in {QUARANTINE_FILE}")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+                        help="Write initial_flagged as CSV, or as Parquet (needs pyarrow; not with --stream)")
+    parser.add_argument('--compact', action='store_true',
+                        help="Write one rule_hits bitmask per row instead of the explanation and matched rule columns, "
+                             "with the rule names in rules.json; render them with compact_results.py expand")
+    return parser
+
+
+def run_flags(flag_names: Optional[List[str]] = None, engine: str = 'python', input_file: Optional[str] = None,
+              workers: int = 1, chunksize: int = DEFAULT_CHUNKSIZE, output_format: str = 'csv',
+              pending: bool = False, cache_path: Optional[str] = None, profile: bool = False,
+              budget: Optional[float] = None, store_path: Optional[str] = None,
+              index_path: Optional[str] = None, compact: bool = False,
+              input_df: Optional[pd.DataFrame] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Read the input once, classify it for every flag and write each flag's output.
+
+    Without input_file, the input comes from the batch manifest, and the batches are
+    recorded there as processed by these flags once the outputs are written. A caller
+    already holding the input, like pipeline.py, passes it as input_df instead.
+
+    Args:
+        flag_names: Flags to run (defaults to every registered flag)
+        engine: Classification engine, one of ENGINES
+        input_file: CSV or Parquet table to classify (defaults to the latest new rows batch)
+        workers: Number of worker processes
+        chunksize: Rows per task when workers is above 1
+        output_format: Format of the initial_flagged files, one of OUTPUT_FORMATS
+        pending: Without input_file, classify every batch not yet processed by these flags
+        cache_path: Classification cache file to use, if any
+        profile: Write per-rule and per-stage metrics next to each flag's output
+        budget: Seconds the rules may spend on one narrative; rows running over are quarantined
+        store_path: SQLite citation store to upsert the classified rows into, if any
+        index_path: Narrative index file to use, if any
+        compact: Write rule_hits bitmasks and a rule table instead of explanations and rule lists
+        input_df: Input already in memory, classified instead of reading input_file, which then only names it
+
+    Returns:
+        Dictionary mapping each flag name to its classified DataFrame
+    """
+    if flag_names is None:
+        flag_names = list(FLAG_DEFINITIONS)
+    if compact:
+        # compact_results builds on this module, so it is imported only when needed
+        from compact_results import compact_frame, write_rule_table
+
+    classifier, metrics = start_profiling(flag_names, engine, workers, budget, cache_path, index_path) if profile else (None, None)
+    stage = metrics.stage if metrics else lambda name: contextlib.nullcontext()
+
+    manifest = None
+    if input_df is not None:
+        input_files = []
+        print(f"Classifying {input_file or 'the input'} from memory")
+    elif input_file is None:
+        manifest = BatchManifest(NEW_ROWS_DIR)
+        input_files = select_batches(manifest, flag_names, pending)
+        if not input_files:
+            print("No pending batches")
+            return {}
+        if len(input_files) > 1:
+            write_pending_changes(manifest, input_files)
+    else:
+        input_files = [input_file]
+
+    for file_path in input_files:
+        print(f"Reading file: {file_path}")
+    print()
+
+    with stage('read'):
+        if input_df is not None:
+            new_inspections_citations = input_df
+        elif len(input_files) == 1:
+            new_inspections_citations = read_table(input_files[0])
+        else:
+            new_inspections_citations = pd.concat([read_table(file_path) for file_path in input_files], ignore_index=True)
+
+    with stage('classify'):
+        classified = classify_all_flags_parallel(new_inspections_citations, flag_names, engine, workers, chunksize,
+                                                 cache_path, classifier, budget, index_path)
+
+    if budget:
+        write_quarantine([quarantined_rows(classified)])
+
+    for flag_name, classified_df in classified.items():
+        output_file = get_output_path(flag_name, output_format)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with stage('write'):
+            if compact:
+                write_table(compact_frame(classified_df, flag_name), output_file)
+                write_rule_table(flag_name, os.path.dirname(output_file))
+            else:
+                write_table(classified_df, output_file)
+        print(f"Classified data saved to {output_file}")
+        print_sanity_check(classified_df, flag_name)
+
+    if store_path:
+        store = CitationStore(store_path)
+        with stage('store'):
+            counts = store.upsert_classified(classified)
+        store.close()
+        print(f"Citation store {store_path} updated: {counts['inserted']} rows inserted, {counts['updated']} updated")
+
+    if metrics is not None:
+        for flag_name in flag_names:
+            metrics.write(flag_name, os.path.dirname(get_output_path(flag_name, output_format)))
+
+    if manifest is not None:
+        manifest.mark_flagged(input_files, flag_names)
+
+    return classified
+
+
+def stream_flags(flag_names: Optional[List[str]] = None, engine: str = 'python', input_file: Optional[str] = None,
+                 workers: int = 1, chunksize: int = DEFAULT_CHUNKSIZE, pending: bool = False,
+                 cache_path: Optional[str] = None, profile: bool = False,
+                 budget: Optional[float] = None, store_path: Optional[str] = None,
+                 index_path: Optional[str] = None, compact: bool = False) -> Dict[str, SanityCheck]:
+    """
+    Streaming run_flags: read the input in chunks, classify each chunk and append it to every flag's output.
+
+    Only the chunks being classified are held in memory. Columns are read as strings so
+    that every chunk is written back exactly as it was read, whatever types pandas would
+    have inferred for that chunk alone. Outputs are written to temporary files and moved
+    into place once the whole input has been classified.
+
+    Args:
+        flag_names: Flags to run (defaults to every registered flag)
+        engine: Classification engine, one of ENGINES
+        input_file: CSV to classify (defaults to the latest new rows batch)
+        workers: Number of worker processes
+        chunksize: Rows per chunk
+        pending: Without input_file, classify every batch not yet processed by these flags
+        cache_path: Classification cache file to use, if any
+        profile: Write per-rule and per-stage metrics next to each flag's output
+        budget: Seconds the rules may spend on one narrative; rows running over are quarantined
+        store_path: SQLite citation store to upsert the classified rows into, if any
+        index_path: Narrative index file to use, if any
+        compact: Write rule_hits bitmasks and a rule table instead of explanations and rule lists
+
+    Returns:
+        Dictionary mapping each flag name to its sanity check counts
+    """
+    if flag_names is None:
+        flag_names = list(FLAG_DEFINITIONS)
+    if compact:
+        # compact_results builds on this module, so it is imported only when needed
+        from compact_results import compact_frame, write_rule_table
+
+    classifier, metrics = start_profiling(flag_names, engine, workers, budget, cache_path, index_path) if profile else (None, None)
+    stage = metrics.stage if metrics else lambda name: contextlib.nullcontext()
+
+    manifest = None
+    if input_file is None:
+        manifest = BatchManifest(NEW_ROWS_DIR)
+        input_files = select_batches(manifest, flag_names, pending)
+        if not input_files:
+            print("No pending batches")
+            return {}
+        if len(input_files) > 1:
+            write_pending_changes(manifest, input_files)
+    else:
+        input_files = [input_file]
+
+    for file_path in input_files:
+        print(f"Streaming file: {file_path}")
+    print()
+
+    temp_files = {name: get_output_path(name) + '.tmp' for name in flag_names}
+    sanity_checks = {name: SanityCheck(name) for name in flag_names}
+
+    chunks = itertools.chain.from_iterable(
+        pd.read_csv(file_path, chunksize=chunksize, dtype=str) for file_path in input_files
+    )
+    if metrics is not None:
+        chunks = metrics.timed('read', chunks)
+    classified_chunks = classify_chunks_in_parallel(chunks, flag_names, engine, workers, cache_path, classifier, budget,
+                                                    index_path)
+    if metrics is not None:
+        # Chunks are read as the classifier pulls them; that time counts towards 'read' only
+        classified_chunks = metrics.timed('classify', classified_chunks)
+
+    store = CitationStore(store_path) if store_path else None
+    stored = {'inserted': 0, 'updated': 0}
+    quarantined = []
+    write_header = True
+    for classified in classified_chunks:
+        if budget:
+            quarantined.append(quarantined_rows(classified))
+        for flag_name, classified_df in classified.items():
+            os.makedirs(os.path.dirname(temp_files[flag_name]), exist_ok=True)
+            sanity_checks[flag_name].update(classified_df)
+            if compact:
+                classified_df = compact_frame(classified_df, flag_name)
+            with stage('write'):
+                classified_df.to_csv(temp_files[flag_name], index=False, header=write_header, mode='w' if write_header else 'a')
+        if store is not None:
+            with stage('store'):
+                counts = store.upsert_classified(classified)
+            stored['inserted'] += counts['inserted']
+            stored['updated'] += counts['updated']
+        write_header = False
+
+    if store is not None:
+        store.close()
+        print(f"Citation store {store_path} updated: {stored['inserted']} rows inserted, {stored['updated']} updated")
+
+    if quarantined:
+        write_quarantine(quarantined)
+
+    for flag_name in flag_names:
+        output_file = get_output_path(flag_name)
+        if write_header:
+            # Empty input: still publish a header-only file
+            header = pd.read_csv(input_files[0], nrows=0, dtype=str)
+            classified_df = classify_all_flags(header, [flag_name], engine)[flag_name]
+            if compact:
+                classified_df = compact_frame(classified_df, flag_name)
+            classified_df.to_csv(temp_files[flag_name], index=False)
+        os.replace(temp_files[flag_name], output_file)
+        if compact:
+            write_rule_table(flag_name, os.path.dirname(output_file))
+        print(f"Classified data saved to {output_file}")
+        sanity_checks[flag_name].print()
+
+    if metrics is not None:
+        for flag_name in flag_names:
+            metrics.write(flag_name, os.path.dirname(get_output_path(flag_name)))
+
+    if manifest is not None:
+        manifest.mark_flagged(input_files, flag_names)
+
+    return sanity_checks
+
+
+def main(flag_names: Optional[List[str]], description: str):
+    """
+    Command line entry point shared by the flag scripts.
+
+    Args:
+        flag_names: Flags the script runs (None for every registered flag)
+        description: Description shown by --help
+    """
+    parser = build_argument_parser(description)
+    args = parser.parse_args()
+
+    if args.diff_against:
+        # The comparison reads --input, or the latest batch, and takes no other option
+        ignored = [f"--{dest.replace('_', '-')}" for dest, value in vars(args).items()
+                   if dest not in ('diff_against', 'input') and value != parser.get_default(dest)]
+        if ignored:
+            parser.error(f"--diff-against cannot be combined with {', '.join(ignored)}")
+        # rule_impact builds on this module, so it is imported only when needed
+        from rule_impact import diff_flags
+        diff_flags(args.diff_against, flag_names, args.input)
+    elif args.narrative_budget and args.engine != 'python':
+        raise ValueError("--narrative-budget times narratives one by one: use it with --engine python")
+    elif args.stream:
+        if args.output_format != 'csv':
+            raise ValueError("--stream writes CSV only; convert afterwards with storage.py")
+        stream_flags(flag_names, args.engine, args.input, args.workers, args.chunksize, args.pending, args.cache, args.profile,
+                     args.narrative_budget, args.store, args.index, args.compact)
+    else:
+        run_flags(flag_names, args.engine, args.input, args.workers, args.chunksize, args.output_format, args.pending, args.cache,
+                  args.profile, args.narrative_budget, args.store, args.index, args.compact)
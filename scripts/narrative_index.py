@@ -0,0 +1,192 @@
+"""
+Persistent inverted index over preprocessed narratives.
+
+Distinct narratives are stored once, by digest, in a SQLite file with an FTS5 trigram
+index, which answers "which narratives contain this substring" from posting lists
+instead of scanning every text. The flag scripts' --index option adds each input's
+narratives as it is classified and takes the literals every rule requires from the
+index, so a rule's regex only runs on narratives containing one of them. Analysts can
+try a pattern against every narrative indexed so far with the search command.
+
+Trigrams can only look up literals of three characters or more; shorter literals are
+left to the caller.
+"""
+import argparse
+import re
+import sqlite3
+import time
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from classification_cache import text_digest
+from flag_options import DEFAULT_INDEX_PATH
+
+# Shortest literal a trigram index can look up
+MIN_LITERAL_LENGTH = 3
+
+# SQLite's default limit on host parameters per statement is 999
+QUERY_BATCH = 900
+
+
+def fts_phrase(literal: str) -> str:
+    """
+    FTS5 query matching a literal as a substring.
+    """
+    return '"' + literal.replace('"', '""') + '"'
+
+
+class NarrativeIndex:
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+
+        # Pool workers share the file; WAL lets them read while one of them writes
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS narratives (id INTEGER PRIMARY KEY, digest TEXT NOT NULL UNIQUE, text TEXT NOT NULL)'
+            )
+            # Texts are lowercased by preprocessing and rule literals are matched case-sensitively
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS narrative_terms USING fts5("
+                " text, content='narratives', content_rowid='id', tokenize='trigram case_sensitive 1')"
+            )
+
+    def add(self, texts: Dict[str, str]) -> Dict[str, int]:
+        """
+        Index the narratives not indexed yet.
+
+        Args:
+            texts: Dictionary mapping digests to preprocessed texts
+
+        Returns:
+            Dictionary mapping each digest to its narrative id in the index
+        """
+        digests = list(texts)
+        ids = {}
+        for start in range(0, len(digests), QUERY_BATCH):
+            batch = digests[start:start + QUERY_BATCH]
+            placeholders = ','.join('?' * len(batch))
+            ids.update(self.connection.execute(f'SELECT digest, id FROM narratives WHERE digest IN ({placeholders})', batch))
+
+        new = [(digest, text) for digest, text in texts.items() if digest not in ids]
+        if new:
+            with self.connection:
+                first_id = self.connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM narratives').fetchone()[0]
+                rows = [(first_id + i, digest, text) for i, (digest, text) in enumerate(new)]
+                self.connection.executemany('INSERT INTO narratives VALUES (?, ?, ?)', rows)
+                self.connection.executemany('INSERT INTO narrative_terms (rowid, text) VALUES (?, ?)',
+                                            [(row_id, text) for row_id, _, text in rows])
+            ids.update((digest, row_id) for row_id, digest, _ in rows)
+        return ids
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM narratives').fetchone()[0]
+
+    def postings(self, literals: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Ids of the indexed narratives containing each literal.
+
+        Args:
+            literals: Literals of at least MIN_LITERAL_LENGTH characters
+
+        Returns:
+            Dictionary mapping each literal to an array of narrative ids
+        """
+        return {
+            literal: np.fromiter((row[0] for row in self.connection.execute(
+                'SELECT rowid FROM narrative_terms WHERE narrative_terms MATCH ?', (fts_phrase(literal),))), dtype=np.int64)
+            for literal in literals
+        }
+
+    def search(self, pattern: str, exclude: Optional[str] = None) -> pd.DataFrame:
+        """
+        Indexed narratives matching a pattern, regex-checking only those containing its required literals.
+
+        Args:
+            pattern: Regex, as a positive rule would be written
+            exclude: Regex whose matches are left out, as a negative rule would be written
+
+        Returns:
+            DataFrame with the digest and text of each matching narrative
+        """
+        # required_literals lives in the flagging engine, which builds on this module
+        from flagging_engine import required_literals
+
+        literals = required_literals(pattern)
+        if literals is not None and all(len(literal) >= MIN_LITERAL_LENGTH for literal in literals):
+            query = ' OR '.join(fts_phrase(literal) for literal in sorted(literals))
+            candidates = self.connection.execute(
+                'SELECT narratives.digest, narratives.text FROM narrative_terms '
+                'JOIN narratives ON narratives.id = narrative_terms.rowid WHERE narrative_terms MATCH ?', (query,))
+        else:
+            candidates = self.connection.execute('SELECT digest, text FROM narratives')
+
+        compiled = re.compile(pattern)
+        excluded = re.compile(exclude) if exclude else None
+        return pd.DataFrame(
+            [(digest, text) for digest, text in candidates
+             if compiled.search(text) and not (excluded and excluded.search(text))],
+            columns=['digest', 'narrative'],
+        )
+
+    def close(self):
+        """
+        Close the SQLite connection.
+        """
+        self.connection.close()
+
+
+def build_index(index_path: str, file_paths: Iterable[str], chunksize: int = 100000):
+    """
+    Add every narrative of some CSVs, e.g. the upstream history, to the index.
+
+    Args:
+        index_path: Index file (created if missing)
+        file_paths: CSVs with a narrative column
+        chunksize: Rows read at a time
+    """
+    from flagging_engine import preprocess_series
+
+    index = NarrativeIndex(index_path)
+    for file_path in file_paths:
+        for chunk in pd.read_csv(file_path, usecols=['narrative'], chunksize=chunksize, dtype=str):
+            texts = preprocess_series(chunk['narrative'])
+            index.add({text_digest(text): text for text in texts.unique() if text})
+        print(f"Indexed the narratives of {file_path}; {len(index)} distinct narratives in {index_path}")
+    index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and search the inverted index over preprocessed narratives.")
+    parser.add_argument('--index_path', default=DEFAULT_INDEX_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Add the narratives of some CSVs, e.g. the upstream history, to the index")
+    build_parser.add_argument('file_paths', nargs='+')
+
+    search_parser = subparsers.add_parser('search', help="Try a rule pattern against every indexed narrative")
+    search_parser.add_argument('pattern', help="Regex matched against lowercased, space-normalized narratives")
+    search_parser.add_argument('--exclude', default=None, help="Regex whose matches are left out, like a negative rule")
+    search_parser.add_argument('--limit', type=int, default=10, help="Matching narratives to print")
+    search_parser.add_argument('--csv_path', default=None, help="Write every matching narrative to this CSV")
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_index(args.index_path, args.file_paths)
+    else:
+        index = NarrativeIndex(args.index_path)
+        start = time.perf_counter()
+        matches = index.search(args.pattern, args.exclude)
+        seconds = time.perf_counter() - start
+        total = len(index)
+        index.close()
+
+        print(f"{len(matches)} of {total} indexed narratives match ({seconds:.2f}s)")
+        for text in matches['narrative'].head(args.limit):
+            print(f"  - {text[:200]}")
+        if args.csv_path:
+            matches.to_csv(args.csv_path, index=False)
+            print(f"Matching narratives saved to {args.csv_path}")
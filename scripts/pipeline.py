@@ -0,0 +1,159 @@
+"""
+The nightly run in one process: extract the new rows, flag them and append them to the published outputs.
+
+The workflow used to start a Python process per step, each importing pandas and
+re-reading what the step before had just written. Here the new rows batch is passed
+to the flags in memory, and every module is imported only once its stage starts, so
+--help and a run where upstream has not changed (with --delta) exit without loading
+pandas. extract_new_rows.py, the flag scripts and append_new_rows.py still run the
+stages one at a time.
+
+    python pipeline.py --delta
+
+The batch, changes file and initial_flagged files are still written, as the separate
+steps write them, and the time each stage took is printed at the end.
+"""
+import argparse
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from flag_definitions import FLAG_DEFINITIONS
+from flag_options import add_lookup_arguments
+from upstream_git import (COMMIT_FILE, UPSTREAM_PATH, UPSTREAM_REF, UPSTREAM_REPO, file_unchanged, read_indexed_commit,
+                          resolve_commit, write_indexed_commit)
+
+OUTPUT_DIR = '../data/output/'
+LATEST_FILE = os.path.join(OUTPUT_DIR, 'inspections_citations_latest.csv')
+NEW_ROWS_DIR = '../data/flagging_process/new_rows/'
+INDEX_FILE = '../data/flagging_process/upstream_fingerprints.tsv'
+
+# Flags with a published output under OUTPUT_DIR; the other registered flags are drafts
+PUBLISHED_FLAGS = ('extreme_temperatures', 'air_transport')
+
+
+def get_published_path(flag_name: str) -> str:
+    """
+    Published output of a flag, to which its initial_flagged rows are appended.
+    """
+    return os.path.join(OUTPUT_DIR, flag_name, f'inspections_citations_with_{flag_name}_flags.csv')
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time a stage, imports included.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self):
+        """
+        Print the time each stage took.
+        """
+        print("\nStage timings:")
+        for name, seconds in self.seconds.items():
+            print(f"  {name:<10}{seconds:8.2f}s")
+        print(f"  {'total':<10}{sum(self.seconds.values()):8.2f}s")
+
+
+def upstream_unchanged(index_file: str = INDEX_FILE, upstream_repo: str = UPSTREAM_REPO,
+                       upstream_path: str = UPSTREAM_PATH, upstream_ref: str = UPSTREAM_REF,
+                       commit_file: str = COMMIT_FILE) -> bool:
+    """
+    Whether the upstream citations file is the one the fingerprint index was built from, asking only git.
+
+    The recorded commit is moved to upstream_ref when the file is unchanged, as
+    extract_new_rows.py would do.
+    """
+    indexed_commit = read_indexed_commit(commit_file)
+    if indexed_commit is None or not os.path.exists(index_file):
+        return False
+    new_commit = resolve_commit(upstream_repo, upstream_ref)
+    if new_commit is None or not file_unchanged(upstream_repo, upstream_path, indexed_commit, new_commit):
+        return False
+    if new_commit != indexed_commit:
+        write_indexed_commit(new_commit, commit_file)
+    print(f"Citations file unchanged since upstream commit {indexed_commit}")
+    return True
+
+
+def run_pipeline(flag_names: Optional[List[str]] = None, delta: bool = False, engine: str = 'python', workers: int = 1,
+                 cache_path: Optional[str] = None, index_path: Optional[str] = None,
+                 upstream_repo: str = UPSTREAM_REPO, upstream_ref: str = UPSTREAM_REF) -> Dict[str, float]:
+    """
+    Extract, flag and append the new upstream rows in one process.
+
+    Args:
+        flag_names: Flags to run (defaults to every registered flag)
+        delta: Read the upstream changes from git history, as extract_new_rows.py --delta
+        engine: Classification engine, one of flagging_engine.ENGINES
+        workers: Number of processes to classify with
+        cache_path: Classification cache file to use, if any
+        index_path: Narrative index file to use, if any
+        upstream_repo: Upstream repository
+        upstream_ref: Upstream ref to process with delta
+
+    Returns:
+        Dictionary mapping each stage to the seconds it took
+    """
+    timer = StageTimer()
+
+    with timer.stage('extract'):
+        if delta and upstream_unchanged(upstream_repo=upstream_repo, upstream_ref=upstream_ref):
+            print("No new data")
+            batch = None
+        else:
+            from extract_new_rows import UPSTREAM_FILE, extract_batch
+            from sharded_output import published_location
+            batch = extract_batch(UPSTREAM_FILE, published_location(LATEST_FILE), NEW_ROWS_DIR, INDEX_FILE, delta,
+                                  upstream_repo=upstream_repo, upstream_ref=upstream_ref)
+    if batch is None:
+        timer.report()
+        return timer.seconds
+
+    with timer.stage('flag'):
+        from batch_manifest import BatchManifest
+        from flagging_engine import get_output_path, run_flags
+
+        flag_names = flag_names or list(FLAG_DEFINITIONS)
+        run_flags(flag_names, engine, batch['new_rows_path'], workers, cache_path=cache_path, index_path=index_path,
+                  input_df=batch['new_rows'])
+        BatchManifest(NEW_ROWS_DIR).mark_flagged([batch['new_rows_path']], flag_names)
+
+    # initial_flagged files are appended byte for byte, so they are passed by path rather than parsed again
+    with timer.stage('append'):
+        from append_new_rows import append_new_rows
+        from sharded_output import published_location
+
+        for flag_name in (name for name in flag_names if name in PUBLISHED_FLAGS):
+            published_path = published_location(get_published_path(flag_name))
+            append_new_rows(published_path, get_output_path(flag_name), published_path, batch['changes_path'])
+        latest_path = published_location(LATEST_FILE)
+        append_new_rows(latest_path, batch['new_rows_path'], latest_path, batch['changes_path'])
+
+    timer.report()
+    return timer.seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract, flag and append the new upstream rows in one process.")
+    parser.add_argument('--delta', action='store_true',
+                        help="Read only the changes since the last processed upstream commit from git history")
+    parser.add_argument('--flags', nargs='+', choices=list(FLAG_DEFINITIONS), default=None, help="Flags to run (default: every registered flag)")
+    parser.add_argument('--engine', choices=('python', 'vectorized'), default='python', help="Classification engine")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes to classify with")
+    add_lookup_arguments(parser)
+    parser.add_argument('--upstream_repo', default=UPSTREAM_REPO, help="Upstream repository")
+    parser.add_argument('--upstream_ref', default=UPSTREAM_REF, help="Upstream ref to process with --delta")
+    args = parser.parse_args()
+
+    run_pipeline(args.flags, args.delta, args.engine, args.workers, args.cache, args.index, args.upstream_repo, args.upstream_ref)
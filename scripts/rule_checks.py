@@ -0,0 +1,273 @@
+"""
+Static checks for regex shapes that backtrack catastrophically.
+
+Python's re module backtracks, so some patterns take exponential time on text they
+almost match. That happens when a repeated group can match the same text in more
+than one way: wherever the engine chooses between consuming more and moving on, such
+as a quantifier that may stop or go on, an optional alternative or the alternatives
+of a branch, a character that fits both choices makes a failing match retry every
+combination, once per iteration. The choices are compared by the characters each can
+start with, the next iteration's start included, after sre_parse has factored common
+prefixes out of alternatives. So (a|aa)*b, (\\w+\\s?)+, (x1|\\w1)* and (.*a){20} are
+rejected when a classifier loads its rules, while (\\d{1,3},)+ is not. Such a group
+repeated at most MAX_POLYNOMIAL_REPEAT times, as in (a+){2}b, and two adjacent
+unbounded quantifiers over overlapping characters, as in \\d+\\d*, are only polynomial
+and produce a warning.
+
+Run this module to check every registered flag's rules, after KNOWN_PATTERNS.
+"""
+import sys
+import warnings
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+# Characters are tracked by ASCII code, with every non-ASCII character sharing the code 128
+NON_ASCII = 128
+ANY_CHARACTER = frozenset(range(NON_ASCII + 1))
+
+REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+
+CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: frozenset(ord(c) for c in '0123456789'),
+    sre_constants.CATEGORY_SPACE: frozenset(ord(c) for c in ' \t\n\r\f\v'),
+    sre_constants.CATEGORY_WORD: frozenset(c for c in range(128) if chr(c).isalnum() or chr(c) == '_') | {NON_ASCII},
+    sre_constants.CATEGORY_LINEBREAK: frozenset({ord('\n')}),
+}
+CATEGORIES.update({
+    sre_constants.CATEGORY_NOT_DIGIT: ANY_CHARACTER - CATEGORIES[sre_constants.CATEGORY_DIGIT],
+    sre_constants.CATEGORY_NOT_SPACE: ANY_CHARACTER - CATEGORIES[sre_constants.CATEGORY_SPACE],
+    sre_constants.CATEGORY_NOT_WORD: ANY_CHARACTER - CATEGORIES[sre_constants.CATEGORY_WORD],
+    sre_constants.CATEGORY_NOT_LINEBREAK: ANY_CHARACTER - CATEGORIES[sre_constants.CATEGORY_LINEBREAK],
+})
+
+# Repetitions of an ambiguous group up to which backtracking is only polynomial, of that degree, and warned about
+MAX_POLYNOMIAL_REPEAT = 2
+
+# (severity, message), severity being 'error' or 'warning'
+Problem = Tuple[str, str]
+
+
+def _code(value: int) -> int:
+    return min(value, NON_ASCII)
+
+
+def _character_set(op, av) -> Optional[FrozenSet[int]]:
+    """
+    Characters a single-character item can match, or None if the item is not one.
+    """
+    if op == sre_constants.LITERAL:
+        return frozenset({_code(av)})
+    if op == sre_constants.NOT_LITERAL:
+        return ANY_CHARACTER - {_code(av)} | {NON_ASCII}
+    if op == sre_constants.ANY:
+        return ANY_CHARACTER
+    if op == sre_constants.IN:
+        characters = set()
+        negate = False
+        for item_op, item_av in av:
+            if item_op == sre_constants.NEGATE:
+                negate = True
+            elif item_op == sre_constants.LITERAL:
+                characters.add(_code(item_av))
+            elif item_op == sre_constants.RANGE:
+                low, high = item_av
+                characters.update(_code(c) for c in range(low, min(high, NON_ASCII) + 1))
+            elif item_op == sre_constants.CATEGORY:
+                characters |= CATEGORIES.get(item_av, ANY_CHARACTER)
+            else:
+                return ANY_CHARACTER
+        return ANY_CHARACTER - characters | {NON_ASCII} if negate else frozenset(characters)
+    return None
+
+
+def _first_characters(items) -> Tuple[FrozenSet[int], bool]:
+    """
+    Characters a sequence's matches can start with, and whether it can match the empty string.
+    """
+    first = frozenset()
+    for op, av in items:
+        characters = _character_set(op, av)
+        if characters is not None:
+            return first | characters, False
+
+        if op == sre_constants.SUBPATTERN:
+            characters, nullable = _first_characters(av[-1])
+        elif op == sre_constants.BRANCH:
+            branches = [_first_characters(branch) for branch in av[1]]
+            characters = frozenset().union(*[chars for chars, _ in branches])
+            nullable = any(branch_nullable for _, branch_nullable in branches)
+        elif op in REPEATS or op == getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+            characters, nullable = _first_characters(av[2])
+            nullable = nullable or av[0] == 0
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # Zero-width
+            continue
+        else:
+            return ANY_CHARACTER, False
+
+        first |= characters
+        if not nullable:
+            return first, False
+    return first, True
+
+
+def _split_ambiguity(items, follow: FrozenSet[int]) -> Optional[str]:
+    """
+    Why a sequence can match the same text in more than one way, or None.
+
+    At every point where the regex engine chooses between consuming more and moving
+    on (a quantifier that may stop or go on, an optional alternative, alternatives
+    of a branch), the characters each choice can start with are compared; if one
+    character fits both, a failing match retries both. Patterns are compared after
+    sre_parse has factored common prefixes out of alternatives, so (a|aa) is checked
+    as a(?:|a).
+
+    Args:
+        items: Parsed sequence
+        follow: Characters that can come right after the sequence
+
+    Returns:
+        Description of the first ambiguous choice found, None if there is none
+    """
+    for index, (op, av) in enumerate(items):
+        rest, rest_nullable = _first_characters(items[index + 1:])
+        item_follow = rest | follow if rest_nullable else rest
+
+        if op in REPEATS:
+            minimum, maximum, body = av
+            body_first = _first_characters(body)[0]
+            if minimum != maximum and body_first & item_follow:
+                return "a quantifier can stop or go on with the same character"
+            # Another iteration of the body may follow the body itself
+            reason = _split_ambiguity(body, item_follow | body_first if maximum > 1 else item_follow)
+        elif op == sre_constants.SUBPATTERN:
+            reason = _split_ambiguity(av[-1], item_follow)
+        elif op == sre_constants.BRANCH:
+            alternatives = [_first_characters(alternative) for alternative in av[1]]
+            starts = [characters for characters, _ in alternatives]
+            if any(starts[i] & starts[j] for i in range(len(starts)) for j in range(i + 1, len(starts))):
+                return "alternatives can start with the same character"
+            if any(nullable for _, nullable in alternatives) and frozenset().union(*starts) & item_follow:
+                return "an alternative can match nothing or go on with the same character"
+            reason = next(filter(None, (_split_ambiguity(alternative, item_follow) for alternative in av[1])), None)
+        else:
+            # Single characters and zero-width items leave no choice; atomic groups and possessive quantifiers never revisit theirs
+            reason = None
+
+        if reason:
+            return reason
+    return None
+
+
+def _check_sequence(items, problems: List[Problem]):
+    """
+    Walk a parsed sequence, recording problems.
+    """
+    previous_unbounded = None
+    for op, av in items:
+        if op in REPEATS:
+            minimum, maximum, body = av
+            unbounded = maximum == sre_constants.MAXREPEAT
+
+            # Each iteration that can split the text several ways multiplies the ways the whole match can
+            if maximum > 1:
+                reason = _split_ambiguity(body, _first_characters(body)[0])
+                if reason and unbounded:
+                    problems.append(('error', f"repeated group can match the same text in more than one way ({reason}), "
+                                              "so it can backtrack exponentially"))
+                elif reason and maximum > MAX_POLYNOMIAL_REPEAT:
+                    problems.append(('error', f"repeated group can match the same text in more than one way ({reason}), "
+                                              f"so {maximum} repetitions can backtrack as a polynomial of degree {maximum}"))
+                elif reason:
+                    problems.append(('warning', f"repeated group can match the same text in more than one way ({reason}); "
+                                                f"at most {maximum} repetitions backtrack polynomially"))
+
+            if unbounded:
+                characters = _first_characters(body)[0]
+                if previous_unbounded is not None and previous_unbounded & characters:
+                    problems.append(('warning', "adjacent unbounded quantifiers over overlapping characters backtrack quadratically"))
+                previous_unbounded = characters
+            else:
+                previous_unbounded = None
+
+            _check_sequence(body, problems)
+            continue
+
+        previous_unbounded = None
+        if op == sre_constants.SUBPATTERN:
+            _check_sequence(av[-1], problems)
+        elif op == sre_constants.BRANCH:
+            for alternative in av[1]:
+                _check_sequence(alternative, problems)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _check_sequence(av[1], problems)
+        # Atomic groups and possessive quantifiers never backtrack into their body
+
+
+def check_pattern(pattern: str) -> List[Problem]:
+    """
+    Find shapes in a pattern that make matching backtrack catastrophically.
+
+    Args:
+        pattern: Regex pattern
+
+    Returns:
+        List of (severity, message) tuples, empty if the pattern looks safe
+    """
+    problems = []
+    _check_sequence(sre_parse.parse(pattern), problems)
+    return list(dict.fromkeys(problems))
+
+
+def check_rules(rules: Dict[str, str]):
+    """
+    Check a rules dictionary before it is used: reject exponential patterns, warn about quadratic ones.
+
+    Args:
+        rules: Dictionary of rule names to patterns
+    """
+    for rule_name, pattern in rules.items():
+        for severity, message in check_pattern(pattern):
+            if severity == 'error':
+                raise ValueError(f"Rule '{rule_name}' ({pattern}): {message}")
+            warnings.warn(f"Rule '{rule_name}' ({pattern}): {message}", RuntimeWarning, stacklevel=2)
+
+
+# Patterns with a known verdict, checked first whenever the module runs: True if the pattern must be rejected
+KNOWN_PATTERNS = {
+    r'(a|aa)*b': True,
+    r'(aa|a)*b': True,
+    r'(.*a){20}': True,
+    r'(\w+\s?)+': True,
+    r'(x1|\w1)*': True,
+    r'(\d{1,3},)+': False,
+    r'(a+){2}b': False,
+    r'(a+){3}b': True,
+    r'(ab|ac)*': False,
+    r'(\w+\s+){0,3}': False,
+}
+
+
+if __name__ == "__main__":
+    from flag_definitions import FLAG_DEFINITIONS
+
+    errors = 0
+    for pattern, rejected in KNOWN_PATTERNS.items():
+        if any(severity == 'error' for severity, _ in check_pattern(pattern)) != rejected:
+            errors += 1
+            print(f"ERROR: the check {'accepts' if rejected else 'rejects'} {pattern}")
+
+    for flag_name, definition in FLAG_DEFINITIONS.items():
+        for kind in ('positive_rules', 'negative_rules'):
+            for rule_name, pattern in definition[kind].items():
+                for severity, message in check_pattern(pattern):
+                    errors += severity == 'error'
+                    print(f"{severity.upper()}: {flag_name} {kind} '{rule_name}': {message}")
+
+    print(f"Checked every rule of {len(FLAG_DEFINITIONS)} flags: {errors} error(s)")
+    sys.exit(1 if errors else 0)
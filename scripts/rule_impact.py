@@ -0,0 +1,217 @@
+"""
+Rule-impact diffs: which rows change classification when rules are edited.
+
+Every rule pattern's hits over an input are kept as a bitset in a sidecar file
+(data/flagging_process/rule_hits.npz), together with a digest of the input's
+narratives. Diffing a ruleset against an older one evaluates only the patterns that
+have no stored hits for this input, usually just the edited rule, and derives both
+the old and the new flags from the bitsets. Rows whose flag flips are written to a
+report for review.
+"""
+import hashlib
+import importlib.util
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from batch_manifest import BatchManifest
+from flag_definitions import FLAG_DEFINITIONS
+from flagging_engine import (FLAGGING_PROCESS_DIR, NEW_ROWS_DIR, RuleBasedClassifier, literal_presence, preprocess_series,
+                             required_literals, rule_mask)
+from storage import read_table
+
+RULE_HITS_FILE = os.path.join(FLAGGING_PROCESS_DIR, 'rule_hits.npz')
+
+
+def load_definitions(definitions_path: str) -> Dict[str, Dict]:
+    """
+    Load FLAG_DEFINITIONS from another copy of flag_definitions.py.
+
+    An older ruleset can be taken from history with, for example,
+    git show HEAD~1:scripts/flag_definitions.py > /tmp/old_flag_definitions.py
+
+    Args:
+        definitions_path: Path to a Python file defining FLAG_DEFINITIONS
+
+    Returns:
+        The file's FLAG_DEFINITIONS
+    """
+    spec = importlib.util.spec_from_file_location('old_flag_definitions', definitions_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.FLAG_DEFINITIONS
+
+
+def classifier_for(definitions: Dict[str, Dict], flag_name: str) -> RuleBasedClassifier:
+    """
+    Classifier for a flag in a ruleset, with no rules if the ruleset does not define the flag.
+
+    Args:
+        definitions: A FLAG_DEFINITIONS dictionary
+        flag_name: Flag to build the classifier for
+
+    Returns:
+        RuleBasedClassifier
+    """
+    definition = definitions.get(flag_name, {})
+    return RuleBasedClassifier(dict(definition.get('positive_rules', {})), dict(definition.get('negative_rules', {})))
+
+
+class RuleHits:
+    """
+    Per-pattern hit bitsets over one input, loaded from and saved to a sidecar file.
+    """
+
+    def __init__(self, texts: pd.Series, path: str = RULE_HITS_FILE):
+        self.texts = texts.reset_index(drop=True)
+        self.has_text = (self.texts != "").to_numpy()
+        self.path = path
+        self.input_digest = hashlib.blake2b('\n'.join(self.texts).encode('utf-8'), digest_size=16).hexdigest()
+        self.hits = {}
+        self.evaluated = []
+
+        if os.path.exists(path):
+            stored = np.load(path)
+            if str(stored['input_digest']) == self.input_digest:
+                patterns = json.loads(str(stored['patterns']))
+                bits = np.unpackbits(stored['bits'], axis=1, count=len(self.texts)).astype(bool)
+                self.hits = dict(zip(patterns, bits))
+
+    def ensure(self, patterns: List[str]):
+        """
+        Evaluate the patterns that have no stored hits, sharing literal scans between them.
+
+        Args:
+            patterns: Rule patterns needed
+        """
+        missing = sorted(set(patterns) - set(self.hits))
+        if not missing:
+            return
+
+        literals = set()
+        for pattern in missing:
+            literals |= required_literals(pattern) or set()
+        presence = literal_presence(self.texts, literals)
+
+        for pattern in missing:
+            self.hits[pattern] = rule_mask(self.texts, {pattern: pattern}, self.has_text, presence) != 0
+            self.evaluated.append(pattern)
+
+    def matched(self, rules: Dict[str, str]) -> np.ndarray:
+        """
+        Boolean matrix of rule hits, one column per rule in rule order.
+
+        Args:
+            rules: Dictionary of rule names to patterns
+
+        Returns:
+            Array of shape (rows, rules)
+        """
+        if not rules:
+            return np.zeros((len(self.texts), 0), dtype=bool)
+        return np.column_stack([self.hits[pattern] for pattern in rules.values()])
+
+    def save(self):
+        """
+        Write the bitsets, replacing any stored for a previous input.
+        """
+        patterns = sorted(self.hits)
+        bits = np.packbits(np.array([self.hits[pattern] for pattern in patterns]), axis=1)
+        temp_path = self.path + '.tmp.npz'
+        np.savez_compressed(temp_path, input_digest=self.input_digest, patterns=json.dumps(patterns), bits=bits)
+        os.replace(temp_path, self.path)
+
+
+def classify_from_hits(hits: RuleHits, classifier: RuleBasedClassifier) -> np.ndarray:
+    """
+    Flag values implied by stored rule hits.
+
+    Args:
+        hits: Rule hits for the input
+        classifier: Classifier whose rules to apply
+
+    Returns:
+        Array of 0/1 flags, one per row
+    """
+    positive = hits.matched(classifier.positive_rules).any(axis=1)
+    negative = hits.matched(classifier.negative_rules).any(axis=1)
+    return (positive & ~negative & hits.has_text).astype(int)
+
+
+def explain(hits: RuleHits, classifier: RuleBasedClassifier, row: int) -> str:
+    """
+    Classification explanation for one row, as the flagging engine would write it.
+
+    Args:
+        hits: Rule hits for the input
+        classifier: Classifier whose rules to apply
+        row: Row position
+
+    Returns:
+        Explanation string
+    """
+    if not hits.has_text[row]:
+        return classifier.apply_rules_preprocessed("")['explanation']
+    matched_positive = [name for name, pattern in classifier.positive_rules.items() if hits.hits[pattern][row]]
+    matched_negative = [name for name, pattern in classifier.negative_rules.items() if hits.hits[pattern][row]] if matched_positive else []
+    return classifier.build_result(matched_positive, matched_negative)['explanation']
+
+
+def diff_flags(old_definitions_path: str, flag_names: Optional[List[str]] = None,
+               input_file: Optional[str] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Report the rows whose flags change between an older ruleset and the current one.
+
+    Each flag's report of flipped rows is written to data/flagging_process/<flag>/rule_impact.csv.
+
+    Args:
+        old_definitions_path: Python file defining the older FLAG_DEFINITIONS
+        flag_names: Flags to compare (defaults to every registered flag)
+        input_file: CSV or Parquet table to compare on (defaults to the latest new rows batch)
+
+    Returns:
+        Dictionary mapping each flag name to its report
+    """
+    if flag_names is None:
+        flag_names = list(FLAG_DEFINITIONS)
+    if input_file is None:
+        manifest = BatchManifest(NEW_ROWS_DIR)
+        input_file = manifest.full_path(manifest.latest())
+    print(f"Reading file: {input_file}")
+    print()
+
+    old_definitions = load_definitions(old_definitions_path)
+    df = read_table(input_file).reset_index(drop=True)
+    hits = RuleHits(preprocess_series(df['narrative']))
+
+    classifiers = {}
+    for flag_name in flag_names:
+        classifiers[flag_name] = (classifier_for(old_definitions, flag_name), classifier_for(FLAG_DEFINITIONS, flag_name))
+        for classifier in classifiers[flag_name]:
+            hits.ensure(list(classifier.positive_rules.values()) + list(classifier.negative_rules.values()))
+    hits.save()
+    print(f"Patterns evaluated: {len(hits.evaluated)} (others reused from {hits.path})")
+
+    reports = {}
+    for flag_name, (old_classifier, new_classifier) in classifiers.items():
+        old_flags = classify_from_hits(hits, old_classifier)
+        new_flags = classify_from_hits(hits, new_classifier)
+        flipped = np.flatnonzero(old_flags != new_flags)
+
+        report = df.iloc[flipped].copy()
+        report['change'] = ['0->1' if new_flags[row] else '1->0' for row in flipped]
+        report['old_explanation'] = [explain(hits, old_classifier, row) for row in flipped]
+        report['new_explanation'] = [explain(hits, new_classifier, row) for row in flipped]
+
+        output_file = os.path.join(FLAGGING_PROCESS_DIR, flag_name, 'rule_impact.csv')
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        report.to_csv(output_file, index=False)
+        reports[flag_name] = report
+
+        print(f"{flag_name}: {int((report['change'] == '0->1').sum())} rows 0->1, "
+              f"{int((report['change'] == '1->0').sum())} rows 1->0; report saved to {output_file}")
+
+    return reports
@@ -0,0 +1,262 @@
+"""
+Opt-in per-rule profiling for flag runs.
+
+RunMetrics swaps a MultiFlagClassifier's matchers for ProfilingRuleMatchers, which
+time every regex search and count calls, prefilter skips and hits per rule, keeping
+the slowest narratives for each. Together with the wall and CPU time of each stage
+of the run (reading, classifying, writing), the metrics are written next to each
+flag's output as metrics.json and as Prometheus text in metrics.prom.
+"""
+import heapq
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional
+
+from flagging_engine import MultiFlagClassifier, RuleMatcher
+
+# Characters of narrative kept for each of the slowest matches
+EXCERPT_LENGTH = 120
+
+
+class ProfilingRuleMatcher(RuleMatcher):
+    """
+    RuleMatcher that records what every rule costs and how often it matches.
+    """
+
+    def __init__(self, rules: Dict[Hashable, str], max_slowest: int = 5):
+        super().__init__(rules)
+        self.max_slowest = max_slowest
+        self.texts = 0
+        self.texts_matched = 0
+        self.prefilter_seconds = 0.0
+        self.calls = dict.fromkeys(self.rule_keys, 0)
+        self.skipped = dict.fromkeys(self.rule_keys, 0)
+        self.hits = dict.fromkeys(self.rule_keys, 0)
+        self.seconds = dict.fromkeys(self.rule_keys, 0.0)
+        self.slowest = {key: [] for key in self.rule_keys}
+
+    def match(self, text: str, present: Optional[set] = None) -> List[Hashable]:
+        """
+        RuleMatcher.match, timing the literal scan and each regex search.
+
+        Args:
+            text: Text to scan
+            present: Literals known to be in text; looked up in text if None
+
+        Returns:
+            Keys of the matching rules, in rule order
+        """
+        self.texts += 1
+        if present is None:
+            start = time.perf_counter()
+            present = self.present_literals(text)
+            self.prefilter_seconds += time.perf_counter() - start
+
+        matched = []
+        for key in self.rule_keys:
+            literals = self.rule_literals[key]
+            if literals is not None and literals.isdisjoint(present):
+                self.skipped[key] += 1
+                continue
+
+            start = time.perf_counter()
+            found = self.compiled[key].search(text)
+            elapsed = time.perf_counter() - start
+
+            self.calls[key] += 1
+            self.seconds[key] += elapsed
+            if len(self.slowest[key]) < self.max_slowest:
+                heapq.heappush(self.slowest[key], (elapsed, text[:EXCERPT_LENGTH]))
+            elif elapsed > self.slowest[key][0][0]:
+                heapq.heapreplace(self.slowest[key], (elapsed, text[:EXCERPT_LENGTH]))
+            if found:
+                self.hits[key] += 1
+                matched.append(key)
+
+        if matched:
+            self.texts_matched += 1
+        return matched
+
+    def rule_metrics(self, key: Hashable) -> Dict:
+        """
+        Metrics recorded for one rule.
+
+        Args:
+            key: Rule key
+
+        Returns:
+            Dictionary of counts, seconds and slowest narratives
+        """
+        return {
+            'calls': self.calls[key],
+            'skipped_by_prefilter': self.skipped[key],
+            'hits': self.hits[key],
+            'seconds': self.seconds[key],
+            'slowest': [
+                {'seconds': seconds, 'narrative': excerpt}
+                for seconds, excerpt in sorted(self.slowest[key], reverse=True)
+            ],
+        }
+
+
+class RunMetrics:
+    """
+    Per-rule and per-stage metrics for one run of a MultiFlagClassifier.
+    """
+
+    def __init__(self, classifier: MultiFlagClassifier):
+        self.classifier = classifier
+        self.stages = {}
+        # Wall and CPU time of stages nested in each running stage, which is not counted towards it
+        self.nested = []
+
+        classifier.positive_matcher = ProfilingRuleMatcher({
+            key: classifier.positive_matcher.compiled[key].pattern for key in classifier.positive_matcher.rule_keys
+        })
+        for flag_classifier in classifier.classifiers.values():
+            flag_classifier.negative_matcher = ProfilingRuleMatcher(flag_classifier.negative_rules)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a stage of the run, by wall clock and by CPU time of this process.
+
+        Time spent in stages entered while this one runs is counted only towards those.
+
+        Args:
+            name: Stage name, e.g. 'read', 'classify' or 'write'
+        """
+        nested = [0.0, 0.0]
+        self.nested.append(nested)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self.nested.pop()
+            if self.nested:
+                self.nested[-1][0] += wall
+                self.nested[-1][1] += cpu
+
+            stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            stage['wall_seconds'] += wall - nested[0]
+            stage['cpu_seconds'] += cpu - nested[1]
+
+    def timed(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        Iterate, counting the time spent producing each item towards a stage.
+
+        Args:
+            name: Stage name
+            iterable: Iterable to time, e.g. a chunked CSV reader
+
+        Returns:
+            Iterator over the same items
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def flag_metrics(self, flag_name: str) -> Dict:
+        """
+        Metrics for one flag's rules, with the run's stage timings.
+
+        Args:
+            flag_name: Key of the flag in FLAG_DEFINITIONS
+
+        Returns:
+            Dictionary ready to be written as JSON
+        """
+        positive_matcher = self.classifier.positive_matcher
+        flag_classifier = self.classifier.classifiers[flag_name]
+        negative_matcher = flag_classifier.negative_matcher
+
+        positive_rows = negative_matcher.texts
+        overridden_rows = negative_matcher.texts_matched
+        return {
+            'flag': flag_name,
+            'texts_evaluated': positive_matcher.texts,
+            'positive_rows': positive_rows,
+            'overridden_rows': overridden_rows,
+            'override_rate': overridden_rows / positive_rows if positive_rows else 0.0,
+            'prefilter_seconds': positive_matcher.prefilter_seconds,
+            'positive_rules': {
+                rule_name: positive_matcher.rule_metrics((flag_name, rule_name))
+                for rule_name in flag_classifier.positive_rules
+            },
+            'negative_rules': {
+                rule_name: negative_matcher.rule_metrics(rule_name)
+                for rule_name in flag_classifier.negative_rules
+            },
+            'stages': self.stages,
+        }
+
+    def write(self, flag_name: str, directory: str):
+        """
+        Write a flag's metrics as metrics.json and metrics.prom in a directory.
+
+        Args:
+            flag_name: Key of the flag in FLAG_DEFINITIONS
+            directory: Directory of the flag's output
+        """
+        metrics = self.flag_metrics(flag_name)
+        with open(os.path.join(directory, 'metrics.json'), 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=2)
+            f.write('\n')
+        with open(os.path.join(directory, 'metrics.prom'), 'w', encoding='utf-8') as f:
+            f.write(to_prometheus(metrics))
+        print(f"Rule metrics saved to {os.path.join(directory, 'metrics.json')} and metrics.prom")
+
+
+def to_prometheus(metrics: Dict) -> str:
+    """
+    Render a flag's metrics in the Prometheus text exposition format.
+
+    Args:
+        metrics: Dictionary returned by RunMetrics.flag_metrics
+
+    Returns:
+        Metrics text
+    """
+    flag = metrics['flag']
+    lines = []
+
+    def family(name: str, kind: str, description: str, samples: List):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{value}"' for key, value in {'flag': flag, **labels}.items())
+            lines.append(f'{name}{{{label_text}}} {value}')
+
+    rules = [
+        ({'kind': kind, 'rule': rule_name}, rule)
+        for kind in ('positive', 'negative')
+        for rule_name, rule in metrics[f'{kind}_rules'].items()
+    ]
+    family('flag_rule_seconds_total', 'counter', 'Time spent in the rule\'s regex search.',
+           [(labels, rule['seconds']) for labels, rule in rules])
+    family('flag_rule_calls_total', 'counter', 'Regex searches run for the rule.',
+           [(labels, rule['calls']) for labels, rule in rules])
+    family('flag_rule_skipped_total', 'counter', 'Texts the literal prefilter ruled out for the rule.',
+           [(labels, rule['skipped_by_prefilter']) for labels, rule in rules])
+    family('flag_rule_hits_total', 'counter', 'Texts the rule matched.',
+           [(labels, rule['hits']) for labels, rule in rules])
+    family('flag_texts_total', 'counter', 'Non-empty narratives evaluated.', [({}, metrics['texts_evaluated'])])
+    family('flag_positive_rows_total', 'counter', 'Narratives matching a positive rule.', [({}, metrics['positive_rows'])])
+    family('flag_overridden_rows_total', 'counter', 'Positive narratives overridden by a negative rule.',
+           [({}, metrics['overridden_rows'])])
+    family('flag_stage_seconds', 'gauge', 'Wall and CPU time of each stage of the run.', [
+        ({'stage': stage, 'clock': clock}, stage_metrics[f'{clock}_seconds'])
+        for stage, stage_metrics in metrics['stages'].items()
+        for clock in ('wall', 'cpu')
+    ])
+    return '\n'.join(lines) + '\n'
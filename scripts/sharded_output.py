@@ -0,0 +1,300 @@
+"""
+Published CSV outputs split into shards by the first hex digits of hash_id.
+
+A sharded output is a directory next to where the monolithic CSV would be (e.g.
+data/output/inspections_citations_latest/ for inspections_citations_latest.csv) with
+one CSV per hash_id prefix, shard_0.csv to shard_f.csv by default, and shards.json:
+the key, the columns and each shard's path, row count, size and SHA-256. Every row
+of a hash_id lands in the same shard, in its original order, so row keys and
+occurrences are the same as in the monolithic file. Consumers read shards.json and
+fetch only the shards they need, checking them against their checksums;
+storage.read_table reads the whole directory as one table.
+
+append_new_rows.py appends to a sharded output by touching only the shards the new
+rows and changes fall in: inserted rows are appended in place to their shard with the
+usual journal, completed on the next run if interrupted, and a shard is rewritten
+only when one of its rows changed or was deleted. Only those shards are re-hashed for
+the manifest.
+
+    python sharded_output.py split ../data/output/inspections_citations_latest.csv [--prefix_length 1]
+    python sharded_output.py verify ../data/output/inspections_citations_latest
+    python sharded_output.py export ../data/output/inspections_citations_latest --csv_path latest.csv
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+from append_new_rows import (append_segment, apply_change_frames, build_segment, fsync_directory,
+                             recover_interrupted_append)
+from storage import SHARD_MANIFEST, is_sharded, read_shard_manifest
+
+SHARD_KEY = 'hash_id'
+DEFAULT_PREFIX_LENGTH = 1
+
+
+def shard_directory(csv_path: str) -> str:
+    """
+    Directory a monolithic CSV output is split into.
+    """
+    return os.path.splitext(csv_path)[0]
+
+
+def published_location(csv_path: str) -> str:
+    """
+    Where an output is published: its shard directory once it has been split, else the CSV itself.
+    """
+    directory = shard_directory(csv_path)
+    return directory if is_sharded(directory) else csv_path
+
+
+def shard_name(prefix: str) -> str:
+    """
+    File name of the shard holding the rows whose hash_id starts with prefix.
+    """
+    return f'shard_{prefix}.csv'
+
+
+def iter_records(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Group the lines of a CSV into whole records, as raw bytes.
+
+    A record ends on a line that closes every quote opened since it started, as
+    narratives can span lines.
+
+    Args:
+        lines: Lines of the CSV, with their line endings
+
+    Returns:
+        Iterator of records
+    """
+    pending = []
+    quotes = 0
+    for line in lines:
+        pending.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield b''.join(pending)
+            pending = []
+            quotes = 0
+    if pending:
+        yield b''.join(pending)
+
+
+def record_key(record: bytes, key_index: int) -> str:
+    """
+    hash_id of a raw CSV record.
+    """
+    if key_index == 0 and not record.startswith(b'"'):
+        return record.split(b',', 1)[0].decode('utf-8')
+    return next(csv.reader([record.decode('utf-8')]))[key_index]
+
+
+def shard_prefix(hash_id: str, prefix_length: int) -> str:
+    """
+    Shard of a hash_id.
+    """
+    prefix = hash_id[:prefix_length].lower()
+    if len(prefix) != prefix_length or any(c not in '0123456789abcdef' for c in prefix):
+        raise ValueError(f"Cannot shard on hash_id '{hash_id}': it does not start with {prefix_length} hex digit(s)")
+    return prefix
+
+
+def file_stats(path: str) -> Dict:
+    """
+    Row count, size and SHA-256 of a shard.
+    """
+    digest = hashlib.sha256()
+    rows = -1  # the header
+    with open(path, 'rb') as f:
+        for record in iter_records(f):
+            digest.update(record)
+            rows += 1
+    return {'rows': max(rows, 0), 'bytes': os.path.getsize(path), 'sha256': digest.hexdigest()}
+
+
+def write_manifest(directory: str, manifest: Dict):
+    """
+    Write a shard manifest, replacing the previous version atomically.
+    """
+    path = os.path.join(directory, SHARD_MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+        f.write('\n')
+    os.replace(path + '.tmp', path)
+    fsync_directory(directory)
+
+
+def split_output(csv_path: str, directory: Optional[str] = None, prefix_length: int = DEFAULT_PREFIX_LENGTH) -> str:
+    """
+    Split a monolithic CSV output into shards, streaming it once.
+
+    Args:
+        csv_path: CSV output to split
+        directory: Shard directory to create (defaults to shard_directory(csv_path))
+        prefix_length: Leading hash_id hex digits to shard on; 16 ** prefix_length shards are written
+
+    Returns:
+        The shard directory
+    """
+    directory = directory or shard_directory(csv_path)
+    os.makedirs(directory, exist_ok=True)
+    prefixes = [format(i, f'0{prefix_length}x') for i in range(16 ** prefix_length)]
+
+    with open(csv_path, 'rb') as source:
+        records = iter_records(source)
+        header = next(records)
+        columns = next(csv.reader([header.decode('utf-8')]))
+        key_index = columns.index(SHARD_KEY)
+
+        shards = {prefix: open(os.path.join(directory, shard_name(prefix)), 'wb') for prefix in prefixes}
+        try:
+            for shard in shards.values():
+                shard.write(header)
+            for record in records:
+                shards[shard_prefix(record_key(record, key_index), prefix_length)].write(record)
+        finally:
+            for shard in shards.values():
+                shard.close()
+
+    write_manifest(directory, {
+        'key': SHARD_KEY,
+        'prefix_length': prefix_length,
+        'columns': columns,
+        'shards': [{'prefix': prefix, 'path': shard_name(prefix), **file_stats(os.path.join(directory, shard_name(prefix)))}
+                   for prefix in prefixes],
+    })
+    print(f"Split {csv_path} into {len(prefixes)} shards in {directory}")
+    return directory
+
+
+def split_rows(segment: bytes, columns: List[str], prefix_length: int) -> Dict[str, bytes]:
+    """
+    Group rows to append by the shard they belong to, keeping their order.
+
+    Args:
+        segment: CSV rows without a header, from build_segment
+        columns: Columns of the rows
+        prefix_length: Manifest's prefix_length
+
+    Returns:
+        Dictionary mapping shard prefixes to their rows
+    """
+    key_index = columns.index(SHARD_KEY)
+    grouped = {}
+    for record in iter_records(segment.splitlines(keepends=True)):
+        grouped.setdefault(shard_prefix(record_key(record, key_index), prefix_length), []).append(record)
+    return {prefix: b''.join(records) for prefix, records in grouped.items()}
+
+
+def append_sharded(directory: str, new_rows_file_path: str, changes_file_path: Optional[str] = None) -> List[str]:
+    """
+    Append new rows, and apply a changes file, to a sharded output, touching only the affected shards.
+
+    Args:
+        directory: Shard directory
+        new_rows_file_path: CSV with the rows to add
+        changes_file_path: Optional changes file written by extract_new_rows.py
+
+    Returns:
+        Prefixes of the shards that were modified
+    """
+    manifest = read_shard_manifest(directory)
+    prefix_length = manifest['prefix_length']
+    columns = manifest['columns']
+    shards = {shard['prefix']: shard for shard in manifest['shards']}
+
+    changes = None
+    if changes_file_path:
+        changes = pd.read_csv(changes_file_path, dtype=str, keep_default_na=False)
+    changed_prefixes = set() if changes is None else {shard_prefix(hash_id, prefix_length) for hash_id in changes[SHARD_KEY]}
+
+    inserted = split_rows(build_segment(new_rows_file_path, columns), columns, prefix_length)
+    touched = sorted(set(inserted) | changed_prefixes)
+
+    if changed_prefixes:
+        new_rows = pd.read_csv(new_rows_file_path, dtype=str, keep_default_na=False)
+        new_rows_prefixes = new_rows[SHARD_KEY].map(lambda hash_id: shard_prefix(hash_id, prefix_length))
+        changes_prefixes = changes[SHARD_KEY].map(lambda hash_id: shard_prefix(hash_id, prefix_length))
+
+    # An append interrupted in an earlier run is completed whether or not this batch touches its shard
+    for prefix, shard in shards.items():
+        shard_path = os.path.join(directory, shard['path'])
+        if recover_interrupted_append(shard_path):
+            shard.update(file_stats(shard_path))
+
+    for prefix in touched:
+        shard_path = os.path.join(directory, shards[prefix]['path'])
+        if prefix in changed_prefixes:
+            # Changed rows point at their position in the whole batch; renumber them within the shard's rows
+            in_shard = (new_rows_prefixes == prefix).to_numpy()
+            positions = {str(row): i for i, row in enumerate(new_rows.index[in_shard])}
+            shard_changes = changes[(changes_prefixes == prefix).to_numpy()].copy()
+            shard_changes['batch_row'] = shard_changes['batch_row'].map(lambda row: positions.get(row, ''))
+            apply_change_frames(shard_path, new_rows[in_shard].reset_index(drop=True), shard_changes, shard_path)
+        else:
+            append_segment(shard_path, inserted[prefix])
+        shards[prefix].update(file_stats(shard_path))
+
+    write_manifest(directory, manifest)
+    print(f"Updated {len(touched)} of {len(shards)} shards in {directory}: {', '.join(touched) or 'none'}")
+    return touched
+
+
+def verify_output(directory: str) -> List[str]:
+    """
+    Shards whose row count or checksum differs from the manifest, or that are missing.
+    """
+    mismatched = []
+    for shard in read_shard_manifest(directory)['shards']:
+        path = os.path.join(directory, shard['path'])
+        if not os.path.exists(path) or file_stats(path) != {key: shard[key] for key in ('rows', 'bytes', 'sha256')}:
+            mismatched.append(shard['path'])
+    return mismatched
+
+
+def export_output(directory: str, output: BinaryIO):
+    """
+    Concatenate the shards into one CSV, in shard order, with a single header.
+    """
+    for i, shard in enumerate(read_shard_manifest(directory)['shards']):
+        with open(os.path.join(directory, shard['path']), 'rb') as f:
+            header = f.readline()
+            if i == 0:
+                output.write(header)
+            output.write(f.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split published CSV outputs into hash_id shards with a manifest.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split_parser = subparsers.add_parser('split', help="Split a monolithic CSV output into shards")
+    split_parser.add_argument('csv_path')
+    split_parser.add_argument('--directory', default=None, help="Shard directory (default: the CSV path without .csv)")
+    split_parser.add_argument('--prefix_length', type=int, default=DEFAULT_PREFIX_LENGTH,
+                              help="Leading hash_id hex digits to shard on (1: 16 shards, 2: 256)")
+
+    verify_parser = subparsers.add_parser('verify', help="Check every shard against the manifest's row counts and checksums")
+    verify_parser.add_argument('directory')
+
+    export_parser = subparsers.add_parser('export', help="Write the shards back out as one CSV")
+    export_parser.add_argument('directory')
+    export_parser.add_argument('--csv_path', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'split':
+        split_output(args.csv_path, args.directory, args.prefix_length)
+    elif args.command == 'verify':
+        mismatched = verify_output(args.directory)
+        if mismatched:
+            raise SystemExit(f"Shards not matching {SHARD_MANIFEST}: {', '.join(mismatched)}")
+        print(f"Every shard of {args.directory} matches {SHARD_MANIFEST}")
+    else:
+        with open(args.csv_path, 'wb') as f:
+            export_output(args.directory, f)
+        print(f"Exported {args.directory} to {args.csv_path}")
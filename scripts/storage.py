@@ -0,0 +1,259 @@
+"""
+Table storage for flagging inputs and outputs: CSV, or optionally Parquet.
+
+Parquet needs pyarrow, which is not in requirements.txt; it is imported only when a
+Parquet path is actually read or written. A Parquet table is either a single .parquet
+file or a directory holding one hive-style partition per day (date=YYYY-MM-DD/), so
+appending a day's rows writes one new file instead of rewriting the table. Low
+cardinality text columns are dictionary-encoded, and reads can be limited to a few
+columns (e.g. hash_id and the flag columns) without touching the narratives.
+
+A CSV output split by sharded_output.py is a directory with a shards.json manifest;
+read_table reads it as one table.
+"""
+import argparse
+import itertools
+import json
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from batch_manifest import BatchManifest
+
+PARQUET_EXTENSION = '.parquet'
+
+# Manifest of a sharded CSV output's directory, written by sharded_output.py
+SHARD_MANIFEST = 'shards.json'
+
+# Repeated values that compress well as dictionaries
+DICTIONARY_COLUMNS = ['code', 'kind', 'desc']
+
+
+def require_pyarrow():
+    """
+    Import pyarrow, with an actionable message if it is missing.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Parquet storage needs pyarrow: pip install pyarrow") from e
+
+
+def is_sharded(path: str) -> bool:
+    """
+    Whether a path is a CSV output split into shards by sharded_output.py.
+    """
+    return os.path.isfile(os.path.join(path, SHARD_MANIFEST))
+
+
+def read_shard_manifest(path: str) -> Dict:
+    """
+    Manifest of a sharded output: its key, columns and each shard's path, row count and checksum.
+    """
+    with open(os.path.join(path, SHARD_MANIFEST), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def is_parquet(path: str) -> bool:
+    """
+    Whether a path is a Parquet file or a partitioned Parquet directory.
+
+    Args:
+        path: File or directory path
+
+    Returns:
+        True for a .parquet path, or a directory with .parquet files under it; False
+        for anything else, an empty directory included
+    """
+    if path.endswith(PARQUET_EXTENSION):
+        return True
+    if not os.path.isdir(path) or is_sharded(path):
+        return False
+    return any(name.endswith(PARQUET_EXTENSION) for _, _, names in os.walk(path) for name in names)
+
+
+def restore_lists(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Turn list columns read back from Parquet (NumPy arrays) into Python lists, as the CSV path produces.
+
+    Args:
+        df: DataFrame read from Parquet
+
+    Returns:
+        The same DataFrame
+    """
+    for column in df.columns:
+        if df[column].dtype == object and len(df) and isinstance(df[column].iloc[0], np.ndarray):
+            df[column] = [list(value) for value in df[column]]
+    return df
+
+
+def read_table(path: str, columns: Optional[List[str]] = None, **csv_kwargs) -> pd.DataFrame:
+    """
+    Read a CSV or Parquet table, optionally only some of its columns.
+
+    Args:
+        path: CSV file, sharded CSV directory, Parquet file, or partitioned Parquet directory
+        columns: Columns to load (all if None); with Parquet, other columns are never read
+        csv_kwargs: Extra pd.read_csv arguments, ignored for Parquet
+
+    Returns:
+        DataFrame
+    """
+    if is_sharded(path):
+        shards = read_shard_manifest(path)['shards']
+        return pd.concat([pd.read_csv(os.path.join(path, shard['path']), usecols=columns, **csv_kwargs) for shard in shards],
+                         ignore_index=True)
+
+    if is_parquet(path):
+        require_pyarrow()
+        df = pd.read_parquet(path, columns=columns, engine='pyarrow')
+        # The partition key is a directory name, not a column of the flagged data
+        if 'date' in df.columns and (columns is None or 'date' not in columns):
+            df = df.drop(columns='date')
+        return restore_lists(df)
+
+    if os.path.isdir(path):
+        raise ValueError(f"{path} is a directory without {SHARD_MANIFEST} or any {PARQUET_EXTENSION} file: not a table")
+    return pd.read_csv(path, usecols=columns, **csv_kwargs)
+
+
+def to_parquet(df: pd.DataFrame, path: str):
+    """
+    Write a DataFrame as a single Parquet file, dictionary-encoding DICTIONARY_COLUMNS.
+
+    Columns pyarrow can only type as null (all missing, or lists that are all empty) are
+    written as strings, so files of the same partitioned table keep compatible schemas.
+
+    Args:
+        df: Rows to write
+        path: Destination .parquet path
+    """
+    require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+        elif pa.types.is_list(field.type) and pa.types.is_null(field.type.value_type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.list_(pa.string())))
+
+    dictionary_columns = [column for column in DICTIONARY_COLUMNS if column in df.columns]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pq.write_table(table, path, use_dictionary=dictionary_columns or False)
+
+
+def write_table(df: pd.DataFrame, path: str):
+    """
+    Write a DataFrame as CSV or Parquet, depending on the path's extension.
+
+    Args:
+        df: Rows to write
+        path: Destination path
+    """
+    if path.endswith(PARQUET_EXTENSION):
+        to_parquet(df, path)
+    else:
+        df.to_csv(path, index=False)
+
+
+def write_daily_partition(df: pd.DataFrame, dataset_dir: str, timestamp: Optional[datetime] = None) -> str:
+    """
+    Add rows to a partitioned Parquet directory as a new file in that day's partition.
+
+    Files are named after the timestamp with a counter, so that several batches
+    arriving within the same second each get their own file.
+
+    Args:
+        df: Rows to add
+        dataset_dir: Root of the partitioned table
+        timestamp: When the rows arrived (defaults to now)
+
+    Returns:
+        Path of the written file
+    """
+    timestamp = timestamp or datetime.now()
+    partition_dir = os.path.join(dataset_dir, f"date={timestamp.strftime('%Y-%m-%d')}")
+    # Hidden and without the extension, so readers skip it until it is complete
+    temp_path = os.path.join(partition_dir, f'.part-{os.getpid()}.tmp')
+    to_parquet(df, temp_path)
+    try:
+        for counter in itertools.count():
+            path = os.path.join(partition_dir, f"part-{timestamp.strftime('%Y%m%d_%H%M%S')}-{counter:04d}{PARQUET_EXTENSION}")
+            try:
+                # Unlike a rename, a link never replaces a file another append already wrote
+                os.link(temp_path, path)
+                return path
+            except FileExistsError:
+                continue
+    finally:
+        os.remove(temp_path)
+
+
+def export_csv(dataset_path: str, csv_path: str):
+    """
+    Export a Parquet table to CSV for public consumers, one partition file at a time.
+
+    Args:
+        dataset_path: Parquet file or partitioned directory
+        csv_path: Destination CSV
+    """
+    require_pyarrow()
+    import pyarrow.parquet as pq
+
+    if os.path.isdir(dataset_path):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(dataset_path)
+            for name in names if name.endswith(PARQUET_EXTENSION)
+        )
+    else:
+        files = [dataset_path]
+
+    temp_path = csv_path + '.tmp'
+    write_header = True
+    for file_path in files:
+        df = restore_lists(pq.read_table(file_path).to_pandas())
+        df.to_csv(temp_path, index=False, header=write_header, mode='w' if write_header else 'a')
+        write_header = False
+    os.replace(temp_path, csv_path)
+    print(f"Exported {len(files)} Parquet file(s) from {dataset_path} to {csv_path}")
+
+
+def convert_batches(batch_dir: str, dataset_dir: str):
+    """
+    Copy the new rows batches listed in a batch manifest into daily partitions of a Parquet table.
+
+    Args:
+        batch_dir: Directory of CSV batches, with their manifest
+        dataset_dir: Root of the partitioned table to write
+    """
+    manifest = BatchManifest(batch_dir)
+    for batch in manifest.batches:
+        df = manifest.read_batch(batch, dtype=str)
+        write_daily_partition(df, dataset_dir, datetime.fromisoformat(batch['timestamp']))
+    print(f"Converted {len(manifest.batches)} batch(es) from {batch_dir} into {dataset_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert flagging data between CSV and partitioned Parquet.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert-batches', help="Copy new rows CSV batches into daily Parquet partitions")
+    convert_parser.add_argument('--batch_dir', default='../data/flagging_process/new_rows/')
+    convert_parser.add_argument('--dataset_dir', required=True)
+
+    export_parser = subparsers.add_parser('export-csv', help="Export a Parquet table to CSV")
+    export_parser.add_argument('--dataset_path', required=True)
+    export_parser.add_argument('--csv_path', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'convert-batches':
+        convert_batches(args.batch_dir, args.dataset_dir)
+    else:
+        export_csv(args.dataset_path, args.csv_path)
@@ -0,0 +1,183 @@
+"""
+Seeded generator of synthetic inspection citations for benchmarks.
+
+Rows have the upstream hash_id,code,kind,repeat,desc,narrative columns. Narratives are
+multi-line, built from boilerplate inspection sentences, with airline, temperature and
+"responsible adult was not available" text mixed in at roughly the rates seen in the
+real new rows batches, so that rules hit about as often as they do in production.
+"""
+import argparse
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['hash_id', 'code', 'kind', 'repeat', 'desc', 'narrative']
+
+CODES = [
+    ('2.126(b)', 'ACCESS AND INSPECTION OF RECORDS AND PROPERTY; SUBMISSION OF ITINERARIES.'),
+    ('2.38(b)', 'MISCELLANEOUS.'),
+    ('2.31(c)(1)', 'INSTITUTIONAL ANIMAL CARE AND USE COMMITTEE (IACUC).'),
+    ('2.40(b)(2)', 'ATTENDING VETERINARIAN AND ADEQUATE VETERINARY CARE (DEALERS AND EXHIBITORS).'),
+    ('2.131(b)(1)', 'HANDLING OF ANIMALS.'),
+    ('3.125(a)', 'FACILITIES, GENERAL.'),
+    ('3.127(d)', 'FACILITIES, OUTDOOR.'),
+    ('3.13(c)(3)', 'CONSIGNMENTS TO CARRIERS AND INTERMEDIATE HANDLERS.'),
+    ('3.1(c)(1)', 'HOUSING FACILITIES, GENERAL.'),
+    ('3.11(a)', 'CLEANING, SANITIZATION, HOUSEKEEPING, AND PEST CONTROL.'),
+    ('3.131(a)', 'SANITATION.'),
+    ('3.162(a)(6)', 'PRIMARY ENCLOSURES USED TO TRANSPORT LIVE BIRDS.'),
+]
+KINDS = ['', 'Critical', 'Direct']
+KIND_WEIGHTS = [0.92, 0.065, 0.015]
+
+FILLER_SENTENCES = [
+    "The facility representative was informed of the findings at the exit briefing.",
+    "The licensee must ensure that all records are maintained and made available for review.",
+    "The primary enclosure housing two goats had several broken wire panels with sharp edges.",
+    "Excessive accumulations of feces and food waste were present in the outdoor pens.",
+    "The written program of veterinary care had not been updated to reflect current species.",
+    "Several bottles of medication in the treatment room were past their expiration dates.",
+    "The IACUC did not review the protocol modification before the procedure was performed.",
+    "A juvenile kangaroo was observed with a laceration on its left forelimb.",
+    "Correct by the date noted and maintain compliance going forward.",
+    "The shelter structure did not provide adequate protection from the elements.",
+    "Pest control was not adequate and rodent droppings were seen along the feed room walls.",
+    "The exhibitor sold three animals without maintaining the required acquisition records.",
+    "Fencing around the enclosure was in disrepair and could allow animals to escape.",
+    "This inspection was conducted with the facility manager.",
+]
+TEMPERATURE_SENTENCES = [
+    "The ambient temperature in the barn was recorded at 94 degrees F during the inspection.",
+    "Animals were housed outdoors during extreme cold with no supplemental heat source.",
+    "The national weather service had issued an excessive heat warning for the area.",
+]
+AIR_SENTENCES = [
+    "The shipment arrived at the airport cargo facility without the required airway bill.",
+    "The animals were held at the international terminal after the flight was delayed.",
+]
+NO_ADULT_SENTENCE = (
+    "An inspection was attempted but a responsible adult was not available to accompany aphis officials "
+    "through the facility."
+)
+
+# Share of narratives that get each kind of rule-triggering sentence
+TEMPERATURE_RATE = 0.03
+AIR_RATE = 0.01
+NO_ADULT_RATE = 0.15
+
+
+def generate_chunk(rng: np.random.Generator, rows: int) -> pd.DataFrame:
+    """
+    Generate one chunk of synthetic citations.
+
+    Args:
+        rng: Seeded random generator, advanced by the call
+        rows: Number of rows
+
+    Returns:
+        DataFrame with COLUMNS, all values strings
+    """
+    # Citations come in inspections of a few rows each, sharing a hash_id
+    starts = rng.random(rows) < 0.3
+    starts[0] = True
+    inspection = np.cumsum(starts)
+    inspection_ids = rng.integers(0, 2 ** 63, size=inspection[-1] + 1)
+    hash_ids = [f'{inspection_ids[i]:016x}' for i in inspection]
+
+    code_index = rng.integers(0, len(CODES), size=rows)
+    kinds = rng.choice(KINDS, size=rows, p=KIND_WEIGHTS)
+    repeats = np.where(rng.random(rows) < 0.06, 'True', 'False')
+
+    sentence_counts = rng.integers(2, 7, size=rows)
+    filler = rng.integers(0, len(FILLER_SENTENCES), size=(rows, 6))
+    temperature = rng.random(rows) < TEMPERATURE_RATE
+    air = rng.random(rows) < AIR_RATE
+    no_adult = rng.random(rows) < NO_ADULT_RATE
+    extra = rng.integers(0, 6, size=rows)
+
+    narratives = []
+    for row in range(rows):
+        if no_adult[row]:
+            # Half of the attempted inspections mention something else, which the no_adult rule then overrides
+            if extra[row] % 2:
+                narratives.append(NO_ADULT_SENTENCE)
+            else:
+                narratives.append(NO_ADULT_SENTENCE + '\n' + FILLER_SENTENCES[filler[row, 0]])
+            continue
+        sentences = [FILLER_SENTENCES[i] for i in filler[row, :sentence_counts[row]]]
+        if temperature[row]:
+            sentences.insert(1, TEMPERATURE_SENTENCES[extra[row] % len(TEMPERATURE_SENTENCES)])
+        if air[row]:
+            sentences.append(AIR_SENTENCES[extra[row] % len(AIR_SENTENCES)])
+        # Upstream narratives are hard-wrapped, so every narrative spans several lines
+        narratives.append('\n'.join(' '.join(sentences[i:i + 2]) for i in range(0, len(sentences), 2)))
+
+    return pd.DataFrame({
+        'hash_id': hash_ids,
+        'code': [CODES[i][0] for i in code_index],
+        'kind': kinds,
+        'repeat': repeats,
+        'desc': [CODES[i][1] for i in code_index],
+        'narrative': narratives,
+    }, columns=COLUMNS)
+
+
+def iter_synthetic_chunks(rows: int, seed: int = 0, chunksize: int = 100000) -> Iterator[pd.DataFrame]:
+    """
+    Generate a synthetic corpus chunk by chunk, so millions of rows never sit in memory at once.
+
+    Args:
+        rows: Total number of rows
+        seed: Random seed; the same seed and rows always give the same corpus
+        chunksize: Rows per chunk
+
+    Returns:
+        Iterator over DataFrames
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, chunksize):
+        yield generate_chunk(rng, min(chunksize, rows - start))
+
+
+def write_synthetic_corpus(path: str, rows: int, seed: int = 0):
+    """
+    Write a synthetic corpus as a CSV quoted like the upstream file.
+
+    Args:
+        path: Destination CSV
+        rows: Number of rows
+        seed: Random seed
+    """
+    write_header = True
+    for chunk in iter_synthetic_chunks(rows, seed):
+        chunk.to_csv(path, index=False, header=write_header, mode='w' if write_header else 'a')
+        write_header = False
+
+
+def parse_rows(value: str) -> int:
+    """
+    Parse a row count such as 10000, 10k or 1M.
+
+    Args:
+        value: Row count, optionally with a k or M suffix
+
+    Returns:
+        Number of rows
+    """
+    multipliers = {'k': 1_000, 'm': 1_000_000}
+    suffix = value[-1].lower()
+    if suffix in multipliers:
+        return int(float(value[:-1]) * multipliers[suffix])
+    return int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic inspections-citations CSV.")
+    parser.add_argument('--rows', type=parse_rows, default=10_000, help="Number of rows, e.g. 10k, 1M or 10M")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True, help="CSV to write")
+    args = parser.parse_args()
+
+    write_synthetic_corpus(args.output, args.rows, args.seed)
+    print(f"Wrote {args.rows} synthetic rows to {args.output}")
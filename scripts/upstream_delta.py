@@ -0,0 +1,354 @@
+"""
+Upstream changes read from the aphis-inspection-reports git history.
+
+Rather than parsing the whole upstream citations file, delta_changes works from git's
+diff of the file between the last processed commit and the new one:
+
+  * Each diff hunk is widened to whole CSV records (a narrative can span several
+    lines) and both of its sides are parsed.
+  * For every (hash_id, code) whose rows the hunks change, the group's rows outside
+    the hunks are located in both versions, so every row gets the (hash_id, code,
+    occurrence) key and digest a full scan would give it.
+
+Only the diff is parsed, plus, rarely, rows whose occurrence shifted. Whenever the
+hunks cannot be mapped to whole records this way, delta_changes returns None and the
+caller falls back to a full scan.
+"""
+import csv
+import io
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from fingerprints import KEY_COLUMNS, RowKey, row_digests
+from upstream_git import git, open_blob
+
+# A record's first line starts with its hash_id
+RECORD_START = re.compile(r'[0-9a-f]{16},')
+HASH_ID = re.compile(r'[0-9a-f]{16}')
+
+HUNK_HEADER = re.compile(rb'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+# Context lines asked of git diff around each change, doubled while hunks are too short to hold whole records
+DIFF_CONTEXT = 20
+MAX_DIFF_CONTEXT = 1280
+
+# (line number of the record's first line, values)
+Record = Tuple[int, List[str]]
+
+
+def diff_hunks(repo: str, old_commit: str, new_commit: str, path: str, context: int) -> List[Dict]:
+    """
+    Hunks of git's diff of a file between two commits.
+
+    Args:
+        repo: Repository
+        old_commit: Commit to diff from
+        new_commit: Commit to diff to
+        path: File path inside the repository
+        context: Unchanged lines to include around each change
+
+    Returns:
+        List of hunks, each with the old and new line numbers its lines start at and
+        its lines as (tag, text) pairs, tag being ' ', '-' or '+'
+    """
+    output = git(repo, 'diff', '--no-color', '--no-ext-diff', '--no-renames', '--text', f'-U{context}',
+                 old_commit, new_commit, '--', path)
+    hunks = []
+    for line in output.split(b'\n'):
+        match = HUNK_HEADER.match(line)
+        if match:
+            old_start, old_count, new_start, new_count = match.groups()
+            # A hunk with no old (or new) lines gives the line before it
+            hunks.append({
+                'old_start': int(old_start) + (old_count == b'0'),
+                'new_start': int(new_start) + (new_count == b'0'),
+                'lines': [],
+            })
+        elif hunks and line[:1] in (b' ', b'-', b'+'):
+            hunks[-1]['lines'].append((line[:1].decode(), line[1:].decode('utf-8')))
+    return hunks
+
+
+def widen_hunk(hunk: Dict, context: int) -> Optional[Tuple[List[Tuple[int, str]], List[Tuple[int, str]]]]:
+    """
+    Both sides of a hunk, cut down or extended to whole records around its changes.
+
+    The widened span starts at the unchanged line that starts the record before the
+    first change (or at the start of the file) and ends before the unchanged line that
+    starts the record after the last change (or at the end of the file).
+
+    Args:
+        hunk: Hunk from diff_hunks
+        context: Context the hunk was produced with
+
+    Returns:
+        Tuple of the old and new sides as (line number, text) pairs, or None if the
+        hunk's context does not reach a record boundary on either end
+    """
+    lines = hunk['lines']
+    changed = [i for i, (tag, _) in enumerate(lines) if tag != ' ']
+
+    def is_boundary(i):
+        return lines[i][0] == ' ' and RECORD_START.match(lines[i][1])
+
+    start = next((i for i in range(changed[0] - 1, -1, -1) if is_boundary(i)), None)
+    if start is None:
+        # Only a hunk at the top of the file may have less context before its changes
+        if hunk['old_start'] != 1:
+            return None
+        start = 0
+    end = next((i for i in range(changed[-1] + 1, len(lines)) if is_boundary(i)), None)
+    if end is None:
+        # Only a hunk at the end of the file may have less context after its changes
+        if len(lines) - 1 - changed[-1] >= context:
+            return None
+        end = len(lines)
+
+    old_side, new_side = [], []
+    old_line, new_line = hunk['old_start'], hunk['new_start']
+    for i, (tag, text) in enumerate(lines):
+        if start <= i < end:
+            if tag != '+':
+                old_side.append((old_line, text))
+            if tag != '-':
+                new_side.append((new_line, text))
+        old_line += tag != '+'
+        new_line += tag != '-'
+    return old_side, new_side
+
+
+def parse_records(side: List[Tuple[int, str]], column_count: int) -> Optional[List[Record]]:
+    """
+    Parse whole CSV records from consecutive lines of a file.
+
+    Args:
+        side: (line number, text) pairs; line 1, the header, is skipped
+        column_count: Number of columns every record must have
+
+    Returns:
+        Records with the line number they start at, or None if the lines do not parse
+        as whole records of the citations file
+    """
+    if side and side[0][0] == 1:
+        side = side[1:]
+    if not side:
+        return []
+
+    first_line = side[0][0]
+    reader = csv.reader((text + '\n' for _, text in side), strict=True)
+    records = []
+    try:
+        while True:
+            start = first_line + reader.line_num
+            try:
+                values = next(reader)
+            except StopIteration:
+                break
+            if len(values) != column_count or not HASH_ID.fullmatch(values[0]):
+                return None
+            records.append((start, values))
+    except csv.Error:
+        return None
+    return records
+
+
+def group_prefix(hash_id: str, code: str) -> str:
+    """
+    How a record of a (hash_id, code) group starts in the CSV.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='').writerow([hash_id, code, ''])
+    return buffer.getvalue()
+
+
+def group_lines(repo: str, commit: str, path: str, groups: Set[Tuple[str, str]]) -> Dict[Tuple[str, str], List[int]]:
+    """
+    Line numbers of every record of some (hash_id, code) groups in a file at a commit.
+
+    Lines are only compared on their first bytes, which is much faster than parsing the
+    file (or git grep with many patterns).
+
+    Args:
+        repo: Repository
+        commit: Commit
+        path: File path inside the repository
+        groups: (hash_id, code) pairs
+
+    Returns:
+        Dictionary mapping each group to the sorted line numbers of its records
+    """
+    prefixes = {group_prefix(*group).encode('utf-8'): group for group in groups}
+    hash_ids = {prefix[:16] for prefix in prefixes}
+    lines = {group: [] for group in groups}
+    if not groups:
+        return lines
+
+    with open_blob(repo, commit, path) as blob:
+        for line_number, line in enumerate(blob, start=1):
+            if line[:16] in hash_ids:
+                for prefix, group in prefixes.items():
+                    if line.startswith(prefix):
+                        lines[group].append(line_number)
+    return lines
+
+
+def read_records(repo: str, commit: str, path: str, line_numbers: Set[int]) -> Dict[int, List[str]]:
+    """
+    Read the records starting at some lines of a file at a commit.
+
+    Args:
+        repo: Repository
+        commit: Commit
+        path: File path inside the repository
+        line_numbers: Lines records start at
+
+    Returns:
+        Dictionary mapping each line number to the values of its record
+    """
+    records = {}
+    pending = None
+    quotes = 0
+    with open_blob(repo, commit, path) as blob:
+        # Lines split on b'\n' only, as git numbers them: a narrative may hold a bare '\r'
+        for line_number, line in enumerate(blob, start=1):
+            if pending is None and line_number in line_numbers:
+                pending = (line_number, [])
+                quotes = 0
+            if pending is not None:
+                pending[1].append(line)
+                quotes += line.count(b'"')
+                # A record ends on a line that closes every quote opened since it started
+                if quotes % 2 == 0:
+                    records[pending[0]] = next(csv.reader([b''.join(pending[1]).decode('utf-8')]))
+                    pending = None
+                    if len(records) == len(line_numbers):
+                        break
+    return records
+
+
+def read_header(repo: str, commit: str, path: str) -> List[str]:
+    """
+    Column names of a CSV file at a commit.
+    """
+    with open_blob(repo, commit, path) as blob:
+        return next(csv.reader([blob.readline().decode('utf-8')]))
+
+
+def delta_changes(repo: str, old_commit: str, new_commit: str, path: str,
+                  previous_index: Dict[RowKey, str]) -> Optional[Dict]:
+    """
+    Rows inserted, changed or deleted between two commits of the upstream file, from git's diff.
+
+    Args:
+        repo: Upstream repository
+        old_commit: Commit previous_index was built from
+        new_commit: Commit to bring the index to
+        path: Citations file path inside the repository
+        previous_index: Fingerprint index of the file at old_commit
+
+    Returns:
+        The same dictionary as extract_new_rows.scan_changes, or None if the diff cannot
+        be mapped to whole records
+    """
+    columns = read_header(repo, new_commit, path)
+    if read_header(repo, old_commit, path) != columns or columns[:len(KEY_COLUMNS)] != KEY_COLUMNS:
+        return None
+
+    context = DIFF_CONTEXT
+    while True:
+        hunks = diff_hunks(repo, old_commit, new_commit, path, context)
+        sides = [widen_hunk(hunk, context) for hunk in hunks]
+        if all(side is not None for side in sides):
+            break
+        if context >= MAX_DIFF_CONTEXT:
+            return None
+        context *= 2
+
+    old_records, new_records = [], []
+    old_hunks, new_hunks = [], []
+    for hunk, (old_side, new_side) in enumerate(sides):
+        old_parsed = parse_records(old_side, len(columns))
+        new_parsed = parse_records(new_side, len(columns))
+        if old_parsed is None or new_parsed is None:
+            return None
+        old_records.extend(old_parsed)
+        new_records.extend(new_parsed)
+        old_hunks.extend([hunk] * len(old_parsed))
+        new_hunks.extend([hunk] * len(new_parsed))
+
+    old_digests = row_digests(pd.DataFrame([values for _, values in old_records], columns=columns, dtype=str))
+    new_digests = dict(zip((line for line, _ in new_records),
+                           row_digests(pd.DataFrame([values for _, values in new_records], columns=columns, dtype=str))))
+    new_values = dict(new_records)
+    old_in_hunks, new_in_hunks = {}, {}
+    old_sequences, new_sequences = {}, {}
+    for (line, values), hunk, digest in zip(old_records, old_hunks, old_digests):
+        old_in_hunks.setdefault((values[0], values[1]), set()).add(line)
+        old_sequences.setdefault((values[0], values[1]), []).append((hunk, digest))
+    for (line, values), hunk in zip(new_records, new_hunks):
+        new_in_hunks.setdefault((values[0], values[1]), set()).add(line)
+        new_sequences.setdefault((values[0], values[1]), []).append((hunk, new_digests[line]))
+
+    # Keys depend on each row's position among the rows sharing its hash_id and code, so
+    # every group whose rows any hunk changes is renumbered, rows outside the hunks
+    # included. Lines outside the hunks are the same in both versions, so a group only
+    # has rows outside the hunks if it had some before.
+    groups = {group for group in old_sequences.keys() | new_sequences.keys()
+              if old_sequences.get(group) != new_sequences.get(group)}
+    old_counts = {}
+    for group in groups:
+        old_counts[group] = 0
+        while (*group, old_counts[group]) in previous_index:
+            old_counts[group] += 1
+    spread = {group for group in groups if old_counts[group] != len(old_in_hunks.get(group, ()))}
+    old_lines = {group: sorted(old_in_hunks.get(group, ())) for group in groups}
+    new_lines = {group: sorted(new_in_hunks.get(group, ())) for group in groups}
+    old_lines.update(group_lines(repo, old_commit, path, spread))
+    new_lines.update(group_lines(repo, new_commit, path, spread))
+
+    current_index = dict(previous_index)
+    rows = []  # (line, key, change)
+    removed_keys = set()
+    for group in groups:
+        old_count = old_counts[group]
+        if len(old_lines[group]) != old_count or not old_in_hunks.get(group, set()) <= set(old_lines[group]):
+            return None
+        outside = [previous_index[(*group, occurrence)] for occurrence, line in enumerate(old_lines[group])
+                   if line not in old_in_hunks.get(group, ())]
+        new_outside = [line for line in new_lines[group] if line not in new_in_hunks.get(group, ())]
+        if len(new_outside) != len(outside) or not new_in_hunks.get(group, set()) <= set(new_lines[group]):
+            return None
+
+        # Rows outside the hunks are unchanged and keep their order
+        outside_digests = dict(zip(new_outside, outside))
+        for occurrence, line in enumerate(new_lines[group]):
+            key = (*group, occurrence)
+            digest = new_digests[line] if line in new_digests else outside_digests[line]
+            previous_digest = previous_index.get(key)
+            current_index[key] = digest
+            if previous_digest is None:
+                rows.append((line, key, 'inserted'))
+            elif previous_digest != digest:
+                rows.append((line, key, 'changed'))
+        for occurrence in range(len(new_lines[group]), old_count):
+            removed_keys.add((*group, occurrence))
+            del current_index[(*group, occurrence)]
+
+    # Rows outside the hunks whose occurrence shifted onto a different row are read from the file
+    missing = {line for line, _, _ in rows if line not in new_values}
+    if missing:
+        new_values.update(read_records(repo, new_commit, path, missing))
+
+    rows.sort()
+    new_rows = pd.DataFrame([new_values[line] for line, _, _ in rows], columns=columns, dtype=str)
+    return {
+        'current_index': current_index,
+        'new_rows': new_rows,
+        'inserted': sum(change == 'inserted' for _, _, change in rows),
+        'changed_keys': [key for _, key, change in rows if change == 'changed'],
+        'changed_batch_rows': [row for row, (_, _, change) in enumerate(rows) if change == 'changed'],
+        # In index order, as a full scan lists them
+        'deleted_keys': [key for key in previous_index if key in removed_keys],
+    }
@@ -0,0 +1,119 @@
+"""
+The aphis-inspection-reports repository, read through git.
+
+Where the upstream citations file lives, which upstream commit the fingerprint index
+was last brought to, and plain git plumbing to read the file at any commit without
+checking it out. Nothing here needs pandas, so a run can tell that upstream has not
+changed before loading anything heavier.
+"""
+import contextlib
+import os
+import subprocess
+from typing import BinaryIO, Iterator, Optional
+
+UPSTREAM_REPO = '../aphis-inspection-reports'
+UPSTREAM_PATH = 'data/combined/inspections-citations.csv'
+UPSTREAM_REF = 'origin/main'
+
+# Upstream commit whose citations file the fingerprint index describes, for --delta
+COMMIT_FILE = '../data/flagging_process/upstream_commit.txt'
+
+
+def git(repo: str, *args: str, input: Optional[bytes] = None) -> bytes:
+    """
+    Run a git command in a repository and return its output.
+
+    Args:
+        repo: Repository (working tree or bare)
+        args: git arguments
+        input: Bytes for the command's standard input
+
+    Returns:
+        Standard output
+    """
+    return subprocess.run(['git', '-C', repo, *args], input=input, capture_output=True, check=True).stdout
+
+
+def resolve_commit(repo: str, ref: str) -> Optional[str]:
+    """
+    Commit hash a ref points to, or None if it cannot be resolved.
+    """
+    try:
+        return git(repo, 'rev-parse', '--verify', '--quiet', f'{ref}^{{commit}}').decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def blob_id(repo: str, commit: str, path: str) -> Optional[str]:
+    """
+    Object id of a file at a commit, or None if the commit or file is missing.
+    """
+    try:
+        return git(repo, 'rev-parse', '--verify', '--quiet', f'{commit}:{path}').decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def is_ancestor(repo: str, old_commit: str, new_commit: str) -> bool:
+    """
+    Whether old_commit is in new_commit's history; False if either is missing, as after a force push.
+    """
+    try:
+        result = subprocess.run(['git', '-C', repo, 'merge-base', '--is-ancestor', old_commit, new_commit], capture_output=True)
+    except OSError:
+        return False
+    return result.returncode == 0
+
+
+@contextlib.contextmanager
+def open_blob(repo: str, commit: str, path: str) -> Iterator[BinaryIO]:
+    """
+    Stream a file's content at a commit, without checking it out.
+
+    Args:
+        repo: Repository
+        commit: Commit
+        path: File path inside the repository
+
+    Returns:
+        Context manager giving a binary file object
+    """
+    process = subprocess.Popen(['git', '-C', repo, 'cat-file', 'blob', f'{commit}:{path}'], stdout=subprocess.PIPE)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        if process.wait() not in (0, -13):  # -13: stopped early by SIGPIPE
+            raise RuntimeError(f"git cat-file failed for {commit}:{path}")
+
+
+def file_unchanged(repo: str, path: str, old_commit: str, new_commit: str) -> bool:
+    """
+    Whether a file has the same content at two commits.
+    """
+    if old_commit == new_commit:
+        return True
+    old_blob = blob_id(repo, old_commit, path)
+    return old_blob is not None and old_blob == blob_id(repo, new_commit, path)
+
+
+def read_indexed_commit(commit_file: str = COMMIT_FILE) -> Optional[str]:
+    """
+    Upstream commit the fingerprint index was last brought to, if recorded.
+    """
+    if not os.path.exists(commit_file):
+        return None
+    with open(commit_file) as f:
+        return f.read().strip() or None
+
+
+def write_indexed_commit(commit: Optional[str], commit_file: str = COMMIT_FILE):
+    """
+    Record the upstream commit the fingerprint index describes, or that it is unknown.
+    """
+    if commit is None:
+        if os.path.exists(commit_file):
+            os.remove(commit_file)
+        return
+    with open(commit_file, 'w') as f:
+        f.write(commit + '\n')